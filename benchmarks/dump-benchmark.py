@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# End-to-end benchmark of groupwise-to-ics: a generated mailbox is served
+# by the local IMAP stand-in with the given latency and bandwidth, and the
+# script is run against it.
+
+import json
+import optparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, os.path.join(TOP_DIR, 'tests'))
+sys.path.insert(0, BENCH_DIR)
+import gwgen
+import imapserver
+
+CONFIG_TEMPLATE = '''gw = {
+    'imap'      : '127.0.0.1',
+    'port'      : %(port)d,
+    'ssl'       : False,
+    'login'     : 'bench',
+    'password'  : 'bench',
+}
+'''
+
+def run_dump(server, workdir, options, extra_args):
+    '''
+    Runs groupwise-to-ics once against the server.
+
+    @result: a dictionary with the timing and the server statistics
+    '''
+    server.stats.reset()
+    args = [sys.executable, os.path.join(TOP_DIR, 'groupwise-to-ics'),
+            '--config', os.path.join(workdir, 'config'),
+            '--ics', os.path.join(workdir, 'out', 'calendar.ics'),
+            '--batch-size', str(options.batch_size),
+            '--connections', str(options.connections)] + extra_args
+    if options.partial:
+        args.append('--partial-fetch')
+    start = time.time()
+    process = subprocess.Popen(args, cwd=workdir)
+    process.wait()
+    duration = time.time() - start
+    if process.returncode != 0:
+        raise Exception('groupwise-to-ics failed with code %d' % process.returncode)
+
+    result = server.stats.to_dict()
+    result['duration'] = duration
+    return result
+
+def print_result(label, result, messages):
+    print '%s:' % label
+    print '  Duration:       %.2f s' % result['duration']
+    if messages > 0:
+        print '  Messages/s:     %.1f' % (messages / result['duration'])
+    print '  Sessions:       %d' % result['sessions']
+    print '  Round-trips:    %d  (%s)' % (result['round_trips'],
+        ', '.join(['%s: %d' % item for item in sorted(result['commands'].items())]))
+    print '  Bytes sent:     %d' % result['bytes_in']
+    print '  Bytes received: %d' % result['bytes_out']
+
+def main(args):
+    usage_str = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage = usage_str)
+
+    parser.add_option('--latency', dest='latency',
+                      type='float', default=20,
+                      metavar='MS',
+                      help='Delay added to each IMAP command in milliseconds '
+                           '(default: %default)')
+    parser.add_option('--bandwidth', dest='bandwidth',
+                      type='int', default=0,
+                      metavar='KB/S',
+                      help='Maximum bandwidth of the IMAP responses in kilobytes '
+                           'per second, 0 for unlimited (default: %default)')
+    parser.add_option('--batch-size', dest='batch_size',
+                      type='int', default=200,
+                      metavar='COUNT',
+                      help='Value of the groupwise-to-ics option (default: %default)')
+    parser.add_option('--connections', dest='connections',
+                      type='int', default=1,
+                      metavar='COUNT',
+                      help='Value of the groupwise-to-ics option (default: %default)')
+    parser.add_option('--partial-fetch', dest='partial',
+                      action='store_true', default=False,
+                      help='Value of the groupwise-to-ics option')
+    parser.add_option('--new', dest='new',
+                      type='int', default=0,
+                      metavar='COUNT',
+                      help='Also measure an incremental run with a state file, '
+                           'after adding COUNT new mails (default: %default)')
+    parser.add_option('--output', dest='output',
+                      default=None,
+                      metavar='FILE',
+                      help='Write the results as JSON to FILE')
+    gwgen.add_options(parser)
+
+    (options, args) = parser.parse_args()
+
+    params = gwgen.options_to_params(options)
+    mails = [mail for (date, mail) in gwgen.generate_mails(params)]
+
+    mailbox = imapserver.Mailbox()
+    count = len(mails) - options.new
+    for mail in mails[:count]:
+        mailbox.append(mail)
+
+    server = imapserver.IMAPServer(('127.0.0.1', 0), mailbox,
+                                   latency=options.latency / 1000.0,
+                                   bandwidth=options.bandwidth * 1024)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix='gw-bench-')
+    report = {
+        'params': params,
+        'latency': options.latency,
+        'bandwidth': options.bandwidth,
+        'batch_size': options.batch_size,
+        'connections': options.connections,
+        'partial': options.partial,
+        'results': {},
+    }
+    try:
+        fp = open(os.path.join(workdir, 'config'), 'w')
+        fp.write(CONFIG_TEMPLATE % {'port': server.server_address[1]})
+        fp.close()
+
+        result = run_dump(server, workdir, options, [])
+        report['results']['full'] = result
+        print_result('Full dump of %d mails' % count, result, count)
+
+        if options.new > 0:
+            state = ['--state', os.path.join(workdir, 'state')]
+            run_dump(server, workdir, options, state)
+            for mail in mails[count:]:
+                mailbox.append(mail)
+            result = run_dump(server, workdir, options, state)
+            report['results']['incremental'] = result
+            print_result('Incremental dump of %d new mails' % options.new,
+                         result, options.new)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+    if options.output is not None:
+        fp = open(options.output, 'w')
+        json.dump(report, fp, indent=2, sort_keys=True)
+        fp.close()
+
+    return 0
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    sys.exit(ret)
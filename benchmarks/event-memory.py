@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the memory used by parsed events kept alive, like dump does.
+
+import optparse
+import os
+import os.path
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cal
+
+EVENT_TEMPLATE = '\r\n'.join(['BEGIN:VCALENDAR',
+                              'VERSION:2.0',
+                              'BEGIN:VEVENT',
+                              'UID:%(index)d-event-uid@hacker.com',
+                              'X-GWRECORDID:%(index)d-recordid',
+                              'DTSTAMP:20131007T194119Z',
+                              'DTSTART:20131008T130000Z',
+                              'DTEND:20131008T133000Z',
+                              'TRANSP:OPAQUE',
+                              'SEQUENCE:2',
+                              'SUMMARY:event number %(index)d',
+                              'LOCATION:test location',
+                              'DESCRIPTION:test description',
+                              'CLASS:PUBLIC',
+                              'STATUS:CONFIRMED',
+                              'ORGANIZER;CN=Joe Hacker:MAILTO:joe@hacker.com',
+                              'ATTENDEE;CUTYPE=INDIVIDUAL;ROLE=REQ-PARTICIPANT;PARTSTAT=ACCEPTED;',
+                              ' RSVP=TRUE;CN=Joe HACKER;LANGUAGE=en:MAILTO:joe@hacker.com',
+                              'ATTENDEE;CUTYPE=INDIVIDUAL;ROLE=REQ-PARTICIPANT;PARTSTAT=NEEDS-ACTION;',
+                              ' RSVP=TRUE;LANGUAGE=en:MAILTO:alice@hacker.com',
+                              'END:VEVENT',
+                              'END:VCALENDAR'])
+
+def get_rss():
+    '''
+    @result: the current resident set size in bytes
+    '''
+    try:
+        fdescr = open('/proc/self/statm', 'r')
+        pages = int(fdescr.read().split()[1])
+        fdescr.close()
+        return pages * resource.getpagesize()
+    except IOError:
+        # Not on Linux: fall back to the peak RSS in kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def main(args):
+    usage_str = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage = usage_str)
+
+    parser.add_option('--count', dest='count',
+                      type='int', default=100000,
+                      help='Number of events to keep in memory (default: 100000)')
+
+    (options, args) = parser.parse_args()
+
+    events = []
+    rss_before = get_rss()
+    start = time.time()
+    for index in xrange(options.count):
+        calendar = cal.Calendar()
+        calendar.parse(EVENT_TEMPLATE % {'index': index}, [])
+        events.extend(calendar.events)
+    duration = time.time() - start
+    rss_after = get_rss()
+
+    print 'Events:           %d' % len(events)
+    print 'Parse time:       %.2f s' % duration
+    print 'RSS increase:     %.1f MB' % ((rss_after - rss_before) / 1048576.0)
+    print 'Bytes per event:  %d' % ((rss_after - rss_before) / max(len(events), 1))
+
+    return 0
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    sys.exit(ret)
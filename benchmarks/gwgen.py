@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generator of synthetic GroupWise calendars: invitation mails looking
+# like the ones GroupWise puts in the Calendar IMAP folder and plain
+# iCalendar files.
+
+import base64
+import datetime
+import email.utils
+import optparse
+import os
+import os.path
+import random
+import sys
+import time
+
+DEFAULTS = {
+    'events': 1000,         # Number of distinct events
+    'versions': 1,          # Number of mails per event: updates, reschedules
+    'recurring': 0.2,       # Ratio of recurring events
+    'exdates': 3,           # Number of EXDATEs of the recurring events
+    'attendees': 5,         # Number of attendees per event
+    'timezones': 3,         # Number of distinct VTIMEZONEs
+    'attachments': 0.1,     # Ratio of events with an attachment
+    'attachment_size': 20000,
+    'seed': 42,
+}
+
+# First day of the generated events
+START = datetime.datetime(2013, 1, 7, 8, 0, 0)
+
+def fold(line):
+    '''
+    Folds a content line at 75 characters like GroupWise does.
+    '''
+    if len(line) <= 75:
+        return [line]
+    lines = [line[:75]]
+    for i in range(75, len(line), 74):
+        lines.append(' %s' % line[i:i + 74])
+    return lines
+
+def generate_timezones(params):
+    '''
+    @result: list of (tzid, lines) tuples
+    '''
+    timezones = []
+    for i in range(params['timezones']):
+        tzid = '(GMT+%02d.00) Generated Zone %d' % (i % 12, i)
+        standard = i % 12
+        lines = ['BEGIN:VTIMEZONE',
+                 'TZID:%s' % tzid,
+                 'BEGIN:STANDARD',
+                 'TZOFFSETFROM:+%02d00' % (standard + 1),
+                 'TZOFFSETTO:+%02d00' % standard,
+                 'DTSTART:20001029T030000',
+                 'RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10',
+                 'TZNAME:Standard Time %d' % i,
+                 'END:STANDARD',
+                 'BEGIN:DAYLIGHT',
+                 'TZOFFSETFROM:+%02d00' % standard,
+                 'TZOFFSETTO:+%02d00' % (standard + 1),
+                 'DTSTART:20000326T020000',
+                 'RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3',
+                 'TZNAME:Daylight Time %d' % i,
+                 'END:DAYLIGHT',
+                 'END:VTIMEZONE']
+        timezones.append((tzid, lines))
+    return timezones
+
+def format_date(dt, tzid):
+    if tzid is None:
+        return ':%s' % dt.strftime('%Y%m%dT%H%M%SZ')
+    return ';TZID="%s":%s' % (tzid, dt.strftime('%Y%m%dT%H%M%S'))
+
+def generate_event(rng, index, version, params, timezones):
+    '''
+    Generates a version of an event.
+
+    @result: (dtstamp, lines, attachments) where attachments is a list of
+             (filename, content-type, payload) tuples
+    '''
+    start = START + datetime.timedelta(days=index % 700, hours=rng.randint(0, 9))
+    end = start + datetime.timedelta(minutes=rng.choice([30, 60, 90, 120]))
+    # Each version is sent a few days after the previous one
+    dtstamp = start - datetime.timedelta(days=30) + datetime.timedelta(days=2 * version,
+                                                                       seconds=index)
+
+    tzid = None
+    if len(timezones) > 0 and rng.random() < 0.7:
+        tzid = timezones[rng.randrange(len(timezones))][0]
+
+    lines = ['BEGIN:VEVENT',
+             'X-GWITEM-TYPE:APPOINTMENT',
+             'DTSTART%s' % format_date(start, tzid),
+             'SUMMARY:Generated meeting %d (v%d)' % (index, version),
+             'DTSTAMP:%s' % dtstamp.strftime('%Y%m%dT%H%M%SZ'),
+             'X-GWMESSAGEID:%08X.EMEA5.EMEA5-1.200.20000E9.1.%X.%d' % (index, index, version),
+             'LAST-MODIFIED:%s' % dtstamp.strftime('%Y%m%dT%H%M%SZ'),
+             'TRANSP:OPAQUE',
+             'X-GWSHOW-AS:BUSY',
+             'X-MICROSOFT-CDO-INTENDEDSTATUS:BUSY',
+             'STATUS:%s' % rng.choice(['TENTATIVE', 'CONFIRMED']),
+             'X-GWRECORDID:%08X.record.%d' % (index, index),
+             'ORGANIZER;CN="Organizer %d";ROLE=CHAIR:MAILTO:organizer%d@hacker.com' % (
+                 index % 50, index % 50)]
+
+    for i in range(params['attendees']):
+        attendee = rng.randrange(500)
+        lines.append('ATTENDEE;CN="Attendee %d";PARTSTAT=%s;ROLE=REQ-PARTICIPANT;'
+                     'RSVP=TRUE:MAILTO:attendee%d@hacker.com' % (
+                         attendee, rng.choice(['NEEDS-ACTION', 'ACCEPTED', 'TENTATIVE']),
+                         attendee))
+
+    lines.append('DESCRIPTION:%s' % (('Agenda of the generated meeting %d. ' % index) * 4))
+
+    if rng.random() < params['recurring']:
+        lines.append('RRULE:FREQ=WEEKLY;COUNT=%d;INTERVAL=1;BYDAY=%s' % (
+                     rng.randint(10, 50), start.strftime('%a')[:2].upper()))
+        exdates = [start + datetime.timedelta(weeks=rng.randint(1, 9))
+                   for i in range(params['exdates'])]
+        if len(exdates) > 0:
+            if tzid is None:
+                values = [date.strftime('%Y%m%dT%H%M%SZ') for date in exdates]
+                lines.append('EXDATE:%s' % ','.join(values))
+            else:
+                values = [date.strftime('%Y%m%dT%H%M%S') for date in exdates]
+                lines.append('EXDATE;TZID="%s":%s' % (tzid, ','.join(values)))
+
+    attachments = []
+    if rng.random() < params['attachments']:
+        payload = ''.join([chr(rng.randrange(256))
+                           for i in range(min(params['attachment_size'], 256))])
+        payload = (payload * (params['attachment_size'] / len(payload) + 1))[:params['attachment_size']]
+        attachments.append(('slides-%d.pdf' % index, 'application/pdf', payload))
+        lines.append('ATTACH:CID:...')
+
+    lines.extend(['LOCATION:Room %d' % (index % 30),
+                  'DTEND%s' % format_date(end, tzid),
+                  'UID:%08d-generated-%d@hacker.com' % (index, index),
+                  'PRIORITY:5',
+                  'CLASS:PUBLIC',
+                  'X-GWCLASS:NORMAL',
+                  'END:VEVENT'])
+
+    folded = []
+    for line in lines:
+        folded.extend(fold(line))
+    return (dtstamp, folded, attachments)
+
+def referenced_timezones(lines, timezones):
+    result = []
+    # Unfold the lines as a TZID may be split
+    content = ''.join([line[1:] if line.startswith(' ') else '\n' + line
+                       for line in lines])
+    for (tzid, tzlines) in timezones:
+        if 'TZID="%s"' % tzid in content:
+            result.extend(tzlines)
+    return result
+
+def generate_mail(index, version, dtstamp, event_lines, attachments, timezones):
+    ics = '\r\n'.join(['BEGIN:VCALENDAR',
+                       'VERSION:2.0',
+                       'PRODID:-//Novell Inc//Groupwise 12.0.2 ',
+                       'METHOD:REQUEST'] +
+                      referenced_timezones(event_lines, timezones) +
+                      event_lines +
+                      ['END:VCALENDAR'])
+    date = email.utils.formatdate(time.mktime(dtstamp.timetuple()))
+    lines = ['Mime-Version: 1.0',
+             'X-Mailer: GroupWise 2012',
+             'Subject: Generated meeting %d' % index,
+             'Date: %s' % date,
+             'Message-ID: <%08X.%d@hacker.com>' % (index, version),
+             'From: "Organizer %d" <organizer%d@hacker.com>' % (index % 50, index % 50),
+             'To: Bob Hacker <bob@hacker.com>',
+             'Content-Type: multipart/mixed; boundary="____MIXED____"',
+             '',
+             '',
+             '--____MIXED____',
+             'Content-Type: multipart/alternative; boundary="____ALTERNATIVE____"',
+             '',
+             '',
+             '--____ALTERNATIVE____',
+             'Content-Type: text/plain; charset=utf-8',
+             'Content-Transfer-Encoding: quoted-printable',
+             'Content-Disposition: inline',
+             '',
+             'Item Type:  Appointment',
+             'Generated meeting %d' % index,
+             '',
+             '--____ALTERNATIVE____',
+             'Content-class: urn:content-classes:calendarmessage',
+             'Content-Type: text/calendar; charset=utf-8; component="vevent";',
+             '\t method="request"',
+             'Content-Transfer-Encoding: 8bit',
+             '',
+             ics,
+             '',
+             '--____ALTERNATIVE____--',
+             '']
+    for (filename, content_type, payload) in attachments:
+        encoded = base64.encodestring(payload).replace('\n', '\r\n')
+        lines.extend(['--____MIXED____',
+                      'Content-Type: %s' % content_type,
+                      'Content-Transfer-Encoding: base64',
+                      'Content-Disposition: attachment; ',
+                      ' filename="%s"' % filename,
+                      '',
+                      encoded])
+    lines.append('--____MIXED____--')
+    return '\r\n'.join(lines)
+
+def generate_mails(params=None):
+    '''
+    Generator producing the invitation mails of the calendar, sorted by
+    date like GroupWise stores them.
+
+    @result: (date, mail) tuples
+    '''
+    params = get_params(params)
+    rng = random.Random(params['seed'])
+    timezones = generate_timezones(params)
+
+    mails = []
+    for index in range(params['events']):
+        for version in range(params['versions']):
+            (dtstamp, lines, attachments) = generate_event(rng, index, version,
+                                                           params, timezones)
+            mails.append((dtstamp, index, version, lines, attachments))
+    mails.sort()
+
+    for (dtstamp, index, version, lines, attachments) in mails:
+        yield (dtstamp, generate_mail(index, version, dtstamp, lines,
+                                      attachments, timezones))
+
+def generate_ics(params=None):
+    '''
+    @result: a plain iCalendar document with the latest version of each
+             event, like the one written by groupwise-to-ics
+    '''
+    params = get_params(params)
+    rng = random.Random(params['seed'])
+    timezones = generate_timezones(params)
+
+    lines = ['BEGIN:VCALENDAR',
+             'PRODID:-//SUSE Hackweek//NONSGML groupwise-to-ics//EN',
+             'VERSION:2.0']
+    for (tzid, tzlines) in timezones:
+        lines.extend(tzlines)
+    for index in range(params['events']):
+        for version in range(params['versions']):
+            (dtstamp, event_lines, attachments) = generate_event(rng, index, version,
+                                                                 params, timezones)
+        lines.extend(event_lines)
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+def get_params(params):
+    result = DEFAULTS.copy()
+    if params is not None:
+        result.update(params)
+    return result
+
+def add_options(parser):
+    '''
+    Adds the generator parameters options to an optparse parser.
+    '''
+    parser.add_option('--events', dest='events', type='int',
+                      default=DEFAULTS['events'],
+                      help='Number of distinct events (default: %default)')
+    parser.add_option('--versions', dest='versions', type='int',
+                      default=DEFAULTS['versions'],
+                      help='Number of mails per event (default: %default)')
+    parser.add_option('--recurring', dest='recurring', type='float',
+                      default=DEFAULTS['recurring'],
+                      help='Ratio of recurring events (default: %default)')
+    parser.add_option('--exdates', dest='exdates', type='int',
+                      default=DEFAULTS['exdates'],
+                      help='Number of EXDATEs per recurring event (default: %default)')
+    parser.add_option('--attendees', dest='attendees', type='int',
+                      default=DEFAULTS['attendees'],
+                      help='Number of attendees per event (default: %default)')
+    parser.add_option('--timezones', dest='timezones', type='int',
+                      default=DEFAULTS['timezones'],
+                      help='Number of distinct VTIMEZONEs (default: %default)')
+    parser.add_option('--attachments', dest='attachments', type='float',
+                      default=DEFAULTS['attachments'],
+                      help='Ratio of events with an attachment (default: %default)')
+    parser.add_option('--attachment-size', dest='attachment_size', type='int',
+                      default=DEFAULTS['attachment_size'],
+                      help='Size of the attachments in bytes (default: %default)')
+    parser.add_option('--seed', dest='seed', type='int',
+                      default=DEFAULTS['seed'],
+                      help='Random generator seed (default: %default)')
+
+def options_to_params(options):
+    params = {}
+    for key in DEFAULTS:
+        params[key] = getattr(options, key)
+    return params
+
+def main(args):
+    usage_str = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage = usage_str)
+
+    parser.add_option('--ics', dest='ics',
+                      default=None,
+                      metavar='FILE',
+                      help='iCalendar file to generate')
+    parser.add_option('--maildir', dest='maildir',
+                      default=None,
+                      metavar='DIR',
+                      help='Folder where to write the generated mails, one per file')
+    add_options(parser)
+
+    (options, args) = parser.parse_args()
+
+    if options.ics is None and options.maildir is None:
+        parser.error('--ics or --maildir is required')
+
+    params = options_to_params(options)
+
+    if options.ics is not None:
+        fp = open(options.ics, 'w')
+        fp.write(generate_ics(params))
+        fp.close()
+
+    if options.maildir is not None:
+        if not os.path.isdir(options.maildir):
+            os.makedirs(options.maildir)
+        count = 0
+        for (date, mail) in generate_mails(params):
+            count += 1
+            fp = open(os.path.join(options.maildir, '%08d.eml' % count), 'w')
+            fp.write(mail)
+            fp.close()
+
+    return 0
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    sys.exit(ret)
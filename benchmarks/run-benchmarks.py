@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Times and memory-profiles the calendar operations on synthetic
+# GroupWise calendars. The results are written as JSON so that two
+# revisions can be compared with --compare.
+
+import datetime
+import gc
+import json
+import optparse
+import os
+import os.path
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import cal
+import gwgen
+
+def get_rss():
+    '''
+    @result: the current resident set size in bytes
+    '''
+    try:
+        fdescr = open('/proc/self/statm', 'r')
+        pages = int(fdescr.read().split()[1])
+        fdescr.close()
+        return pages * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak_rss():
+    '''
+    Resets the peak RSS counter of the process if the kernel allows it.
+
+    @result: whether get_peak_rss() now measures from this point
+    '''
+    try:
+        fdescr = open('/proc/self/clear_refs', 'w')
+        fdescr.write('5')
+        fdescr.close()
+        return True
+    except IOError:
+        return False
+
+def get_peak_rss():
+    '''
+    @result: the peak resident set size in bytes or None if unknown
+    '''
+    try:
+        fdescr = open('/proc/self/status', 'r')
+        for line in fdescr:
+            if line.startswith('VmHWM:'):
+                fdescr.close()
+                return int(line.split()[1]) * 1024
+        fdescr.close()
+    except IOError:
+        pass
+    return None
+
+def get_revision():
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                   cwd=BENCH_DIR,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out = process.communicate()[0]
+        if process.returncode == 0:
+            return out.strip()
+    except OSError:
+        pass
+    return None
+
+def write_attachment(filename, payload):
+    return 'file:///tmp/%s' % filename
+
+class Fixtures(object):
+    '''
+    Lazily generates and parses the data the benchmarks work on so that
+    only what the selected benchmarks need is built.
+    '''
+
+    def __init__(self, params):
+        self.params = params
+        self._mails = None
+        self._ics = None
+        self._calendar = None
+        self._modified = None
+
+    def mails(self):
+        if self._mails is None:
+            self._mails = [mail for (date, mail) in gwgen.generate_mails(self.params)]
+        return self._mails
+
+    def ics(self):
+        if self._ics is None:
+            self._ics = gwgen.generate_ics(self.params)
+        return self._ics
+
+    def calendar(self):
+        if self._calendar is None:
+            self._calendar = cal.Calendar()
+            self._calendar.parse(self.ics(), [])
+        return self._calendar
+
+    def modified(self):
+        '''
+        @result: a copy of the calendar with one event out of ten changed
+        '''
+        if self._modified is None:
+            ics = self.ics()
+            self._modified = cal.Calendar()
+            self._modified.parse(ics, [])
+            for (index, event) in enumerate(self._modified.events):
+                if index % 10 == 0:
+                    event.set_property('modified %d' % index, 'summary')
+        return self._modified
+
+def bench_mail_parse(fixtures):
+    mails = fixtures.mails()
+    def run():
+        for mail in mails:
+            cal.Calendar(mail, write_attachment)
+        return len(mails)
+    return run
+
+def bench_parse(fixtures):
+    ics = fixtures.ics()
+    def run():
+        calendar = cal.Calendar()
+        calendar.parse(ics, [])
+        return len(calendar.events)
+    return run
+
+def bench_diff(fixtures):
+    calendar = fixtures.calendar()
+    modified = fixtures.modified()
+    def run():
+        calendar.diff(modified)
+        return len(calendar.events)
+    return run
+
+def bench_to_ical(fixtures):
+    calendar = fixtures.calendar()
+    def run():
+        calendar.to_ical()
+        return len(calendar.events)
+    return run
+
+def bench_utcoffset(fixtures):
+    registry = fixtures.calendar().registry
+    timezones = [tz for (lines, tz) in registry.definitions.values()]
+    start = datetime.datetime(2010, 1, 1, 12, 0)
+    dates = [start + datetime.timedelta(days=day * 7) for day in xrange(520)]
+    def run():
+        for timezone in timezones:
+            for date in dates:
+                timezone.utcoffset(date)
+        return len(timezones) * len(dates)
+    return run
+
+def bench_event_eq(fixtures):
+    pairs = zip(fixtures.calendar().events, fixtures.modified().events)
+    def run():
+        for (left, right) in pairs:
+            left == right
+        return len(pairs)
+    return run
+
+def bench_occurrences(fixtures):
+    calendar = fixtures.calendar()
+    start = gwgen.START
+    def run():
+        index = cal.OccurrenceIndex(calendar)
+        for week in xrange(100):
+            index.search(start + datetime.timedelta(weeks=week),
+                         start + datetime.timedelta(weeks=week + 13))
+        return len(calendar.events)
+    return run
+
+BENCHMARKS = [
+    ('mail-parse', 'Calendar.__init__ on invitation mails', bench_mail_parse),
+    ('parse', 'Calendar.parse on an ICS file', bench_parse),
+    ('diff', 'Calendar.diff with 10% changed events', bench_diff),
+    ('to-ical', 'Calendar.to_ical', bench_to_ical),
+    ('utcoffset', 'Timezone.utcoffset over ten years', bench_utcoffset),
+    ('event-eq', 'Event.__eq__', bench_event_eq),
+    ('occurrences', 'OccurrenceIndex build and 100 searches', bench_occurrences),
+]
+
+def measure(factory, fixtures, repeat):
+    '''
+    Runs a benchmark repeat times.
+
+    @result: a dictionary with the timings and memory usage
+    '''
+    run = factory(fixtures)
+    times = []
+    items = 0
+    gc.collect()
+    rss_before = get_rss()
+    peak_reset = reset_peak_rss()
+    peak_before = get_peak_rss()
+    for i in xrange(repeat):
+        start = time.time()
+        items = run()
+        times.append(time.time() - start)
+    rss_after = get_rss()
+    peak_after = get_peak_rss()
+
+    best = min(times)
+    result = {
+        'best': best,
+        'times': times,
+        'items': items,
+        'items_per_second': items / best if best > 0 else None,
+        'rss_delta': rss_after - rss_before,
+        'peak_rss_delta': None,
+    }
+    if peak_reset and peak_before is not None and peak_after is not None:
+        result['peak_rss_delta'] = peak_after - rss_before
+    return result
+
+def compare(old, new):
+    '''
+    Prints the ratio between the best times of two result sets.
+    '''
+    print '%-12s %12s %12s %8s' % ('benchmark', 'old (s)', 'new (s)', 'ratio')
+    for (name, descr, factory) in BENCHMARKS:
+        if name not in old['results'] or name not in new['results']:
+            continue
+        old_best = old['results'][name]['best']
+        new_best = new['results'][name]['best']
+        ratio = new_best / old_best if old_best > 0 else float('inf')
+        print '%-12s %12.4f %12.4f %7.2fx' % (name, old_best, new_best, ratio)
+    if old['params'] != new['params']:
+        print 'Warning: the results were produced with different parameters'
+
+def main(args):
+    usage_str = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage = usage_str)
+
+    parser.add_option('--repeat', dest='repeat',
+                      type='int', default=3,
+                      help='Number of runs of each benchmark (default: %default)')
+    parser.add_option('--only', dest='only',
+                      action='append', default=[],
+                      metavar='NAME',
+                      help='Only run the given benchmark, can be repeated. ' +
+                           'One of: %s' % ', '.join([b[0] for b in BENCHMARKS]))
+    parser.add_option('--output', dest='output',
+                      default=None,
+                      metavar='FILE',
+                      help='Write the results as JSON to FILE')
+    parser.add_option('--compare', dest='compare',
+                      default=None,
+                      metavar='FILE',
+                      help='Compare the results with those of a previous --output')
+    gwgen.add_options(parser)
+
+    (options, args) = parser.parse_args()
+
+    names = [b[0] for b in BENCHMARKS]
+    for name in options.only:
+        if name not in names:
+            parser.error('unknown benchmark: %s' % name)
+
+    params = gwgen.options_to_params(options)
+    fixtures = Fixtures(params)
+
+    results = {}
+    for (name, descr, factory) in BENCHMARKS:
+        if len(options.only) > 0 and name not in options.only:
+            continue
+        result = measure(factory, fixtures, options.repeat)
+        results[name] = result
+        peak = ''
+        if result['peak_rss_delta'] is not None:
+            peak = ', peak +%.1f MB' % (result['peak_rss_delta'] / 1048576.0)
+        print '%-12s %9.4f s %12.0f items/s, RSS +%.1f MB%s  (%s)' % \
+              (name, result['best'], result['items_per_second'] or 0,
+               result['rss_delta'] / 1048576.0, peak, descr)
+
+    report = {
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'repeat': options.repeat,
+        'params': params,
+        'results': results,
+    }
+
+    if options.output is not None:
+        fp = open(options.output, 'w')
+        json.dump(report, fp, indent=2, sort_keys=True)
+        fp.close()
+
+    if options.compare is not None:
+        fp = open(options.compare, 'r')
+        old = json.load(fp)
+        fp.close()
+        print
+        compare(old, report)
+
+    return 0
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    sys.exit(ret)
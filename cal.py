@@ -17,46 +17,294 @@ import datetime
 import time
 from dateutil import rrule
 import email
+import email.message
 import os.path
 import sys
 import re
+import bisect
+import hashlib
+import threading
+import mmap
+import binascii
+# strptime imports it lazily, which isn't thread-safe in Python 2: the
+# first calls from the fetching threads could fail with an AttributeError
+import _strptime
+
+TZID_PARAM_RE = re.compile(r';TZID=("[^"]*"|[^;:]*)', re.IGNORECASE)
+# Parameter with a possibly quoted value, the quoted parts may contain ';' and ':'
+PARAM_RE = re.compile(r';([^=;:]*)(?:=((?:"[^"]*"|[^";:])*))?')
+
+def is_simple_header(header):
+    '''
+    The quoted parameter values usually contain neither ';' nor ':', then
+    the first ':' ends the parameters and ';' separates them.
+
+    @header: the parameters part of a content line up to its first ':'
+    '''
+    quoted = header.count('"')
+    if quoted == 0:
+        return True
+    if quoted == 2:
+        return header.find(';', header.find('"'), header.rfind('"')) < 0
+    return quoted % 2 == 0 and ';' not in ''.join(header.split('"')[1::2])
+
+def split_contentline(line):
+    '''
+    Splits an unfolded content line in a single pass.
+
+    @result: (name, params, value) where params is a list of (key, value)
+             tuples, the parameter value being None if there is no '='.
+             The value is None if the line has no ':' separator.
+    '''
+    colon = line.find(':')
+    semicolon = line.find(';')
+    if semicolon < 0 or 0 <= colon < semicolon:
+        # No parameters
+        if colon < 0:
+            return (line, [], None)
+        return (line[:colon], [], line[colon + 1:])
+
+    name = line[:semicolon]
+    if colon < 0:
+        colon = len(line)
+    header = line[semicolon + 1:colon]
+    if is_simple_header(header):
+        params = []
+        for param in header.split(';'):
+            (key, equal, value) = param.partition('=')
+            if not equal:
+                value = None
+            params.append((key, value))
+        return (name, params, line[colon + 1:] if colon < len(line) else None)
+
+    params = []
+    pos = semicolon
+    match = PARAM_RE.match(line, pos)
+    while match is not None:
+        params.append((match.group(1), match.group(2)))
+        pos = match.end()
+        match = PARAM_RE.match(line, pos)
+    value = None
+    if pos < len(line) and line[pos] == ':':
+        value = line[pos + 1:]
+    return (name, params, value)
+
+FOLDING_CHARS = (' ', '\t')
 
 class LineUnwrapper(object):
     def __init__(self, s):
-        try:
+        '''
+        @s: the iCalendar content either as a string or as an iterable
+            of lines like a file object
+        '''
+        if isinstance(s, basestring):
             self.lines = s.split('\n')
-        except:
+        elif hasattr(s, '__iter__'):
+            self.lines = s
+        else:
             print >> sys.stderr, "Can't parse %s\n" % (s)
             self.lines = []
-        self.lines_read = None
-        self.saved = None
 
     def each_line(self):
+        lines_read = None
+        saved = None
         for line in self.lines:
-            line = line.rstrip('\r')
-            if line.startswith(' ') or line.startswith('\t'):
-                if self.saved is None:
-                    self.saved = ''
-                    self.lines_read = []
-                self.lines_read.append(line)
-                self.saved += line.strip()
+            line = line.rstrip('\r\n')
+            if line[:1] in FOLDING_CHARS:
+                if saved is None:
+                    saved = ''
+                    lines_read = []
+                lines_read.append(line)
+                saved += line.strip()
             else:
-                if self.saved is not None:
-                    retval = (self.lines_read, self.saved)
-                    self.lines_read = [line]
-                    self.saved = line.strip()
-                    yield retval
-                self.lines_read = [line]
-                self.saved = line.strip()
+                if saved is not None:
+                    yield (lines_read, saved)
+                lines_read = [line]
+                saved = line.strip()
+        if saved is not None:
+            yield (lines_read, saved)
+
+class TimezoneRegistry(object):
+    '''
+    Interns the VTIMEZONE definitions by TZID and content digest: all the
+    calendars parsed with the same registry share a single parsed Timezone
+    object and lines list for identical definitions.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (TZID line, digest) -> (lines, Timezone)
+        self.definitions = {}
+        # Statistics: definitions seen again, parsed ones and time spent
+        # parsing them
+        self.reused = 0
+        self.parsed = 0
+        self.parse_time = 0.0
+
+    def intern(self, lines):
+        '''
+        Gets the shared definition matching the VTIMEZONE lines, parsing
+        them only if they have never been seen.
 
-class Calendar(object):
-    def __init__(self, mailstr, attach_write_func=None):
+        @result: (lines, timezone) tuple
+        '''
+        tzid = None
+        for line in lines:
+            if line.startswith('TZID:'):
+                tzid = line
+                break
+        key = (tzid, hashlib.sha1('\r\n'.join(lines)).digest())
+
+        with self.lock:
+            definition = self.definitions.get(key)
+            if definition is not None:
+                self.reused += 1
+        if definition is None:
+            start = time.time()
+            timezone = Timezone()
+            for line in lines[1:-1]:
+                timezone.parseline(line)
+            with self.lock:
+                definition = self.definitions.setdefault(key, (lines, timezone))
+                self.parsed += 1
+                self.parse_time += time.time() - start
+        return definition
+
+# Characters skipped by the base64 decoding, like binascii does
+BASE64_IGNORED = ''.join([chr(i) for i in range(256) if chr(i) not in
+                          'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                          '0123456789+/='])
+UU_ENCODINGS = ('x-uuencode', 'uuencode', 'uue', 'x-uue')
+
+class Attachment(object):
+    '''
+    Handle on a MIME attachment of a mail. The payload is only decoded when
+    read, by chunks, so that big attachments never have to be held decoded
+    in memory.
+    '''
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, part):
+        self.part = part
+        self.filename = part.get_filename()
+        self.content_type = part.get_content_type()
+
+    def get_encoded(self):
+        '''
+        @result: a (payload, Content-Transfer-Encoding) tuple with the
+                 payload still encoded
+        '''
+        payload = self.part.get_payload()
+        if not isinstance(payload, basestring):
+            # Multipart attachment: let email flatten it
+            return (self.part.get_payload(decode=True) or '', None)
+        encoding = str(self.part.get('Content-Transfer-Encoding', ''))
+        return (payload, encoding)
+
+    def iter_chunks(self):
+        '''
+        Generator decoding the payload and yielding it by chunks.
+        '''
+        (payload, encoding) = self.get_encoded()
+        encoding = (encoding or '').strip().lower()
+        size = Attachment.CHUNK_SIZE
+        if encoding == 'base64':
+            pending = ''
+            for start in xrange(0, len(payload), size):
+                data = pending + payload[start:start + size].translate(None,
+                                                                       BASE64_IGNORED)
+                cut = len(data) - len(data) % 4
+                pending = data[cut:]
+                if cut > 0:
+                    try:
+                        yield binascii.a2b_base64(data[:cut])
+                    except binascii.Error:
+                        # email keeps the payload encoded when it can't
+                        # decode it: the chunks already decoded can't be
+                        # taken back, so only keep this one encoded
+                        yield data[:cut]
+            if pending:
+                try:
+                    yield binascii.a2b_base64(pending + '=' * (-len(pending) % 4))
+                except binascii.Error:
+                    yield pending
+        elif encoding == 'quoted-printable':
+            start = 0
+            while start < len(payload):
+                # Only cut after a line end not to split an escaped char
+                end = payload.find('\n', start + size)
+                if end < 0:
+                    end = len(payload)
+                else:
+                    end += 1
+                yield binascii.a2b_qp(payload[start:end])
+                start = end
+        else:
+            if encoding in UU_ENCODINGS:
+                # Rarely used: let email decode it at once
+                part = email.message.Message()
+                part['Content-Transfer-Encoding'] = encoding
+                part.set_payload(payload)
+                payload = part.get_payload(decode=True)
+            for start in xrange(0, len(payload), size):
+                yield payload[start:start + size]
+
+    def get_payload(self):
+        '''
+        @result: the whole decoded payload
+        '''
+        return ''.join(self.iter_chunks())
+
+    def write_to(self, fileobj):
+        '''
+        Writes the decoded payload to a file-like object.
+        '''
+        for chunk in self.iter_chunks():
+            fileobj.write(chunk)
+
+class EventList(list):
+    '''
+    List of the events of a calendar counting its changes, so that the
+    index by UID knows when it is stale.
+    '''
+
+    def __init__(self, events=()):
+        list.__init__(self, events)
+        self.version = 0
+
+def counting_change(name):
+    method = getattr(list, name)
+    def change(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    change.__name__ = name
+    return change
+
+for name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+             '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+             'remove', 'reverse', 'sort'):
+    setattr(EventList, name, counting_change(name))
+del name
 
+class Calendar(object):
+    def __init__(self, mailstr=None, attach_write_func=None, registry=None):
+        '''
+        @mailstr: the mail holding the calendar, None for an empty calendar
+        @attach_write_func: function(name, attachment) storing an Attachment
+                            referenced by an event and returning its URI
+        '''
+        self._by_uid = None
         self.events = []
+        self.timezones = {}
+        self.registry = registry
+        if self.registry is None:
+            self.registry = TimezoneRegistry()
+        if mailstr is None:
+            # Empty calendar to be filled by the caller
+            return
+
         mail = email.message_from_string(mailstr)
         ical = None
         attachments = []
-        self.timezones = {}
 
         for part in mail.walk():
             if part.get_content_type().startswith('text/calendar'):
@@ -64,46 +312,95 @@ class Calendar(object):
             else:
                 disposition = part.get('Content-Disposition')
                 if disposition and disposition.startswith('attachment'):
-                    attachment = {}
-                    filename = part.get_filename()
-                    if filename:
-                        attachment['filename'] = filename
-                    attachment['content-type'] = part.get_content_type()
-                    attachment['payload'] = part.get_payload(decode=True)
-                    attachments.append(attachment)
+                    attachments.append(Attachment(part))
         if ical is None:
             print >> sys.stderr, "Didn't find any ical data in following email %s\n" % (mailstr)
         else:
             self.parse(ical, attachments, attach_write_func)
 
+    def get_events(self):
+        return self._events
+    def set_events(self, events):
+        self._events = EventList(events)
+        self.reset_index()
+    events = property(get_events, set_events)
+
     def parse(self, ical, attachments, attach_write_func=None):
+        for event in self.iter_parse(ical, attachments, attach_write_func):
+            self.events.append(event)
+
+    def read_file(self, source, attach_write_func=None):
+        '''
+        Parses a plain iCalendar file, not wrapped in an email.
+
+        @source: path or file-like object to read
+        '''
+        for event in self.iter_file(source, attach_write_func):
+            self.events.append(event)
+
+    def iter_file(self, source, attach_write_func=None):
+        '''
+        Generator parsing a plain iCalendar file incrementally and yielding
+        the events as soon as they are read. Unlike the timezones, the events
+        are not added to the calendar: the memory used doesn't depend on the
+        size of the file.
+
+        @source: path or file-like object to read, mmap objects work too.
+                 Paths are memory-mapped.
+        '''
+        if not isinstance(source, basestring):
+            for event in self.iter_parse(iter(source.readline, ''), [],
+                                         attach_write_func):
+                yield event
+            return
+
+        fdescr = open(source, 'rb')
+        try:
+            try:
+                content = mmap.mmap(fdescr.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # Empty files or files that can't be mapped
+                content = fdescr
+            for event in self.iter_parse(iter(content.readline, ''), [],
+                                         attach_write_func):
+                yield event
+            if content is not fdescr:
+                content.close()
+        finally:
+            fdescr.close()
+
+    def iter_parse(self, ical, attachments, attach_write_func=None):
+        '''
+        Generator parsing the iCalendar content and yielding the events.
+        The timezones are added to the calendar.
+
+        @ical: content as a string or an iterable of lines
+        '''
         content = LineUnwrapper(ical)
         vtimezone = None
         vevent = None
         tzmap = {}
-        timezone = []
 
         for (real_lines, line) in content.each_line():
-            if vtimezone is not None:
-                timezone.append(line)
-                if line == 'END:VTIMEZONE':
-                    tzmap[vtimezone.tzid] = vtimezone
-                    self.timezones[vtimezone.tzid] = timezone
-                    vtimezone = None
-                else:
-                    vtimezone.parseline(line)
-            elif vevent is None and line == 'BEGIN:VTIMEZONE':
-                vtimezone = Timezone()
-                timezone.append(line)
-            elif vevent is not None:
+            if vevent is not None:
                 if line == 'END:VEVENT':
-                    self.events.append(vevent)
+                    vevent.tzmap = None
+                    yield vevent
                     vevent = None
                 else:
-                    vevent.parseline(real_lines, line, attachments,
-                                     attach_write_func)
-            elif vtimezone is None and line == 'BEGIN:VEVENT':
+                    parseline(real_lines, line, attachments, attach_write_func)
+            elif vtimezone is not None:
+                vtimezone.append(line)
+                if line == 'END:VTIMEZONE':
+                    (lines, timezone) = self.registry.intern(vtimezone)
+                    tzmap[timezone.tzid] = timezone
+                    self.timezones[timezone.tzid] = lines
+                    vtimezone = None
+            elif line == 'BEGIN:VTIMEZONE':
+                vtimezone = [line]
+            elif line == 'BEGIN:VEVENT':
                 vevent = Event(tzmap)
+                parseline = vevent.parseline
 
     def diff(self, calendar):
         '''
@@ -126,7 +423,7 @@ class Calendar(object):
         dest_events = calendar.get_events_by_uid()
         for uid in orig_events:
             if uid in dest_events:
-                if orig_events[uid] == dest_events[uid]:
+                if orig_events[uid].fingerprint == dest_events[uid].fingerprint:
                     unchanged[uid] = orig_events[uid]
                 else:
                     changed[uid] = {'old': orig_events[uid], 'new': dest_events[uid]}
@@ -142,80 +439,413 @@ class Calendar(object):
         return (changed, removed, added, unchanged)
 
     def get_events_by_uid(self):
-        by_uid = {}
-        for event in self.events:
-            uid = event.uid
-            if event.gwrecordid is not None:
-                uid = event.gwrecordid
-            by_uid[uid] = event
-        return by_uid
+        '''
+        @result: the events indexed by their GroupWise record ID or UID. The
+                 index is cached: it is rebuilt if the events list has been
+                 changed since or if the UID or record ID of any event has
+                 been set.
+        '''
+        version = (self._events.version, Event.key_changes)
+        if self._by_uid is None or self._by_uid[0] != version:
+            by_uid = {}
+            for event in self._events:
+                uid = event.uid
+                if event.gwrecordid is not None:
+                    uid = event.gwrecordid
+                by_uid[uid] = event
+            self._by_uid = (version, by_uid)
+        return self._by_uid[1]
+
+    def reset_index(self):
+        self._by_uid = None
+
+    def restrict(self, start=None, end=None):
+        '''
+        Only keeps the events with an occurrence overlapping [start, end).
 
-    def to_ical(self):
-        out = ''
+        @start: naive UTC datetime or None for no lower bound
+        @end: naive UTC datetime or None for no upper bound
+        '''
+        index = OccurrenceIndex(self)
+        self.events = index.search(start or datetime.datetime.min,
+                                   end or datetime.datetime.max)
 
-        out  = 'BEGIN:VCALENDAR\r\n'
-        out += 'PRODID:-//SUSE Hackweek//NONSGML groupwise-to-ics//EN\r\n'
-        out += 'VERSION:2.0\r\n'
+    def iter_ical(self):
+        '''
+        Generator producing the iCalendar document chunk by chunk.
+        '''
+        yield 'BEGIN:VCALENDAR\r\n'
+        yield 'PRODID:-//SUSE Hackweek//NONSGML groupwise-to-ics//EN\r\n'
+        yield 'VERSION:2.0\r\n'
 
+        # Only output the timezones used by the events
+        tzids = set()
+        for event in self.events:
+            tzids.update(event.get_tzids())
         for timezone in self.timezones:
-            out += '\r\n'.join(self.timezones[timezone])
+            if timezone not in tzids:
+                continue
+            yield '\r\n'.join(self.timezones[timezone])
+            yield '\r\n'
 
         for event in self.events:
-            out += event.to_ical()
+            for chunk in event.iter_ical():
+                yield chunk
+
+        yield 'END:VCALENDAR\r\n'
 
-        out += 'END:VCALENDAR\r\n'
-        return out
+    def write_ical(self, fileobj):
+        for chunk in self.iter_ical():
+            fileobj.write(chunk)
+
+    def to_ical(self):
+        return ''.join(self.iter_ical())
+
+RECURRENCE_LINE_RE = re.compile(r'(RRULE|RDATE|EXDATE|DURATION)[;:]', re.IGNORECASE)
+UNTIL_RE = re.compile(r'UNTIL=(\d{8}(?:T\d{6})?)Z?', re.IGNORECASE)
+DURATION_RE = re.compile(r'^([-+])?P(?:(\d+)W)?(?:(\d+)D)?'
+                         r'(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+def parse_duration(value):
+    '''
+    @result: the timedelta of an iCalendar DURATION value or None
+    '''
+    match = DURATION_RE.match(value)
+    if match is None:
+        return None
+    (sign, weeks, days, hours, minutes, seconds) = match.groups()
+    delta = datetime.timedelta(weeks=int(weeks or 0), days=int(days or 0),
+                               hours=int(hours or 0), minutes=int(minutes or 0),
+                               seconds=int(seconds or 0))
+    if sign == '-':
+        return -delta
+    return delta
+
+class OccurrenceIndex(object):
+    '''
+    Index of the occurrences of the events of a calendar: the recurring
+    events are expanded from their RRULE and RDATE, minus their EXDATE.
+    The occurrences are kept in an interval tree, so that searching the
+    events overlapping a period only visits a logarithmic number of the
+    occurrences not overlapping it, whatever their duration.
+
+    Rules without end are expanded up to HORIZON_YEARS after the current
+    date, or after the latest date searched if later. The events whose
+    rules still go on at the horizon overlap any period ending after it.
+    '''
+    HORIZON_YEARS = 5
+
+    def __init__(self, calendar):
+        self.events = calendar.events
+        self.tzinfos = {}
+        for (tzid, lines) in calendar.timezones.items():
+            self.tzinfos[tzid] = calendar.registry.intern(lines)[1]
+        self.build(datetime.datetime.now())
+
+    def build(self, date):
+        year = max(date.year, datetime.datetime.now().year) + OccurrenceIndex.HORIZON_YEARS
+        self.horizon = datetime.datetime(min(year, datetime.MAXYEAR), 1, 1)
+
+        occurrences = []
+        # Position of the events without known dates: always selected
+        self.unknown = []
+        # Position of the events with occurrences after the horizon
+        self.endless = []
+        for (pos, event) in enumerate(self.events):
+            try:
+                (starts, duration, endless) = self.expand(event)
+            except (ValueError, TypeError, KeyError, OverflowError):
+                starts = None
+            if starts is None:
+                self.unknown.append(pos)
+                continue
+            if endless:
+                self.endless.append(pos)
+            for start in starts:
+                occurrences.append((start, start + duration, pos))
+        occurrences.sort()
+        self.occurrences = occurrences
+        # Implicit interval tree: the node of the [low, high) range of the
+        # sorted occurrences is its middle one, holding the range latest end
+        self.max_ends = [None] * len(occurrences)
+        self.fill_max_ends(0, len(occurrences))
+
+    def fill_max_ends(self, low, high):
+        '''
+        @result: the latest end of the occurrences in [low, high)
+        '''
+        if low >= high:
+            return datetime.datetime.min
+        middle = (low + high) // 2
+        latest = max(self.occurrences[middle][1],
+                     self.fill_max_ends(low, middle),
+                     self.fill_max_ends(middle + 1, high))
+        self.max_ends[middle] = latest
+        return latest
+
+    def parse_date(self, value, params):
+        '''
+        @result: (local naive datetime, timezone or None, whether it is a date)
+        '''
+        value = value.split('/')[0]
+        # Way faster than strptime
+        if len(value) < 15 or value[8] != 'T':
+            return (datetime.datetime(int(value[0:4]), int(value[4:6]),
+                                      int(value[6:8])), None, True)
+        date = datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                                 int(value[9:11]), int(value[11:13]),
+                                 int(value[13:15]))
+        tzid = params.get('TZID')
+        if value.endswith('Z') or tzid is None:
+            return (date, None, False)
+        timezone = self.tzinfos.get(tzid.lower().translate(None, '"\''))
+        return (date, timezone, False)
+
+    def to_utc(self, date, timezone):
+        if timezone is None:
+            return date
+        offset = timezone.utcoffset(date)
+        if offset is None:
+            return date
+        return date - offset
+
+    def get_lines(self, event):
+        '''
+        @result: (name, params, value) of the unfolded recurrence and
+                 duration lines of the event
+        '''
+        lines = []
+        for line in event.lines:
+            if isinstance(line, int):
+                # Property slot, never a recurrence line
+                lines.append(None)
+            elif line.startswith(' ') and len(lines) > 0:
+                if lines[-1] is not None:
+                    lines[-1] += line[1:]
+            elif line[:1] in 'RDE' and RECURRENCE_LINE_RE.match(line):
+                lines.append(line)
+            else:
+                lines.append(None)
+        return [split_contentline(line) for line in lines if line is not None]
 
+    def expand(self, event):
+        '''
+        @result: (sorted UTC starts of the occurrences, duration, whether
+                 the occurrences go on after the horizon) or
+                 (None, None, False) if the event has no start date
+        '''
+        if event.dtstart is None:
+            return (None, None, False)
+        dtstart = ParametrizedValue(event.dtstart)
+        (start, timezone, is_date) = self.parse_date(dtstart.value, dtstart.params)
+
+        duration = None
+        if event.dtend is not None:
+            dtend = ParametrizedValue(event.dtend)
+            (end, end_timezone, end_is_date) = self.parse_date(dtend.value,
+                                                               dtend.params)
+            duration = self.to_utc(end, end_timezone) - self.to_utc(start, timezone)
+        rules = []
+        rdates = []
+        exdates = set()
+        for (name, params, value) in self.get_lines(event):
+            if value is None:
+                continue
+            params = dict([(param_key(key), val) for (key, val) in params])
+            if name == 'DURATION' and duration is None:
+                duration = parse_duration(value)
+            elif name == 'RRULE':
+                rules.append(value)
+            elif name in ('RDATE', 'EXDATE'):
+                for date in value.split(','):
+                    (date, date_timezone, date_is_date) = self.parse_date(date, params)
+                    if date_is_date and not is_date:
+                        date = date.replace(hour=start.hour, minute=start.minute,
+                                            second=start.second)
+                        date_timezone = timezone
+                    date = self.to_utc(date, date_timezone)
+                    if name == 'RDATE':
+                        rdates.append(date)
+                    else:
+                        exdates.add(date)
+        if duration is None:
+            duration = datetime.timedelta(days=1 if is_date else 0)
+        duration = max(duration, datetime.timedelta(0))
+
+        starts = set([self.to_utc(start, timezone)])
+        endless = False
+        for rule in rules:
+            # The rule applies to the local time, but its UNTIL is in UTC
+            until = UNTIL_RE.search(rule)
+            if until is not None:
+                value = until.group(1)
+                if 'T' in value:
+                    date = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+                    if timezone is not None and timezone.utcoffset(date) is not None:
+                        date += timezone.utcoffset(date)
+                    value = date.strftime('%Y%m%dT%H%M%S')
+                rule = UNTIL_RE.sub('UNTIL=%s' % value, rule)
+            for date in rrule.rrulestr(rule, dtstart=start):
+                if date >= self.horizon:
+                    endless = True
+                    break
+                starts.add(self.to_utc(date, timezone))
+        starts.update(rdates)
+        starts.difference_update(exdates)
+        return (sorted(starts), duration, endless)
+
+    def search(self, start, end):
+        '''
+        @result: the events with an occurrence overlapping [start, end),
+                 in the calendar order
+        '''
+        # Without end, the occurrences after the start are needed
+        latest = start if end == datetime.datetime.max else end
+        if latest > self.horizon:
+            self.build(latest)
+        selected = set(self.unknown)
+        if end > self.horizon:
+            selected.update(self.endless)
+
+        ranges = [(0, len(self.occurrences))]
+        while len(ranges) > 0:
+            (low, high) = ranges.pop()
+            if low >= high:
+                continue
+            middle = (low + high) // 2
+            if self.max_ends[middle] < start:
+                # All the range occurrences end before the period
+                continue
+            ranges.append((low, middle))
+            (occ_start, occ_end, pos) = self.occurrences[middle]
+            if occ_start < end:
+                if occ_end > start or occ_start >= start:
+                    selected.add(pos)
+                # The next occurrences start later
+                ranges.append((middle + 1, high))
+        return [self.events[pos] for pos in sorted(selected)]
 
 class Timezone(datetime.tzinfo):
+    # Number of years of recurring transitions computed ahead of the
+    # latest date looked up
+    HORIZON_YEARS = 10
+
     def __init__(self):
         self.tzid = None
         self.component = None
         self.changes = []
 
+    def get_changes(self):
+        return self._changes
+    def set_changes(self, value):
+        self._changes = value
+        self.reset_transitions()
+    changes = property(get_changes, set_changes)
+
+    def reset_transitions(self):
+        # Sorted transition dates and the TZDetails applying from each of them
+        self._transitions = []
+        self._details = []
+        self._horizon = None
+
+    def __getstate__(self):
+        # The transitions table is a cache, no need to store it
+        state = self.__dict__.copy()
+        state['_transitions'] = []
+        state['_details'] = []
+        state['_horizon'] = None
+        return state
+
     def parseline(self, line):
-        if line.startswith('TZID:'):
-            self.tzid = line[len('TZID:'):].lower().translate(None, '"\'')
-        elif self.component is None and line.startswith('BEGIN:'):
-            value = line[len('BEGIN:'):]
+        (name, params, value) = split_contentline(line)
+        if name == 'TZID' and value is not None:
+            self.tzid = value.lower().translate(None, '"\'')
+        elif self.component is None and name == 'BEGIN' and value is not None:
             self.component = TZDetails(value)
         elif self.component is not None:
-            if line.startswith('END:'):
+            if name == 'END':
                 self.changes.append(self.component)
                 sorted(self.changes, key = lambda change: change.start)
                 self.component = None
+                self.reset_transitions()
             else:
-                self.component.parseline(line)
+                self.component.parsetokens(name, params, value)
 
-    def utcoffset(self, dt):
-        offset = None
-        # Build a list of sorted changes
-        all_changes = {}
-        now = datetime.datetime.now()
+    def compile_transitions(self, dt):
+        '''
+        Builds the sorted transitions table, expanding the recurring
+        changes up to HORIZON_YEARS after dt, or the current date if later.
+        '''
+        year = max(dt.year, datetime.datetime.now().year) + Timezone.HORIZON_YEARS
+        horizon = datetime.datetime(min(year, datetime.MAXYEAR), 1, 1)
+
+        transitions = []
         for change in self.changes:
             if change.start:
-                all_changes[change.start] = change
-            else:
-                it = iter(change.rrule)
-                try:
-                    date = it.next()
-                    # Who plans meetings in 10 years from now?
-                    while date.year < now.year + 10:
-                        date = it.next()
-                        all_changes[date] = change
-                except StopIteration:
-                    pass
-
-        # Find the matching change
-        for date in sorted(all_changes.keys()):
-            if dt >= date:
-                offset = all_changes[date].offsetto
-            else:
-                if offset is None:
-                    return all_changes[date].offsetfrom
-                else:
-                    return offset
-        return offset
+                transitions.append((change.start, change))
+            elif change.rrule is not None and not isinstance(change.rrule, basestring):
+                for date in change.rrule:
+                    if date >= horizon:
+                        break
+                    transitions.append((date, change))
+        transitions.sort(key = lambda transition: transition[0])
+
+        self._transitions = [transition[0] for transition in transitions]
+        self._details = [transition[1] for transition in transitions]
+        self._horizon = horizon
+
+    def find_change(self, dt):
+        '''
+        Looks up the change applying to dt.
+
+        @result: (change, before) where before is True if dt is before the
+                 first known transition, meaning that the state before
+                 that change applies. change is None if there is no change.
+        '''
+        dt = dt.replace(tzinfo=None)
+        if self._horizon is None or dt >= self._horizon:
+            self.compile_transitions(dt)
+
+        if len(self._transitions) == 0:
+            return (None, False)
+
+        pos = bisect.bisect_right(self._transitions, dt)
+        if pos == 0:
+            return (self._details[0], True)
+        return (self._details[pos - 1], False)
+
+    def utcoffset(self, dt):
+        if dt is None:
+            return None
+        (change, before) = self.find_change(dt)
+        if change is None:
+            return None
+        if before:
+            return change.offsetfrom
+        return change.offsetto
+
+    def dst(self, dt):
+        if dt is None:
+            return None
+        (change, before) = self.find_change(dt)
+        if change is None:
+            return None
+        delta = change.offsetto - change.offsetfrom
+        if before:
+            # The state before a STANDARD change is daylight saving time
+            if change.kind == 'STANDARD':
+                return -delta
+        elif change.kind == 'DAYLIGHT':
+            return delta
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        if dt is None:
+            return None
+        (change, before) = self.find_change(dt)
+        if change is None or before:
+            return None
+        return change.name
 
 
 class TZDetails(object):
@@ -228,22 +858,25 @@ class TZDetails(object):
         self.rrule = None
 
     def parseline(self, line):
-        if line.startswith('TZNAME:'):
-            self.name = line[len('TZNAME:'):]
-        if line.startswith('DTSTART:'):
-            value = line[len('DTSTART:'):]
+        (name, params, value) = split_contentline(line)
+        self.parsetokens(name, params, value)
+
+    def parsetokens(self, name, params, value):
+        if value is None:
+            return
+        if name == 'TZNAME':
+            self.name = value
+        elif name == 'DTSTART':
             self.start = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
             if self.rrule:
                 self.rrule = rrule.rrulestr(self.rrule, dtstart=self.start)
                 self.start = None
-        if line.startswith('TZOFFSETFROM:'):
-            value = line[len('TZOFFSETFROM:'):]
+        elif name == 'TZOFFSETFROM':
             self.offsetfrom = self.parseoffset(value)
-        if line.startswith('TZOFFSETTO:'):
-            value = line[len('TZOFFSETTO:'):]
+        elif name == 'TZOFFSETTO':
             self.offsetto = self.parseoffset(value)
-        if line.startswith('RRULE:'):
-            self.rrule = line[len('RRULE:'):]
+        elif name == 'RRULE':
+            self.rrule = value
             if self.start:
                 self.rrule = rrule.rrulestr(self.rrule, dtstart=self.start)
                 self.start = None
@@ -267,46 +900,113 @@ class TZDetails(object):
                self.offsetto == other.offsetto and \
                self.start == other.start
 
-class ParametrizedValue(object):
-    def __init__(self, ical):
-        pos = ical.find(':')
-
-        self.value = None
+# Cache of the normalized parameter names
+PARAM_KEYS = {}
+
+def param_key(key):
+    '''
+    Normalizes a parameter name: upper case all keys to avoid potential
+    problems. The keys are interned as the same few ones are found in all
+    the events.
+    '''
+    normalized = PARAM_KEYS.get(key)
+    if normalized is None:
+        normalized = key.upper()
+        if isinstance(normalized, str):
+            normalized = intern(normalized)
+        if len(PARAM_KEYS) < 1000:
+            PARAM_KEYS[key] = normalized
+    return normalized
+
+# Cache of the parsed parameters as (name, value) tuples: the same
+# attendees are found in many events. The dictionaries are built again in
+# the same order so that the parameters are written like before.
+PARAMS = {}
+
+def parse_params(header):
+    '''
+    Parses the parameters part of a content line, up to its first ':'.
+
+    @result: dictionary of the normalized parameter names and their value,
+             the parameters without value being dropped. None if the
+             header needs split_contentline() as a quoted value contains
+             ';' or ':'.
+    '''
+    params = PARAMS.get(header)
+    if params is None:
+        if not is_simple_header(header):
+            return None
+        params = []
+        for param in header.split(';'):
+            (key, equal, value) = param.partition('=')
+            if equal:
+                # Inlined cache lookup of param_key()
+                name = PARAM_KEYS.get(key)
+                if name is None:
+                    name = param_key(key)
+                params.append((name, value))
+        params = tuple(params)
+        if len(PARAMS) < 10000:
+            PARAMS[header] = params
+    return dict(params)
 
-        # Split the value from the parameters
-        if pos >= 0:
-            self.value = ical[pos + 1:]
-            params = ical[:pos].split(';')
-        else:
-            params = ical.split(';')
+class ParametrizedValue(object):
+    __slots__ = ('value', '_params')
 
-        # Process the parameters
-        new_params = {}
-        for param in params:
-            pos = param.find('=')
-            if pos >= 0:
-                key = param[:pos]
-                new_params[key] = param[pos + 1:]
-        self.params = new_params
+    def __init__(self, ical, params=None):
+        '''
+        @ical: the parameters and value part of a content line, like
+               ';CN=Joe:MAILTO:joe@hacker.com'. If params is given, ical
+               is the already split value and params either the list of
+               (key, value) tuples from split_contentline() or the
+               dictionary from parse_params(), then kept as is.
+        '''
+        self.value = ical
+        if isinstance(params, dict):
+            self._params = params
+            return
+        if params is None:
+            (name, params, self.value) = split_contentline(ical)
+
+        self._params = normalized = {}
+        for (key, value) in params:
+            if value is not None:
+                # Inlined cache lookup of param_key()
+                name = PARAM_KEYS.get(key)
+                if name is None:
+                    name = param_key(key)
+                normalized[name] = value
 
     def set_params(self, value):
         self._params = {}
-        # Upper case all keys to avoid potential problems
         for param in value:
-            self._params[param.upper()] = value[param]
+            self._params[param_key(param)] = value[param]
     def get_params(self):
         return self._params;
     params = property(get_params, set_params)
 
     def __eq__(self, other):
+        if not isinstance(other, ParametrizedValue):
+            return False
         params_equals = set(self.params.items()) ^ set(other.params.items())
         return self.value == other.value and len(params_equals) == 0
 
+    def __ne__(self, other):
+        return not self == other
+
     def __repr__(self):
         return self.to_ical()
 
     def __hash__(self):
-        return hash(repr(self))
+        return hash((self.value, frozenset(self.params.items())))
+
+    def canonical(self):
+        '''
+        @result: a string representation of the value independent of the
+                 parameters order
+        '''
+        params = sorted(map('='.join, self._params.iteritems()))
+        return '%s\x01%s' % (self.value, '\x01'.join(params))
 
     def to_ical(self):
         result = ''
@@ -316,43 +1016,121 @@ class ParametrizedValue(object):
         return result
 
 class Event(object):
-    def __init__(self, tzmap):
+    # Properties with an accessor and their line pattern, each of them
+    # has a fixed slot in the values and linenos lists
+    PROPERTIES = (('uid', 'UID:%s'),
+                  ('gwrecordid', 'X-GWRECORDID:%s'),
+                  ('dtstamp', 'DTSTAMP:%s'),
+                  ('dtstart', 'DTSTART%s'),
+                  ('dtend', 'DTEND%s'),
+                  ('summary', 'SUMMARY:%s'),
+                  ('location', 'LOCATION:%s'),
+                  ('description', 'DESCRIPTION:%s'),
+                  ('status', 'STATUS:%s'),
+                  ('organizer', 'ORGANIZER%s'))
+    SLOTS = dict([(prop[0], i) for (i, prop) in enumerate(PROPERTIES)])
+    KEY_SLOTS = (SLOTS['uid'], SLOTS['gwrecordid'])
+    # Number of times the UID or record ID of any event has been set: the
+    # calendars indexes by UID are stale once it changes
+    key_changes = 0
+    key_lock = threading.Lock()
+
+    __slots__ = ('lines', 'values', 'linenos', 'tzmap',
+                 '_attendees', 'attachments', '_fingerprint')
+
+    def __init__(self, tzmap=None):
+        # Lines of the event as read. The properties' lines are stored as
+        # their slot number and generated from the value when needed.
         self.lines = []
-        self.properties = {}
+        self.values = [None] * len(Event.PROPERTIES)
+        self.linenos = [None] * len(Event.PROPERTIES)
+        # Only needed while parsing, reset once the event is complete
         self.tzmap = tzmap
-        self.attendees = []
+        self._attendees = []
         self.attachments = []
+        self._fingerprint = None
+
+    def get_properties(self):
+        '''
+        @result: dictionary of the set properties, the values being
+                 (value, lineno) tuples
+        '''
+        properties = {}
+        for (i, prop) in enumerate(Event.PROPERTIES):
+            if self.linenos[i] is not None:
+                properties[prop[0]] = (self.values[i], self.linenos[i])
+        return properties
+    properties = property(get_properties)
 
     def get_property(self, key):
-        value = None
-        if key in self.properties:
-            value = self.properties[key][0]
-        return value
-    def set_property(self,value, key, pattern):
-        if key in self.properties:
-            lineno = self.properties[key][1]
-            del self.lines[lineno]
-            del self.properties[key]
-        lineno = len(self.lines)
-        self.lines.append(pattern % value)
-        self.properties[key] = (value, lineno)
+        return self.values[Event.SLOTS[key]]
+    def set_property(self, value, key):
+        self.set_slot(Event.SLOTS[key], value)
+
+    def set_slot(self, slot, value):
+        if self.linenos[slot] is None:
+            self.linenos[slot] = len(self.lines)
+            self.lines.append(slot)
+        self.values[slot] = value
+        self._fingerprint = None
+        if slot in Event.KEY_SLOTS:
+            with Event.key_lock:
+                Event.key_changes += 1
+
+    def get_attendees(self):
+        return self._attendees
+    def set_attendees(self, value):
+        self._attendees = value
+        self._fingerprint = None
+    attendees = property(get_attendees, set_attendees)
+
+    def get_fingerprint(self):
+        '''
+        Digest of the properties and attendees, independent of their order.
+        It is computed once: changing the properties or setting the
+        attendees resets it, but not modifying the values in place.
+        '''
+        if self._fingerprint is None:
+            values = []
+            for value in self.values:
+                if value is None:
+                    value = '\x00'
+                elif isinstance(value, ParametrizedValue):
+                    value = value.canonical()
+                values.append(value)
+            attendees = sorted(set([attendee.canonical() for attendee in self._attendees]))
+            content = '%s\x03%s' % ('\x02'.join(values), '\x02'.join(attendees))
+            self._fingerprint = hashlib.sha1(content).digest()
+        return self._fingerprint
+    fingerprint = property(get_fingerprint)
+
+    def iter_lines(self):
+        '''
+        Generator producing the lines of the event as they will be written,
+        without the attendees and attachments.
+        '''
+        for line in self.lines:
+            if isinstance(line, int):
+                yield Event.PROPERTIES[line][1] % self.values[line]
+            else:
+                yield line
 
     def get_uid(self):
         return self.get_property('uid')
     def set_uid(self, uid):
-        self.set_property(uid, 'uid', 'UID:%s')
+        self.set_property(uid, 'uid')
     uid = property(get_uid, set_uid)
 
     def get_gwrecordid(self):
         return self.get_property('gwrecordid')
     def set_gwrecordid(self, value):
-        self.set_property(value, 'gwrecordid', 'X-GWRECORDID:%s')
+        self.set_property(value, 'gwrecordid')
     gwrecordid = property(get_gwrecordid, set_gwrecordid)
 
     def get_dtstamp(self):
         return self.get_property('dtstamp')
     def set_dtstamp(self, value):
-        self.set_property(value, 'dtstamp', 'DTSTAMP:%s')
+        self.set_property(value, 'dtstamp')
     dtstamp = property(get_dtstamp, set_dtstamp)
 
     def get_dtstart(self):
@@ -361,7 +1139,7 @@ class Event(object):
         """
         return self.get_property('dtstart')
     def set_dtstart(self, value):
-        self.set_property(value, 'dtstart', 'DTSTART%s')
+        self.set_property(value, 'dtstart')
     dtstart = property(get_dtstart, set_dtstart)
 
     def get_dtend(self):
@@ -370,87 +1148,150 @@ class Event(object):
         """
         return self.get_property('dtend')
     def set_dtend(self, value):
-        self.set_property(value, 'dtend', 'DTEND%s')
+        self.set_property(value, 'dtend')
     dtend = property(get_dtend, set_dtend)
 
     def get_summary(self):
         return self.get_property('summary')
     def set_summary(self, value):
-        self.set_property(value, 'summary', 'SUMMARY:%s')
+        self.set_property(value, 'summary')
     summary = property(get_summary, set_summary)
 
     def get_location(self):
         return self.get_property('location')
     def set_location(self, value):
-        self.set_property(value, 'location', 'LOCATION:%s')
+        self.set_property(value, 'location')
     location = property(get_location, set_location)
 
     def get_description(self):
         return self.get_property('description')
     def set_description(self, value):
-        self.set_property(value, 'description', 'DESCRIPTION:%s')
+        self.set_property(value, 'description')
     description = property(get_description, set_description)
 
     def get_status(self):
         return self.get_property('status')
     def set_status(self, value):
-        self.set_property(value, 'status', 'STATUS:%s')
+        self.set_property(value, 'status')
     status = property(get_status, set_status)
 
     def get_organizer(self):
         return self.get_property('organizer')
     def set_organizer(self, value):
-        self.set_property(value, 'organizer', 'ORGANIZER%s')
+        self.set_property(value, 'organizer')
     organizer = property(get_organizer, set_organizer)
 
     def parseline(self, real_lines, line, attachments, attach_write_func=None):
-        if line.startswith('DTSTART'):
-            value = line[len('DTSTART'):]
-            self.dtstart = self.datetime_to_utc(value)
-        elif line.startswith('DTEND'):
-            value = line[len('DTEND'):]
-            self.dtend = self.datetime_to_utc(value)
-        elif line.startswith('UID:'):
-            self.uid = line[len('UID:'):]
-        elif line.startswith('X-GWRECORDID:'):
-            self.gwrecordid = line[len('X-GWRECORDID:'):]
-        elif line.startswith('DTSTAMP:'):
-            utc = self.datetime_to_utc(line[len('DTSTAMP'):])
-            if utc.startswith(':'):
-                utc = utc[1:]
-            self.dtstamp = utc
-        elif line.startswith('SUMMARY:'):
-            self.summary = line[len('SUMMARY:'):]
-        elif line.startswith('LOCATION:'):
-            self.location = line[len('LOCATION:'):]
-        elif line.startswith('DESCRIPTION:'):
-            self.description = line[len('DESCRIPTION:'):]
-        elif line.startswith('STATUS:'):
-            self.status = line[len('STATUS:'):]
-        elif line.startswith('ORGANIZER'):
-            self.organizer = ParametrizedValue(line[len('ORGANIZER'):])
-        elif line.startswith('ATTENDEE'):
-            self.attendees.append(ParametrizedValue(line[len('ATTENDEE'):]))
-        elif line.startswith('ATTACH'):
-            attach = ParametrizedValue(line[len('ATTACH'):])
-            if attach.value.lower() == 'cid:...':
-                for attachment in attachments:
-                    attach = ParametrizedValue('')
-                    filename = 'unnamed'
-                    if attachment['filename']:
-                        filename = attachment['filename']
-                    if self.gwrecordid:
-                        filename = os.path.join(self.gwrecordid, filename)
-                    payload = attachment['payload']
-                    attach.value = attach_write_func(filename, payload)
-                    self.attachments.append(attach)
+        # Look the property up before splitting the line: most of the
+        # unhandled lines don't need to be
+        end = line.find(':')
+        if end < 0:
+            end = len(line)
+        name = line[:end]
+        semicolon = name.find(';')
+        if semicolon >= 0:
+            name = name[:semicolon]
+        handler = Event.HANDLERS.get(name)
+        if handler is None and not name.isupper():
+            handler = Event.HANDLERS.get(name.upper())
+        if handler is None or (semicolon >= 0 and not handler[1]):
+            self.lines.extend(real_lines)
+            return
+        if semicolon < 0:
+            params = ()
+            value = line[end + 1:] if end < len(line) else None
         else:
+            params = None
+            if end < len(line):
+                params = parse_params(line[semicolon + 1:end])
+                value = line[end + 1:]
+            if params is None:
+                (name, params, value) = split_contentline(line)
+        if value is None:
             # Don't add lines if we got a property: the line is
             # auto-added in the property setter
             self.lines.extend(real_lines)
+        else:
+            handler[0](self, params, value, attachments, attach_write_func)
+
+    def parse_datetime(self, params, value):
+        if len(params) == 0 and value.endswith('Z'):
+            # Already in UTC
+            return ':' + value
+        return self.datetime_to_utc(ParametrizedValue(value, params))
+
+    def parse_dtstart(self, params, value, attachments, attach_write_func):
+        self.set_slot(Event.SLOTS['dtstart'], self.parse_datetime(params, value))
+
+    def parse_dtend(self, params, value, attachments, attach_write_func):
+        self.set_slot(Event.SLOTS['dtend'], self.parse_datetime(params, value))
+
+    def parse_dtstamp(self, params, value, attachments, attach_write_func):
+        utc = self.parse_datetime(params, value)
+        if utc.startswith(':'):
+            utc = utc[1:]
+        self.set_slot(Event.SLOTS['dtstamp'], utc)
+
+    def parse_organizer(self, params, value, attachments, attach_write_func):
+        self.organizer = ParametrizedValue(value, params)
+
+    def parse_attendee(self, params, value, attachments, attach_write_func):
+        self._attendees.append(ParametrizedValue(value, params))
+        self._fingerprint = None
+
+    def parse_attach(self, params, value, attachments, attach_write_func):
+        attach = ParametrizedValue(value, params)
+        if attach.value.lower() == 'cid:...':
+            for attachment in attachments:
+                attach = ParametrizedValue('')
+                filename = 'unnamed'
+                if attachment.filename:
+                    filename = attachment.filename
+                if self.gwrecordid:
+                    filename = os.path.join(self.gwrecordid, filename)
+                attach.value = attach_write_func(filename, attachment)
+                self.attachments.append(attach)
+        else:
+            # Already resolved attachment, like in a written ICS file
+            self.attachments.append(attach)
+
+    def simple_property_parser(slot):
+        def parse(self, params, value, attachments, attach_write_func):
+            self.set_slot(slot, value)
+        return parse
+
+    # Property name -> (parser, whether the property can have parameters).
+    # Lines of properties not in the table or with unexpected parameters
+    # are kept as is.
+    HANDLERS = {'DTSTART': (parse_dtstart, True),
+                'DTEND': (parse_dtend, True),
+                'UID': (simple_property_parser(SLOTS['uid']), False),
+                'X-GWRECORDID': (simple_property_parser(SLOTS['gwrecordid']), False),
+                'DTSTAMP': (parse_dtstamp, False),
+                'SUMMARY': (simple_property_parser(SLOTS['summary']), False),
+                'LOCATION': (simple_property_parser(SLOTS['location']), False),
+                'DESCRIPTION': (simple_property_parser(SLOTS['description']), False),
+                'STATUS': (simple_property_parser(SLOTS['status']), False),
+                'ORGANIZER': (parse_organizer, True),
+                'ATTENDEE': (parse_attendee, True),
+                'ATTACH': (parse_attach, True)}
+    del simple_property_parser
+
+    def get_tzids(self):
+        '''
+        @result: the set of the TZIDs referenced by the event, normalized
+                 the same way as Timezone.tzid
+        '''
+        tzids = set()
+        for line in self.iter_lines():
+            for tzid in TZID_PARAM_RE.findall(line):
+                tzids.add(tzid.lower().translate(None, '"\''))
+        return tzids
 
     def datetime_to_utc(self, local):
-        value = ParametrizedValue(local)
+        value = local
+        if not isinstance(value, ParametrizedValue):
+            value = ParametrizedValue(local)
         return value.to_ical() # FIXME disable code below, it doesn't handle all case
 
         if 'TZID' in value.params:
@@ -479,15 +1320,20 @@ class Event(object):
         if self.get_dtstart().find('T')>=0 :
             exdate = False
             for i in range(len(self.lines)):
+                if isinstance(self.lines[i], int):
+                    exdate = False
                 # ensure excluding event are fullday too
-                if self.lines[i].startswith('EXDATE;TZID=""'):
+                elif self.lines[i].startswith('EXDATE;TZID=""'):
                     exdate = True
                 elif exdate and self.lines[i].startswith(' '):
                     self.lines[i] = re.sub("T[0-9]*","", self.lines[i])
                 else:
                     exdate = False
 
-    def to_ical(self):
+    def iter_ical(self):
+        '''
+        Generator producing the VEVENT component chunk by chunk.
+        '''
         attendees_lines = []
         attachments_lines = []
         for attendee in self.attendees:
@@ -495,21 +1341,19 @@ class Event(object):
         for attachment in self.attachments:
             attachments_lines.append('ATTACH%s' % attachment)
         self.fix_groupwise_inconsistencies()
-        return 'BEGIN:VEVENT\r\n%s\r\n%s\r\n%s\r\nEND:VEVENT\r\n' % (
-                    '\r\n'.join(self.lines), '\r\n'.join(attendees_lines),
-                    '\r\n'.join(attachments_lines))
+        yield 'BEGIN:VEVENT\r\n'
+        for lines in (self.iter_lines(), attendees_lines, attachments_lines):
+            yield '\r\n'.join(lines)
+            yield '\r\n'
+        yield 'END:VEVENT\r\n'
+
+    def to_ical(self):
+        return ''.join(self.iter_ical())
 
     def __eq__(self, other):
-        # Get the properties as a dictionary without lines numbers to compare them
-        self_props = {}
-        for prop in self.properties:
-            self_props[prop] = self.properties[prop][0]
-
-        other_props = {}
-        for prop in other.properties:
-            other_props[prop] = other.properties[prop][0]
-
-        # We don't mind the order of the items in the dictionary in the comparison
-        props_equal = set(self_props.items()) ^ set(other_props.items())
-        attendees_equal = set(self.attendees) ^ set(other.attendees)
-        return len(props_equal) == 0 and len(attendees_equal) == 0
+        if not isinstance(other, Event):
+            return False
+        return self.fingerprint == other.fingerprint
+
+    def __ne__(self, other):
+        return not self == other
@@ -18,49 +18,1133 @@
 
 import imaplib
 import sys
-from cal import Calendar
+from cal import Calendar, TimezoneRegistry, Attachment, LineUnwrapper
+from metrics import Metrics
 from datetime import datetime
+import os
 import os.path
 import httplib
 import xml.etree.ElementTree as ET
+import re
 import shutil
+import cPickle as pickle
+import socket
+import errno
+import Queue
+import hashlib
+import base64
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+def uid_set(uids):
+    '''
+    Builds an IMAP sequence set from a sorted list of UIDs, collapsing
+    the consecutive ones into ranges: [1, 2, 3, 5] gives '1:3,5'.
+    '''
+    ranges = []
+    start = None
+    previous = None
+    for uid in uids:
+        if start is None:
+            start = uid
+        elif uid != previous + 1:
+            ranges.append((start, previous))
+            start = uid
+        previous = uid
+    if start is not None:
+        ranges.append((start, previous))
+
+    items = []
+    for (first, last) in ranges:
+        if first == last:
+            items.append('%d' % first)
+        else:
+            items.append('%d:%d' % (first, last))
+    return ','.join(items)
+
+FETCH_TOKEN_RE = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+# Charset parameter of a content type
+CHARSET_RE = re.compile(r';\s*charset="?([^";\s]+)', re.IGNORECASE)
+
+def tokenize_fetch(data):
+    '''
+    Splits an imaplib FETCH response into tokens. The literals, returned
+    by imaplib as (line, literal) tuples, become string tokens.
+    '''
+    tokens = []
+    for item in data:
+        literal = None
+        if isinstance(item, tuple):
+            (item, literal) = item
+            item = item[:item.rfind('{')]
+        if item is None:
+            continue
+        for token in FETCH_TOKEN_RE.findall(item):
+            if token.startswith('"'):
+                token = re.sub(r'\\(.)', r'\1', token[1:-1])
+            elif token.upper() == 'NIL':
+                token = None
+            tokens.append(token)
+        if literal is not None:
+            # Tell literals from atoms
+            tokens.append([literal])
+    return tokens
+
+def parse_fetch(data):
+    '''
+    Parses an imaplib FETCH response.
+
+    @result: a list of dictionaries mapping the upper-cased item names of
+             each message to their value: strings or nested lists
+    '''
+    tokens = tokenize_fetch(data)
+    position = [0]
+
+    def parse_value():
+        token = tokens[position[0]]
+        position[0] += 1
+        if token == '(':
+            values = []
+            while tokens[position[0]] != ')':
+                values.append(parse_value())
+            position[0] += 1
+            return values
+        if isinstance(token, list):
+            return token[0]
+        return token
+
+    messages = []
+    while position[0] < len(tokens):
+        # Message sequence number, then the list of items
+        position[0] += 1
+        if position[0] >= len(tokens):
+            break
+        values = parse_value()
+        if not isinstance(values, list):
+            continue
+        items = {}
+        for i in range(0, len(values) - 1, 2):
+            items[str(values[i]).upper()] = values[i + 1]
+        messages.append(items)
+    return messages
+
+def get_structure_params(params):
+    result = {}
+    if isinstance(params, list):
+        for i in range(0, len(params) - 1, 2):
+            result[str(params[i]).lower()] = params[i + 1]
+    return result
+
+def find_parts(structure, prefix=''):
+    '''
+    Walks a BODYSTRUCTURE looking for the calendar and attachment parts.
+
+    @result: a (calendar, attachments) tuple where calendar is the last
+             (section, encoding) of the text/calendar parts, or None, and
+             attachments a list of (section, filename, content type,
+             encoding) tuples
+    '''
+    calendar = None
+    attachments = []
+    if len(structure) > 0 and isinstance(structure[0], list):
+        index = 0
+        while index < len(structure) and isinstance(structure[index], list):
+            child = structure[index]
+            index += 1
+            (child_calendar, child_attachments) = find_parts(child,
+                                                    '%s%d.' % (prefix, index))
+            if child_calendar is not None:
+                calendar = child_calendar
+            attachments.extend(child_attachments)
+        return (calendar, attachments)
+
+    section = prefix[:-1] or '1'
+    maintype = str(structure[0]).lower()
+    content_type = '%s/%s' % (maintype, str(structure[1]).lower())
+    encoding = structure[5]
+    if content_type.startswith('text/calendar'):
+        return ((section, encoding), [])
+
+    extension = 7
+    if maintype == 'text':
+        extension = 8
+    elif content_type == 'message/rfc822':
+        extension = 10
+    disposition = None
+    if len(structure) > extension + 1:
+        disposition = structure[extension + 1]
+    if isinstance(disposition, list) and len(disposition) > 0 and \
+       str(disposition[0]).lower().startswith('attachment'):
+        filename = None
+        if len(disposition) > 1:
+            filename = get_structure_params(disposition[1]).get('filename')
+        if filename is None:
+            filename = get_structure_params(structure[2]).get('name')
+        attachments.append((section, filename, content_type, encoding))
+    return (calendar, attachments)
+
+def scan_event(ical):
+    '''
+    Reads the UID and DTSTAMP of the first event of a calendar without
+    parsing it.
+
+    @result: (UID, DTSTAMP) values or None if there is no event
+    '''
+    in_event = False
+    uid = None
+    dtstamp = None
+    for (real_lines, line) in LineUnwrapper(ical).each_line():
+        if line == 'BEGIN:VEVENT':
+            in_event = True
+        elif not in_event:
+            continue
+        elif line == 'END:VEVENT':
+            break
+        elif line.startswith('UID:'):
+            uid = line[4:]
+        elif line.startswith('DTSTAMP'):
+            dtstamp = line[line.find(':') + 1:]
+    if uid is None:
+        return None
+    return (uid, dtstamp)
+
+def parse_dtstamp(value):
+    if value is None:
+        return datetime.min
+    return datetime.strptime(value, '%Y%m%dT%H%M%SZ')
+
+class IMAPAttachment(Attachment):
+    '''
+    Attachment only fetched from the server when read, using the IMAP
+    session of the connection that parses its mail.
+    '''
+
+    def __init__(self, connection, mail_uid, section, filename=None,
+                 content_type=None, encoding=None, payload=None):
+        self.connection = connection
+        self.mail_uid = mail_uid
+        self.section = section
+        self.filename = filename
+        self.content_type = content_type
+        self.encoding = encoding
+        self.payload = payload
+        # The content of a message part never changes
+        self.key = '%s:%d:%s' % (connection.uidvalidity, mail_uid, section)
+
+    def get_encoded(self):
+        if self.payload is None:
+            self.payload = self.connection.fetch_section(self.mail_uid,
+                                                         self.section)
+        return (self.payload, self.encoding)
+
+class SyncState(object):
+    '''
+    Persistent state of the mailbox synchronization. It remembers the
+    UIDVALIDITY of the mailbox, the last UID seen and the events parsed
+    from the messages so that only new messages have to be fetched.
+
+    Only the newest version of each event is kept: the other messages are
+    only indexed by their event UID and DTSTAMP, so the memory used is
+    bounded by the number of distinct events rather than of messages.
+    '''
+    VERSION = 2
+    # Source of the calendar the state is for
+    KIND = 'imap'
+
+    def __init__(self, path=None):
+        self.path = path
+        self.reset(None)
+
+    def reset(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.last_uid = 0
+        # Mail UID -> (event UID, DTSTAMP) or None if the mail had no event
+        self.messages = {}
+        # Event UID -> (mail UID, event, timezones) of the newest version
+        self.events = {}
+
+    def add(self, mail_uid, event, timezones):
+        '''
+        Records the event parsed from a mail. The event is kept only if
+        it is the newest version, the latest mail winning on equal DTSTAMPs.
+        '''
+        self.last_uid = max(self.last_uid, mail_uid)
+        if event is None or event.uid is None:
+            self.messages[mail_uid] = None
+            return
+
+        dtstamp = parse_dtstamp(event.dtstamp)
+        self.messages[mail_uid] = (event.uid, dtstamp)
+        if self.is_newest(event.uid, dtstamp, mail_uid):
+            self.events[event.uid] = (mail_uid, event, timezones)
+
+    def add_superseded(self, mail_uid, event_uid, dtstamp):
+        '''
+        Records a mail holding an older version of an event without its
+        content: it is only fetched if the newer versions get expunged.
+        '''
+        self.last_uid = max(self.last_uid, mail_uid)
+        self.messages[mail_uid] = (event_uid, dtstamp)
+
+    def is_newest(self, event_uid, dtstamp, mail_uid):
+        '''
+        @result: whether a version of an event is newer than the known one
+        '''
+        if event_uid not in self.events:
+            return True
+        newest_uid = self.events[event_uid][0]
+        return (self.messages[newest_uid][1], newest_uid) <= (dtstamp, mail_uid)
+
+    def expunge(self, mail_uids):
+        '''
+        Forgets the expunged mails.
+
+        @result: sorted list of the mail UIDs to fetch again as they hold
+                 the newest remaining version of an event whose newest
+                 version has been expunged
+        '''
+        orphans = set()
+        for mail_uid in mail_uids:
+            entry = self.messages.pop(mail_uid, None)
+            if entry is None:
+                continue
+            event_uid = entry[0]
+            if event_uid in self.events and self.events[event_uid][0] == mail_uid:
+                del self.events[event_uid]
+                orphans.add(event_uid)
+
+        candidates = {}
+        if len(orphans) > 0:
+            for mail_uid in self.messages:
+                entry = self.messages[mail_uid]
+                if entry is None or entry[0] not in orphans:
+                    continue
+                best = candidates.get(entry[0])
+                if best is None or (self.messages[best][1], best) < (entry[1], mail_uid):
+                    candidates[entry[0]] = mail_uid
+        return sorted(candidates.values())
+
+    def is_valid(self, uidvalidity):
+        return self.uidvalidity is not None and self.uidvalidity == uidvalidity
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        fdescr = open(self.path, 'rb')
+        try:
+            data = pickle.load(fdescr)
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, ValueError):
+            print >> sys.stderr, 'Ignoring invalid sync state %s\n' % self.path
+            return
+        finally:
+            fdescr.close()
+        if not isinstance(data, dict) or data.get('version') != self.VERSION \
+           or data.get('kind', SyncState.KIND) != self.KIND:
+            # Older state format or other source: do a full synchronization
+            return
+        self.set_data(data)
+
+    def get_data(self):
+        return {'uidvalidity': self.uidvalidity,
+                'last_uid': self.last_uid,
+                'messages': self.messages,
+                'events': self.events}
+
+    def set_data(self, data):
+        self.uidvalidity = data['uidvalidity']
+        self.last_uid = data['last_uid']
+        self.messages = data['messages']
+        self.events = data['events']
+
+    def save(self):
+        if self.path is None:
+            return
+        data = self.get_data()
+        data['version'] = self.VERSION
+        data['kind'] = self.KIND
+        # Write to a temporary file first to never leave a truncated state
+        tmp_path = '%s.tmp' % self.path
+        fdescr = open(tmp_path, 'wb')
+        pickle.dump(data, fdescr, pickle.HIGHEST_PROTOCOL)
+        fdescr.close()
+        os.rename(tmp_path, self.path)
+
+class SoapSyncState(SyncState):
+    '''
+    Persistent state of the synchronization through the SOAP API: the
+    calendar folder, the events of its appointments and the latest
+    modification date seen, to only ask for the appointments modified since.
+    '''
+    VERSION = 1
+    KIND = 'soap'
+
+    def reset(self, folder):
+        self.folder = folder
+        # Latest modification date seen, as sent by the server
+        self.modified = None
+        # Item id -> (modification date, event)
+        self.items = {}
+
+    def add(self, item_id, modified, event):
+        self.items[item_id] = (modified, event)
+        if modified is not None and (self.modified is None or
+                                     modified > self.modified):
+            self.modified = modified
+
+    def remove(self, item_ids):
+        for item_id in item_ids:
+            del self.items[item_id]
+
+    def is_valid(self, folder):
+        return self.folder is not None and self.folder == folder
+
+    def get_data(self):
+        return {'folder': self.folder,
+                'modified': self.modified,
+                'items': self.items}
+
+    def set_data(self, data):
+        self.folder = data['folder']
+        self.modified = data['modified']
+        self.items = data['items']
+
+class AttachmentStore(object):
+    '''
+    Content-addressed storage of the attachments. Each distinct content is
+    stored once in the .store folder, named after its SHA-1, and the
+    attachments are hardlinks to it named gwrecordid/digest/filename: the
+    digest keeps apart the versions of an event carrying different files.
+
+    The hardlinks are only created by collect() for the attachments of the
+    dumped events, so the older versions of the events cost no link. The
+    unchanged attachments are never written again and identical files sent
+    with several invitations share the same blob.
+
+    The attachments having a key identifying their content, like the IMAP
+    message part they come from, have their digest remembered in an index
+    so that they are not even read again.
+    '''
+    STORE_DIR = '.store'
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.store_path = os.path.join(self.path, AttachmentStore.STORE_DIR)
+        self.index_path = os.path.join(self.store_path, 'index')
+        self.lock = threading.Lock()
+        # Attachment path -> blob path of the attachments seen in this run
+        self.pending = {}
+        # Attachment key -> digest
+        self.keys = {}
+        self.written = 0
+        self.linked = 0
+        self.load_index()
+
+    def load_index(self):
+        if not os.path.isfile(self.index_path):
+            return
+        fdescr = open(self.index_path, 'rb')
+        try:
+            self.keys = pickle.load(fdescr)
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, ValueError):
+            self.keys = {}
+        finally:
+            fdescr.close()
+
+    def save_index(self):
+        self.makedirs(self.store_path)
+        tmp_path = '%s.tmp' % self.index_path
+        fdescr = open(tmp_path, 'wb')
+        pickle.dump(self.keys, fdescr, pickle.HIGHEST_PROTOCOL)
+        fdescr.close()
+        os.rename(tmp_path, self.index_path)
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.store_path, digest[:2], digest)
+
+    def makedirs(self, path):
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                # Another fetching session may have created it meanwhile
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def get_blob(self, digest, attachment):
+        '''
+        Stores the attachment content if not already there.
+
+        @result: the path of the blob holding the content
+        '''
+        blob_path = self.get_blob_path(digest)
+        blob_dir = os.path.dirname(blob_path)
+        if not os.path.exists(blob_path):
+            self.makedirs(blob_dir)
+            (fd, tmp_path) = tempfile.mkstemp(dir=blob_dir)
+            fdescr = os.fdopen(fd, 'wb')
+            attachment.write_to(fdescr)
+            fdescr.close()
+            os.rename(tmp_path, blob_path)
+            with self.lock:
+                self.written += 1
+        return blob_path
+
+    def write(self, name, attachment):
+        '''
+        Attachment writing function for Calendar. The attachment is decoded
+        a first time to compute its digest and only decoded again to be
+        written if its content is not stored yet.
+
+        @result: the URI of the attachment
+        '''
+        key = getattr(attachment, 'key', None)
+        digest = None
+        if key is not None:
+            with self.lock:
+                digest = self.keys.get(key)
+            if digest is not None and not os.path.exists(self.get_blob_path(digest)):
+                digest = None
+        if digest is None:
+            digest = hashlib.sha1()
+            for chunk in attachment.iter_chunks():
+                digest.update(chunk)
+            digest = digest.hexdigest()
+            if key is not None:
+                with self.lock:
+                    self.keys[key] = digest
+        blob_path = self.get_blob(digest, attachment)
+
+        attach_path = os.path.normpath(os.path.join(self.path,
+                                                    os.path.dirname(name),
+                                                    digest[:12],
+                                                    os.path.basename(name)))
+        if not attach_path.startswith(self.path + os.sep):
+            attach_path = os.path.join(self.path, digest[:12],
+                                       os.path.basename(name))
+        with self.lock:
+            self.pending[attach_path] = blob_path
+        return 'file://%s' % attach_path
+
+    def link(self, attach_path, blob_path):
+        '''
+        Makes attach_path a hardlink to the blob.
+        '''
+        if os.path.exists(attach_path) and \
+           os.path.samefile(attach_path, blob_path):
+            return
+        self.makedirs(os.path.dirname(attach_path))
+        # Link to a temporary name and rename to replace atomically
+        tmp_path = '%s.tmp' % attach_path
+        try:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(blob_path, tmp_path)
+        except (OSError, AttributeError):
+            # No hardlinks on this file system: copy the blob
+            shutil.copyfile(blob_path, tmp_path)
+        os.rename(tmp_path, attach_path)
+        self.linked += 1
+
+    def remove_unreferenced(self, path, referenced, in_store):
+        removed = 0
+        for (dirpath, dirnames, filenames) in os.walk(path, topdown=False):
+            if not in_store and (dirpath == self.store_path or \
+               dirpath.startswith(self.store_path + os.sep)):
+                continue
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                if file_path in referenced:
+                    continue
+                # Blobs are kept while an attachment links to them
+                if in_store and os.stat(file_path).st_nlink > 1:
+                    continue
+                os.remove(file_path)
+                removed += 1
+            if dirpath != self.path and len(os.listdir(dirpath)) == 0:
+                os.rmdir(dirpath)
+        return removed
+
+    def collect(self, uris):
+        '''
+        Links the attachments referenced by the given URIs and removes all
+        the other ones. The blobs seen in this run are kept even if not
+        linked: they belong to older versions of events still in the mailbox.
+
+        @result: the number of removed files
+        '''
+        referenced = set()
+        for uri in uris:
+            if uri.startswith('file://'):
+                referenced.add(os.path.normpath(uri[len('file://'):]))
+
+        for attach_path in referenced:
+            blob_path = self.pending.get(attach_path)
+            if blob_path is not None:
+                self.link(attach_path, blob_path)
+
+        # Remove the stale attachments first so that their blobs are no
+        # longer linked when looking at the store
+        removed = self.remove_unreferenced(self.path, referenced, False)
+        referenced.update(self.pending.values())
+        referenced.add(self.index_path)
+        removed += self.remove_unreferenced(self.store_path, referenced, True)
+
+        for key in self.keys.keys():
+            if not os.path.exists(self.get_blob_path(self.keys[key])):
+                del self.keys[key]
+        if len(self.keys) > 0 or os.path.exists(self.index_path):
+            self.save_index()
+        return removed
+
+IMAP_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
 
 class GWConnection:
-    def __init__(self, server, debug = False):
+    def __init__(self, server, debug = False, batch_size = 200, connections = 1,
+                 port = None, ssl = True, partial = False, since = None,
+                 before = None, sent = False, two_phase = False):
+        '''
+        @since, before: only synchronize the mails received in [since, before),
+                        dates or None
+        @sent: compare since and before with the Date header of the mails
+               rather than with their arrival date
+        @two_phase: read the UID and DTSTAMP of the events first to only
+                    fetch the mails holding their newest version
+        '''
         self.is_debug = debug
-        self.imap = imaplib.IMAP4_SSL(server)
+        self.batch_size = batch_size
+        self.connections = connections
+        self.partial = partial
+        self.since = since
+        self.before = before
+        self.sent = sent
+        self.two_phase = two_phase
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.imap = self.new_imap()
         self.timezones = {}
+        # Shared by all the parsed mails to intern the VTIMEZONEs
+        self.registry = TimezoneRegistry()
+        # Shared by all the sessions
+        self.metrics = Metrics()
+        # Duration of the last IMAP command
+        self.command_time = 0
+        self.uidvalidity = None
+        self.login = None
+        self.passwd = None
+        self.mailbox = None
+
+    def new_imap(self):
+        if self.ssl:
+            return imaplib.IMAP4_SSL(self.server, self.port or imaplib.IMAP4_SSL_PORT)
+        return imaplib.IMAP4(self.server, self.port or imaplib.IMAP4_PORT)
 
-    def debug(self, message):
+    def debug(self, message, *args):
+        '''
+        Prints a debug message, only formatted with the args if shown.
+        '''
         if self.is_debug:
+            if args:
+                message = message % args
             print >> sys.stderr, 'DEBUG %s\n' % (message)
 
+    def trace(self, message, *args):
+        '''
+        Like debug, for the verbose messages like the mails content, only
+        shown with a debug level higher than 1.
+        '''
+        if self.is_debug > 1:
+            if args:
+                message = message % args
+            print >> sys.stderr, 'TRACE %s\n' % (message)
+
+    def uid_command(self, command, *args):
+        '''
+        Runs an IMAP UID command and records its duration and the size of
+        its response. imaplib only raises on BAD: a NO answer raises
+        imaplib.IMAP4.error too, naming the command arguments.
+        '''
+        start = time.time()
+        err, data = self.imap.uid(command, *args)
+        self.command_time = time.time() - start
+        size = 0
+        for item in data or []:
+            if isinstance(item, tuple):
+                size += sum([len(part) for part in item if part is not None])
+            elif item is not None:
+                size += len(item)
+        self.metrics.add_time('imap_%s' % command.lower(), self.command_time)
+        self.metrics.incr('imap_round_trips')
+        self.metrics.incr('imap_bytes', size)
+        if err != 'OK':
+            # An ignored NO would look like an empty result
+            raise imaplib.IMAP4.error('UID %s %s failed: %s' %
+                                      (command, ' '.join([arg for arg in args
+                                                          if arg is not None]),
+                                       data))
+        return (err, data)
+
+    def record_message(self, mail_uid, size, fetch_time, parse_time):
+        '''
+        Records the size, fetch and parse time of a message.
+        '''
+        self.metrics.incr('messages')
+        self.metrics.add_time('parse', parse_time)
+        self.metrics.observe('message_bytes', mail_uid, size)
+        self.metrics.observe('message_seconds', mail_uid, fetch_time + parse_time)
 
     def connect(self, login, passwd, mailbox):
-        self.imap.login(login, passwd)
-        self.imap.select(mailbox)
-
-    def get_mails_ids(self):
-        err, ids = self.imap.search(None, '(ALL)')
-        return ids[0].split()
-
-    def get_event(self, mail_id, attach_write_func):
-        # TODO Caching the events would be needed,
-        # though we still need to find a way to get changed appointments
-        err, data = self.imap.fetch(mail_id, '(RFC822)')
-        self.debug('Mail content to parse: \n------\n%s\n' % data[0][1])
-        calendar = Calendar(data[0][1], attach_write_func)
-        event = None
-        if len(calendar.events) > 0:
-            event = calendar.events[0]
-        if len(calendar.timezones) > 0:
-            for key in calendar.timezones:
-                self.timezones[key] = calendar.timezones[key]
-        self.debug("%s\n" % calendar.to_ical)
-        return event
-
-    def dump(self, path):
+        self.login = login
+        self.passwd = passwd
+        self.mailbox = mailbox
+        with self.metrics.timer('imap_connect'):
+            self.imap.login(login, passwd)
+            self.imap.select(mailbox)
+        self.metrics.incr('imap_round_trips', 2)
+        err, data = self.imap.response('UIDVALIDITY')
+        if data and data[0] is not None:
+            self.uidvalidity = data[0]
+
+    def refresh(self):
+        '''
+        Prepares a connection kept since a previous dump for another one:
+        selecting the mailbox again is enough to read its current
+        UIDVALIDITY. A new session is opened if the server closed the
+        previous one.
+        '''
+        self.timezones = {}
+        try:
+            with self.metrics.timer('imap_connect'):
+                err, data = self.imap.select(self.mailbox)
+            if err != 'OK':
+                raise imaplib.IMAP4.error('SELECT failed: %s' % data)
+            self.metrics.incr('imap_round_trips')
+        except (imaplib.IMAP4.abort, socket.error), e:
+            self.debug('Session lost, connecting again: %s', e)
+            self.logout()
+            self.imap = self.new_imap()
+            self.connect(self.login, self.passwd, self.mailbox)
+            return
+        err, data = self.imap.response('UIDVALIDITY')
+        if data and data[0] is not None:
+            self.uidvalidity = data[0]
+
+    def get_search_criteria(self):
+        '''
+        @result: the IMAP SEARCH criteria matching the mails to synchronize
+        '''
+        criteria = []
+        prefix = 'SENT' if self.sent else ''
+        for (key, date) in (('SINCE', self.since), ('BEFORE', self.before)):
+            if date is not None:
+                # Not strftime: the month names must not depend on the locale
+                criteria.append('%s%s %d-%s-%d' % (prefix, key, date.day,
+                                                   IMAP_MONTHS[date.month - 1],
+                                                   date.year))
+        if len(criteria) == 0:
+            return '(ALL)'
+        return '(%s)' % ' '.join(criteria)
+
+    def get_mails_uids(self):
+        criteria = self.get_search_criteria()
+        self.debug('Search criteria: %s', criteria)
+        # A refused search raises: an empty result would drop all the
+        # messages from the state
+        err, uids = self.uid_command('SEARCH', None, criteria)
+        return sorted([int(uid) for uid in uids[0].split()])
+
+    def get_new_uids(self, state):
+        '''
+        Lists the mails of the mailbox by only searching the UIDs above the
+        last one seen: the message count returned by SELECT tells whether
+        some known mails have been expunged since.
+
+        @state: SyncState of the mailbox
+        @result: the sorted UIDs of the mails, or None if they have to be
+                 searched in full
+        '''
+        try:
+            err, uids = self.uid_command('SEARCH', None, 'UID',
+                                         '%d:*' % (state.last_uid + 1))
+        except imaplib.IMAP4.error, e:
+            self.debug('Search of the new mails failed: %s', e)
+            return None
+        # '*' is the highest UID even if below the start of the range
+        new_uids = sorted([int(uid) for uid in uids[0].split()
+                           if int(uid) > state.last_uid])
+
+        # imaplib answers [None] for the responses not received
+        err, expunged = self.imap.response('EXPUNGE')
+        err, exists = self.imap.response('EXISTS')
+        if (expunged and expunged[0] is not None) or \
+           not exists or exists[-1] is None:
+            return None
+        if int(exists[-1]) != len(state.messages) + len(new_uids):
+            self.debug('%s messages in the mailbox for %d known and %d new, '
+                       'searching all of them', exists[-1],
+                       len(state.messages), len(new_uids))
+            return None
+        return sorted(state.messages) + new_uids
+
+    def get_calendar(self, mail_uid, attach_write_func):
+        err, data = self.uid_command('FETCH', str(mail_uid), '(UID RFC822)')
+        fetch_time = self.command_time
+        content = None
+        for items in parse_fetch(data):
+            if items.get('RFC822') is not None:
+                content = items['RFC822']
+        if content is None:
+            raise imaplib.IMAP4.error('Mail %d not found' % mail_uid)
+        self.trace('Mail content to parse: \n------\n%s\n', content)
+        start = time.time()
+        calendar = Calendar(content, attach_write_func, self.registry)
+        self.record_message(mail_uid, len(content), fetch_time,
+                            time.time() - start)
+        if self.is_debug > 1:
+            self.trace('%s\n', calendar.to_ical())
+        return calendar
+
+    def fetch_section(self, mail_uid, section):
+        '''
+        @result: the still encoded content of a section of a message
+        '''
+        err, data = self.uid_command('FETCH', str(mail_uid),
+                                     '(UID BODY.PEEK[%s])' % section)
+        for items in parse_fetch(data):
+            if 'BODY[%s]' % section in items:
+                return items['BODY[%s]' % section] or ''
+        return ''
+
+    def fetch_calendar_parts(self, batch):
+        '''
+        Fetches the BODYSTRUCTURE of a batch of messages and then only their
+        text/calendar part.
+
+        @result: (structures, icals, fetch time) where structures maps the
+                 UIDs to the find_parts() result and icals to the still
+                 encoded calendar parts
+        '''
+        err, data = self.uid_command('FETCH', uid_set(batch), '(UID BODYSTRUCTURE)')
+        fetch_time = self.command_time
+        structures = {}
+        for items in parse_fetch(data):
+            if 'UID' in items and isinstance(items.get('BODYSTRUCTURE'), list):
+                structures[int(items['UID'])] = find_parts(items['BODYSTRUCTURE'])
+
+        # The calendar parts are usually at the same place in all the
+        # messages: fetch them together
+        sections = {}
+        for mail_uid in batch:
+            parts = structures.get(mail_uid)
+            if parts is not None and parts[0] is not None:
+                sections.setdefault(parts[0][0], []).append(mail_uid)
+
+        icals = {}
+        for section in sorted(sections):
+            err, data = self.uid_command('FETCH', uid_set(sections[section]),
+                                         '(UID BODY.PEEK[%s])' % section)
+            fetch_time += self.command_time
+            for items in parse_fetch(data):
+                if 'UID' in items and 'BODY[%s]' % section in items:
+                    icals[int(items['UID'])] = items['BODY[%s]' % section] or ''
+        return (structures, icals, fetch_time)
+
+    def fetch_parts(self, batch, attach_write_func):
+        '''
+        Fetches only the text/calendar part of a batch of messages. The
+        attachments are only fetched if an event references them.
+
+        @result: a list of (uid, calendar) tuples
+        '''
+        (structures, icals, fetch_time) = self.fetch_calendar_parts(batch)
+        calendars = []
+        for mail_uid in batch:
+            if mail_uid not in structures:
+                # Unexpected structure: fall back to the whole message
+                calendars.append((mail_uid, self.get_calendar(mail_uid,
+                                                              attach_write_func)))
+                continue
+
+            if mail_uid not in icals and structures[mail_uid][0] is not None:
+                # The calendar part was missing from the response
+                calendars.append((mail_uid, self.get_calendar(mail_uid,
+                                                              attach_write_func)))
+                continue
+
+            if mail_uid not in icals:
+                print >> sys.stderr, "Didn't find any ical data in mail %d\n" % mail_uid
+                calendars.append((mail_uid, Calendar(registry=self.registry)))
+                continue
+
+            # The fetch time of the batch is shared by its messages
+            calendar = self.parse_parts(mail_uid, structures[mail_uid],
+                                        icals[mail_uid], attach_write_func,
+                                        fetch_time / len(batch))
+            calendars.append((mail_uid, calendar))
+        return calendars
+
+    def parse_parts(self, mail_uid, parts, payload, attach_write_func,
+                    fetch_time=0):
+        '''
+        Parses the calendar part of a message. Its attachments are only
+        fetched if an event references them.
+
+        @parts: the find_parts() result of the message
+        @payload: the still encoded calendar part
+        '''
+        (ical_part, attachment_parts) = parts
+        (section, encoding) = ical_part
+        start = time.time()
+        ical = IMAPAttachment(self, mail_uid, section, encoding=encoding,
+                              payload=payload).get_payload()
+        self.trace('Calendar part to parse: \n------\n%s\n', ical)
+        attachments = [IMAPAttachment(self, mail_uid, part[0], part[1],
+                                      part[2], part[3])
+                       for part in attachment_parts]
+        calendar = Calendar(registry=self.registry)
+        calendar.parse(ical, attachments, attach_write_func)
+        self.record_message(mail_uid, len(payload), fetch_time,
+                            time.time() - start)
+        return calendar
+
+    def fetch_batch(self, batch, attach_write_func):
+        '''
+        Fetches a batch of messages in a single request and returns a list
+        of (uid, calendar) tuples.
+        '''
+        if self.partial:
+            try:
+                return self.fetch_parts(batch, attach_write_func)
+            except imaplib.IMAP4.error, e:
+                self.debug('Partial fetch failed, fetching whole mails: %s', e)
+
+        if self.batch_size <= 1:
+            return [(mail_uid, self.get_calendar(mail_uid, attach_write_func)) \
+                    for mail_uid in batch]
+
+        try:
+            err, data = self.uid_command('FETCH', uid_set(batch), '(UID RFC822)')
+        except imaplib.IMAP4.error, e:
+            self.debug('Batched fetch failed, fetching one by one: %s', e)
+            return [(mail_uid, self.get_calendar(mail_uid, attach_write_func)) \
+                    for mail_uid in batch]
+
+        fetch_time = self.command_time
+        calendars = []
+        missing = set(batch)
+        # The items may come in any order: the UID can follow the literal
+        for items in parse_fetch(data):
+            content = items.get('RFC822')
+            if 'UID' not in items or content is None:
+                continue
+            mail_uid = int(items['UID'])
+            if mail_uid not in missing:
+                continue
+            missing.remove(mail_uid)
+            self.trace('Mail content to parse: \n------\n%s\n', content)
+            start = time.time()
+            calendar = Calendar(content, attach_write_func, self.registry)
+            self.record_message(mail_uid, len(content), fetch_time / len(batch),
+                                time.time() - start)
+            calendars.append((mail_uid, calendar))
+
+        # Not answered by the server, like when it failed to read them
+        for mail_uid in sorted(missing):
+            self.debug('Mail %d missing from the batch, fetching it alone',
+                       mail_uid)
+            calendars.append((mail_uid, self.get_calendar(mail_uid,
+                                                          attach_write_func)))
+        return calendars
+
+    def select_newest(self, state, mail_uids):
+        '''
+        First phase of the two-phase fetch: the UID and DTSTAMP of the events
+        are read from the calendar part of the messages only, by batches of
+        batch_size messages. The messages holding an older version of an
+        event are only recorded in the state. The calendar part of the
+        newest versions is kept to be parsed without fetching it again.
+
+        @result: (mail_uids, payloads) where mail_uids are the UIDs of the
+                 messages to fetch as usual, as their calendar part couldn't
+                 be read, and payloads maps the UIDs of the messages holding
+                 the newest versions to their (parts, calendar part) tuple
+        '''
+        size = max(self.batch_size, 1)
+        fetch_uids = []
+        payloads = {}
+        # Event UID -> (DTSTAMP, message UID) of the newest version
+        newest = {}
+        # Message UID -> (event UID, DTSTAMP) of the older versions
+        superseded = {}
+        try:
+            for i in range(0, len(mail_uids), size):
+                batch = mail_uids[i:i + size]
+                (structures, icals, fetch_time) = self.fetch_calendar_parts(batch)
+                for mail_uid in batch:
+                    if mail_uid not in icals:
+                        fetch_uids.append(mail_uid)
+                        continue
+                    (section, encoding) = structures[mail_uid][0]
+                    ical = IMAPAttachment(self, mail_uid, section, encoding=encoding,
+                                          payload=icals[mail_uid]).get_payload()
+                    scanned = scan_event(ical)
+                    try:
+                        key = (parse_dtstamp(scanned[1]), mail_uid)
+                    except (TypeError, ValueError):
+                        # No event or odd DTSTAMP: let the parser deal with it
+                        fetch_uids.append(mail_uid)
+                        continue
+                    event_uid = scanned[0]
+                    if event_uid in newest:
+                        if newest[event_uid] > key:
+                            superseded[mail_uid] = (event_uid, key[0])
+                            continue
+                        (dtstamp, older_uid) = newest[event_uid]
+                        superseded[older_uid] = (event_uid, dtstamp)
+                        del payloads[older_uid]
+                    newest[event_uid] = key
+                    payloads[mail_uid] = (structures[mail_uid], icals[mail_uid])
+        except imaplib.IMAP4.error, e:
+            self.debug('Reading the events failed, fetching all mails: %s', e)
+            return (mail_uids, {})
+
+        for (event_uid, (dtstamp, mail_uid)) in newest.items():
+            if not state.is_newest(event_uid, dtstamp, mail_uid):
+                superseded[mail_uid] = (event_uid, dtstamp)
+                del payloads[mail_uid]
+        for (mail_uid, (event_uid, dtstamp)) in superseded.items():
+            state.add_superseded(mail_uid, event_uid, dtstamp)
+
+        self.metrics.incr('superseded', len(superseded))
+        self.debug('Skipping %d messages holding older versions of events',
+                   len(superseded))
+        return (sorted(fetch_uids), payloads)
+
+    def open_session(self):
+        '''
+        Opens another session on the same server and mailbox.
+        '''
+        session = GWConnection(self.server, self.is_debug, self.batch_size,
+                               port=self.port, ssl=self.ssl, partial=self.partial)
+        session.registry = self.registry
+        session.metrics = self.metrics
+        session.connect(self.login, self.passwd, self.mailbox)
+        if session.uidvalidity != self.uidvalidity:
+            session.logout()
+            raise imaplib.IMAP4.error('UIDVALIDITY changed while syncing')
+        return session
+
+    def logout(self):
+        try:
+            self.imap.logout()
+        except (imaplib.IMAP4.error, socket.error):
+            pass
+
+    def get_calendars(self, mail_uids, attach_write_func):
+        '''
+        Generator fetching the messages by batches of batch_size UIDs
+        and yielding a (uid, calendar) tuple for each of them.
+
+        When more than one connection is allowed, the batches are spread
+        over a pool of sessions, but still yielded in the order of the UIDs.
+        '''
+        size = max(self.batch_size, 1)
+        batches = [mail_uids[i:i + size] for i in range(0, len(mail_uids), size)]
+
+        if self.connections <= 1 or len(batches) <= 1:
+            for batch in batches:
+                for item in self.fetch_batch(batch, attach_write_func):
+                    yield item
+            return
+
+        local = threading.local()
+        sessions = []
+        sessions_lock = threading.Lock()
+
+        def fetch(batch):
+            if not hasattr(local, 'session'):
+                local.session = self.open_session()
+                with sessions_lock:
+                    sessions.append(local.session)
+            return local.session.fetch_batch(batch, attach_write_func)
+
+        pool = ThreadPool(min(self.connections, len(batches)))
+        try:
+            for calendars in pool.imap(fetch, batches):
+                for item in calendars:
+                    yield item
+        finally:
+            pool.terminate()
+            pool.join()
+            for session in sessions:
+                session.logout()
+
+    def sync(self, state, attach_write_func):
+        '''
+        Updates the synchronization state with the mailbox content: only the
+        messages with a UID higher than the last seen one are fetched and the
+        expunged ones are dropped. Without a date window, only those UIDs are
+        searched unless the message count shows that some mails have been
+        expunged. A UIDVALIDITY change resets the state.
+        The messages out of the since and before dates are handled like
+        expunged ones, so changing the dates doesn't need a full resync.
+
+        @result: True if a full resynchronization has been done
+        '''
+        full = not state.is_valid(self.uidvalidity)
+        if full:
+            state.reset(self.uidvalidity)
+
+        uids = None
+        # The date window may drop known mails: only a full search tells
+        if not full and state.last_uid > 0 and \
+           self.get_search_criteria() == '(ALL)':
+            uids = self.get_new_uids(state)
+        if uids is None:
+            uids = self.get_mails_uids()
 
+        current = set(uids)
+        expunged = [uid for uid in state.messages if uid not in current]
+        self.debug('Expunged messages: %s', expunged)
+        refetch = state.expunge(expunged)
+
+        new_uids = [uid for uid in uids if uid not in state.messages]
+        fetch_uids = sorted(refetch + new_uids)
+        if self.two_phase and len(fetch_uids) > 0:
+            with self.metrics.timer('scan'):
+                (fetch_uids, payloads) = self.select_newest(state, fetch_uids)
+            for mail_uid in sorted(payloads):
+                (parts, payload) = payloads.pop(mail_uid)
+                calendar = self.parse_parts(mail_uid, parts, payload,
+                                            attach_write_func)
+                event = None
+                if len(calendar.events) > 0:
+                    event = calendar.events[0]
+                state.add(mail_uid, event, calendar.timezones)
+        for (uid, calendar) in self.get_calendars(fetch_uids, attach_write_func):
+            event = None
+            if len(calendar.events) > 0:
+                event = calendar.events[0]
+            state.add(uid, event, calendar.timezones)
+
+        return full
+
+    def dump(self, path, state_path=None, metrics_path=None, start=None,
+             end=None):
+        '''
+        Writes the calendar to path, or stdout if None.
+
+        @state_path: file keeping the synchronization state between runs
+        @metrics_path: file where to write the metrics of the run, in the
+                       Prometheus text format if its name ends with .prom
+        @start, end: only write the events with an occurrence in
+                     [start, end), naive UTC datetimes or None
+        '''
         dirname = None
         attachdir_path = os.path.join(os.getcwd(), 'attachments')
         if path is not None:
@@ -69,107 +1153,360 @@ class GWConnection:
             if not os.path.isdir(dirname):
                 os.makedirs(dirname)
 
-        def attach_write_func(name, content):
-            attach_path = os.path.join(attachdir_path, name)
-            attach_dir = os.path.dirname(attach_path)
-            if not os.path.exists(attach_dir):
-                os.makedirs(attach_dir)
-            if not os.path.exists(attach_path):
-                fdescr = open(attach_path, 'w')
-                fdescr.write(content)
-                fdescr.close()
-
-            return 'file://%s' % attach_path
-
-        # Cleanup existing files
-        if (os.path.isdir(attachdir_path)):
-            shutil.rmtree(attachdir_path)
-        os.makedirs(attachdir_path)
-
-        events = {}
-        ids = self.get_mails_ids( );
-        for mail_id in ids:
-            event = self.get_event(mail_id, attach_write_func)
-            if event is None:
-                continue
-            dtstamp = datetime.strptime(event.dtstamp, '%Y%m%dT%H%M%SZ')
-            uid = event.uid
+        store = AttachmentStore(attachdir_path)
+        state = SyncState(state_path)
+        with self.metrics.timer('state_load'):
+            state.load()
+
+        def attach_write_func(name, attachment):
+            with self.metrics.timer('attachments'):
+                return store.write(name, attachment)
 
-            if uid is not None:
-                if uid in events and \
-                        datetime.strptime(events[uid].dtstamp, '%Y%m%dT%H%M%SZ') <= dtstamp:
-                    events[uid] = event
-                elif uid not in events:
-                    events[uid] = event
+        with self.metrics.timer('sync'):
+            full = self.sync(state, attach_write_func)
+        self.metrics.incr('full_sync' if full else 'incremental_sync')
+
+        calendar = Calendar()
+        for (mail_uid, event, timezones) in sorted(state.events.values()):
+            for key in timezones:
+                self.timezones[key] = timezones[key]
+            calendar.events.append(event)
+        calendar.timezones = self.timezones
+        calendar.registry = self.registry
+        if start is not None or end is not None:
+            with self.metrics.timer('occurrences'):
+                calendar.restrict(start, end)
+        self.metrics.incr('events', len(calendar.events))
 
         if path is not None:
             fp = open(path, 'w')
         else:
             fp = sys.stdout
 
-        fp.write('BEGIN:VCALENDAR\r\n')
-        fp.write('PRODID:-//SUSE Hackweek//NONSGML groupwise-to-ics//EN\r\n')
-        fp.write('VERSION:2.0\r\n')
-
-        for timezone in self.timezones:
-            fp.write('\r\n'.join(self.timezones[timezone]))
-            fp.write('\r\n')
+        with self.metrics.timer('output'):
+            calendar.write_ical(fp)
 
-        for eventid in events:
-            event = events[eventid]
-            fp.write(event.to_ical())
-
-        fp.write('END:VCALENDAR\r\n')
         if path is not None:
             fp.close()
 
+        with self.metrics.timer('state_save'):
+            state.save()
+
+        # The attachments of the events out of the written period are kept
+        uris = [attach.value for (mail_uid, event, timezones) in state.events.values()
+                for attach in event.attachments]
+        with self.metrics.timer('attachments_gc'):
+            removed = store.collect(uris)
+        self.metrics.incr('attachments_written', store.written)
+        self.metrics.incr('attachments_linked', store.linked)
+        self.metrics.incr('attachments_removed', removed)
+
+        self.metrics.incr('timezones_parsed', self.registry.parsed)
+        self.metrics.incr('timezones_reused', self.registry.reused)
+        if self.registry.parsed > 0:
+            self.metrics.add_time('timezones', self.registry.parse_time)
+
+        self.debug('%s', self.metrics.summary())
+        if metrics_path is not None:
+            self.metrics.write(metrics_path)
+
 class SoapException(Exception):
     def __init__(self, msg):
         self.msg = msg
     def __str__(self):
         return self.msg
 
+GW_METHODS_NS = 'http://schemas.novell.com/2005/01/GroupWise/methods'
+GW_TYPES_NS = 'http://schemas.novell.com/2005/01/GroupWise/types'
+GW_NS = {'gwm': GW_METHODS_NS, 'gwt': GW_TYPES_NS}
+
+ENVELOPE_HEAD = '''<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ns1="%s" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:ns2="%s">
+%%s
+<SOAP-ENV:Body>''' % (GW_TYPES_NS, GW_METHODS_NS)
+ENVELOPE_SESSION = '<SOAP-ENV:Header><session>%s</session></SOAP-ENV:Header>'
+ENVELOPE_FOOTER = '</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+def gw_tag(name, namespace=GW_TYPES_NS):
+    '''
+    @result: the element tag of name as given by ElementTree
+    '''
+    return '{%s}%s' % (namespace, name)
+
+class FolderCache(object):
+    '''
+    Tree of the mailbox folders, filled from a single recursive folder
+    listing and indexed by (parent id, name) and by folder type. It is
+    optionally kept on disk and considered stale after ttl seconds.
+    '''
+    VERSION = 1
+
+    def __init__(self, path=None, ttl=24*3600):
+        self.path = path
+        self.ttl = ttl
+        self.clear()
+
+    def clear(self):
+        self.updated = None
+        # (parent id, name) -> folder id
+        self.by_name = {}
+        # Folder type -> folder id
+        self.by_type = {}
+
+    def is_fresh(self):
+        return self.updated is not None and \
+               time.time() - self.updated < self.ttl
+
+    def fill(self, folders):
+        '''
+        Replaces the cached folders.
+
+        @folders: list of (folder id, parent id, name, type) tuples,
+                  the type being None for the user folders
+        '''
+        by_name = {}
+        by_type = {}
+        for (folder_id, parent_id, name, folder_type) in folders:
+            by_name[(parent_id, name)] = folder_id
+            if folder_type is not None and folder_type not in by_type:
+                by_type[folder_type] = folder_id
+        # Swap the indexes at once for the lookups running meanwhile
+        (self.by_name, self.by_type) = (by_name, by_type)
+        self.updated = time.time()
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        fdescr = open(self.path, 'rb')
+        try:
+            data = pickle.load(fdescr)
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, ValueError):
+            return
+        finally:
+            fdescr.close()
+        if not isinstance(data, dict) or data.get('version') != FolderCache.VERSION:
+            return
+        self.updated = data['updated']
+        self.by_name = data['by_name']
+        self.by_type = data['by_type']
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {'version': FolderCache.VERSION,
+                'updated': self.updated,
+                'by_name': self.by_name,
+                'by_type': self.by_type}
+        tmp_path = '%s.tmp' % self.path
+        fdescr = open(tmp_path, 'wb')
+        pickle.dump(data, fdescr, pickle.HIGHEST_PROTOCOL)
+        fdescr.close()
+        os.rename(tmp_path, self.path)
+
+def is_stale_connection(error):
+    '''
+    @result: True if the error shows that the server closed a kept-alive
+             connection without reading the request, so that sending it
+             again can't run it twice. Timeouts and errors after the first
+             response bytes are not.
+    '''
+    if isinstance(error, httplib.BadStatusLine):
+        # The connection was closed before the status line, not a
+        # malformed one. Python 2.7.16 replaced the empty line by a message.
+        return not error.line or \
+               error.line.startswith('No status line received')
+    if isinstance(error, httplib.CannotSendRequest):
+        return True
+    return isinstance(error, socket.error) and \
+           error.errno in (errno.EPIPE, errno.ECONNRESET)
+
 class GwSoapClient(object):
-    def __init__(self, server, port, username, passwd):
+    '''
+    GroupWise SOAP client. It keeps a pool of persistent HTTP connections
+    sharing the same SOAP session, so requests can be sent concurrently
+    from several threads, see map().
+    '''
+    # Errors meaning the server closed a kept-alive connection
+    CLOSED_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                     httplib.ResponseNotReady, httplib.IncompleteRead,
+                     socket.error)
+    # Size of the reads of the streamed responses
+    CHUNK_SIZE = 16*1024
+
+    def __init__(self, server, port, username, passwd, connections = 4,
+                 secure = True, folder_cache = None):
         self.server = server
         self.port = port
         self.username = username
         self.passwd = passwd
         self.session = None
+        self.session_lock = threading.Lock()
 
-        self.http = httplib.HTTPSConnection(server, port)
+        self.secure = secure
+        self.connections = max(connections, 1)
+        # Idle connections and number of connections that can still be opened
+        self.idle = Queue.LifoQueue()
+        self.available = threading.Semaphore(self.connections)
 
-    def createEnvelope(self, request):
+        self.folders = folder_cache
+        if self.folders is None:
+            self.folders = FolderCache()
+        self.folders.load()
+        self.folders_lock = threading.Lock()
+
+    def get_session(self):
+        return self._session
 
+    def set_session(self, session):
+        # The envelope head only depends on the session: build it once
+        self._session = session
         soap_header = ''
-        if self.session is not None:
-            soap_header = '<SOAP-ENV:Header><session>%s</session></SOAP-ENV:Header>' % self.session
+        if session is not None:
+            soap_header = ENVELOPE_SESSION % session
+        self.envelope_head = ENVELOPE_HEAD % soap_header
 
-        header = '''<?xml version="1.0" encoding="UTF-8"?>
-<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ns1="http://schemas.novell.com/2005/01/GroupWise/types" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:ns2="http://schemas.novell.com/2005/01/GroupWise/methods">
-%s
-<SOAP-ENV:Body>''' % (soap_header)
+    session = property(get_session, set_session)
 
-        footer = '''</SOAP-ENV:Body></SOAP-ENV:Envelope>'''
+    def new_http(self):
+        if self.secure:
+            return httplib.HTTPSConnection(self.server, self.port)
+        return httplib.HTTPConnection(self.server, self.port)
 
-        body = '%s%s%s' % (header, request, footer)
-        return body
+    def get_http(self):
+        '''
+        Takes a connection from the pool, waiting for one if they are all
+        in use.
+        '''
+        self.available.acquire()
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return self.new_http()
 
-    def request(self, request, body):
+    def release_http(self, http):
+        if http is not None:
+            self.idle.put(http)
+        self.available.release()
+
+    def createEnvelope(self, request):
+        return ''.join((self.envelope_head, request, ENVELOPE_FOOTER))
+
+    def send(self, http, request, body):
+        '''
+        Sends a request on a pooled connection.
+
+        @result: the connection used, which may be a new one if the server
+                 closed the kept-alive one, and the response to read
+        '''
         headers = {'SOAPAction': request, \
                    'Content-Type': 'text/xml;charset=utf-8'}
         envelope = self.createEnvelope(body)
-        self.http.request('POST', '/soap', envelope, headers)
+        # Only a connection already used may have been closed while idle
+        reused = http.sock is not None
+        try:
+            http.request('POST', '/soap', envelope, headers)
+            return (http, http.getresponse())
+        except Exception, e:
+            if not reused or not is_stale_connection(e):
+                raise
 
-        response = self.http.getresponse()
-        response_body = response.read()
+        # The server closed the kept-alive connection before reading the
+        # request: send it once more on a new connection
+        http.close()
+        http = self.new_http()
+        try:
+            http.request('POST', '/soap', envelope, headers)
+            return (http, http.getresponse())
+        except:
+            http.close()
+            raise
+
+    def request(self, request, body):
+        http = self.get_http()
+        try:
+            (http, response) = self.send(http, request, body)
+            response_body = response.read()
+            if response.getheader('connection', '').lower() == 'close':
+                http.close()
+        except:
+            http.close()
+            self.release_http(None)
+            raise
+        self.release_http(http)
         return response_body
 
+    def iter_request(self, request, body, tag):
+        '''
+        Sends a request and parses its response while it is received.
+        The elements are cleared once the next one is asked for: the caller
+        has to extract what it needs from them before.
+
+        @tag: the tag of the elements to generate, like gw_tag('item')
+        @result: a generator of the tag elements of the response
+        '''
+        http = self.get_http()
+        response = None
+        try:
+            (http, response) = self.send(http, request, body)
+            parents = []
+            for (event, elem) in ET.iterparse(response, ('start', 'end')):
+                if event == 'start':
+                    parents.append(elem)
+                    continue
+                parents.pop()
+                if elem.tag == tag:
+                    yield elem
+                    # Drop the processed element to keep the tree small
+                    elem.clear()
+                    if len(parents) > 0:
+                        parents[-1].remove(elem)
+        except GeneratorExit:
+            # The caller stopped early: read the rest of the response to
+            # keep the connection alive
+            try:
+                while response is not None and \
+                      response.read(GwSoapClient.CHUNK_SIZE):
+                    pass
+            except GwSoapClient.CLOSED_ERRORS:
+                http.close()
+        except:
+            http.close()
+            self.release_http(None)
+            raise
+        if response is not None and \
+           response.getheader('connection', '').lower() == 'close':
+            http.close()
+        self.release_http(http)
+
+    def map(self, function, items):
+        '''
+        Calls function on all the items using as many threads as pooled
+        connections.
+
+        @result: the list of the results, in the items order
+        '''
+        items = list(items)
+        self.connect()
+        if self.connections <= 1 or len(items) <= 1:
+            return [function(item) for item in items]
+        pool = ThreadPool(min(self.connections, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.terminate()
+            pool.join()
+
     def connect(self):
         if self.session is not None:
             # Already connected
             return
 
+        with self.session_lock:
+            if self.session is None:
+                self.login()
+
+    def login(self):
         login_request = '''
             <ns2:loginRequest>
               <ns2:auth xsi:type="ns1:PlainText">
@@ -178,24 +1515,29 @@ class GwSoapClient(object):
               </ns2:auth>
             </ns2:loginRequest>''' % (self.username, self.passwd)
 
-        response = self.request('loginRequest', login_request)
-
-        root = ET.fromstring(response)
-        ns = {'gwm': 'http://schemas.novell.com/2005/01/GroupWise/methods', \
-              'gwt': 'http://schemas.novell.com/2005/01/GroupWise/types'}
-        result = root.findall('.//gwm:loginResponse/gwm:session', ns)
+        session = None
+        for elem in self.iter_request('loginRequest', login_request,
+                                      gw_tag('session', GW_METHODS_NS)):
+            session = elem.text
 
-        if len(result) == 0:
+        if session is None:
             raise SoapException('Failed to login')
-        self.session = result[0].text
+        self.session = session
 
     def logout(self):
         if self.session is None:
             # Not connected, so need to disconnect
             return
 
-        request = '<ns2:logoutRequest>'
+        request = '<ns2:logoutRequest/>'
         self.request('logoutRequest', request)
+        self.session = None
+
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
 
     def get_item(self, itemid):
         # autoconnect
@@ -206,54 +1548,368 @@ class GwSoapClient(object):
 <ns2:getItemRequest>
   <ns2:id>%s</ns2:id>
 </ns2:getItemRequest>''' % itemid
-        response = self.request('getItemRequest', request)
-        print response
+        return self.request('getItemRequest', request)
 
-    def get_folder_id_by_type(self, folder_type):
+    def get_items(self, itemids):
+        '''
+        Gets several items concurrently.
+
+        @result: the list of the responses, in the itemids order
+        '''
+        return self.map(self.get_item, itemids)
+
+    def iter_items(self, container, view = None, filter = None):
+        '''
+        Lists the items of a folder without loading the whole response.
+
+        @view: the space separated names of the fields to get
+        @filter: the XML of a ns2:filter element
+        @result: a generator of the item elements, see iter_request()
+        '''
+        # autoconnect
+        if self.session is None:
+            self.connect()
+
+        request = ['<ns2:getItemsRequest>',
+                   '<ns2:container>%s</ns2:container>' % container]
+        if view is not None:
+            request.append('<ns2:view>%s</ns2:view>' % view)
+        if filter is not None:
+            request.append(filter)
+        request.append('</ns2:getItemsRequest>')
+        return self.iter_request('getItemsRequest', ''.join(request),
+                                 gw_tag('item'))
+
+    def load_folders(self):
+        '''
+        Fills the folder cache with a recursive listing of all the folders.
+        '''
         # autoconnect
         if self.session is None:
             self.connect()
 
         request = '''
-<ns2:getFolderRequest>
-  <ns2:folderType>%s</ns2:folderType>
-</ns2:getFolderRequest>''' % folder_type
-        response = self.request('getFolderRequest', request)
+<ns2:getFolderListRequest>
+  <ns2:parent>folders</ns2:parent>
+  <ns2:recurse>true</ns2:recurse>
+</ns2:getFolderListRequest>'''
 
-        root = ET.fromstring(response)
-        ns = {'gwm': 'http://schemas.novell.com/2005/01/GroupWise/methods', \
-              'gwt': 'http://schemas.novell.com/2005/01/GroupWise/types'}
-        ids = root.findall('.//gwm:getFolderResponse/gwm:folder/gwt:id', ns)
+        folders = []
+        for folder in self.iter_request('getFolderListRequest', request,
+                                        gw_tag('folder')):
+            folders.append((folder.findtext('./gwt:id', None, GW_NS),
+                            folder.findtext('./gwt:parent', 'folders', GW_NS),
+                            folder.findtext('./gwt:name', None, GW_NS),
+                            folder.findtext('./gwt:folderType', None, GW_NS)))
+        with self.folders_lock:
+            self.folders.fill(folders)
+            self.folders.save()
 
-        print ids
+    def find_folder(self, index, key):
+        '''
+        Looks for a folder in the cache, the cache is reloaded if it is stale
+        or if the folder isn't found as the folders may have changed.
 
-        result = None
-        if len(ids) > 0:
-            result = ids[0].text
+        @result: the folder id or None if the folder doesn't exist
+        '''
+        reloaded = False
+        if not self.folders.is_fresh():
+            self.load_folders()
+            reloaded = True
+        result = getattr(self.folders, index).get(key)
+        if result is None and not reloaded:
+            self.load_folders()
+            result = getattr(self.folders, index).get(key)
         return result
 
+    def get_folder_id_by_type(self, folder_type):
+        result = self.find_folder('by_type', folder_type)
+        if result is not None:
+            return result
 
-    def get_folder_id(self, parent_id, name):
-        # autoconnect
-        if self.session is None:
-            self.connect()
+        # The listing doesn't always give the type of the folders
+        request = '''
+<ns2:getFolderRequest>
+  <ns2:folderType>%s</ns2:folderType>
+</ns2:getFolderRequest>''' % folder_type
+
+        for folder in self.iter_request('getFolderRequest', request,
+                                        gw_tag('folder', GW_METHODS_NS)):
+            result = folder.findtext('./gwt:id', None, GW_NS)
+            break
+        if result is not None:
+            with self.folders_lock:
+                self.folders.by_type[folder_type] = result
+                self.folders.save()
+        return result
 
+    def get_folder_id(self, parent_id, name):
         if parent_id is None:
             parent_id = 'folders'
-        request = '''
-<ns2:getFolderListRequest>
-  <ns2:parent>%s</ns2:parent>
-</ns2:getFolderListRequest>''' % parent_id
-        response = self.request('getFolderListRequest', request)
-
-        root = ET.fromstring(response)
-        ns = {'gwm': 'http://schemas.novell.com/2005/01/GroupWise/methods', \
-              'gwt': 'http://schemas.novell.com/2005/01/GroupWise/types'}
-        folders = root.findall('.//gwm:getFolderListResponse/gwm:folders/gwt:folder', ns)
-
-        result = None
-        for folder in folders:
-            if folder.findall('./gwt:name', ns)[0].text == name:
-                result = folder.findall('./gwt:id', ns)[0].text
+        return self.find_folder('by_name', (parent_id, name))
+
+    def get_folder_id_by_path(self, path):
+        '''
+        @path: slash separated names of the folders from the root
+        @result: the folder id or None if the folder doesn't exist
+        '''
+        folder_id = None
+        for name in path.strip('/').split('/'):
+            folder_id = self.get_folder_id(folder_id, name)
+            if folder_id is None:
                 break
-        return result
+        return folder_id
+
+def ical_text(value):
+    '''
+    @result: value escaped as an iCalendar TEXT value
+    '''
+    return value.replace('\\', '\\\\').replace(';', '\\;') \
+                .replace(',', '\\,').replace('\n', '\\n').replace('\r', '')
+
+def soap_date(value, all_day=False):
+    '''
+    Converts a SOAP date like 2013-01-07T08:00:00Z to its iCalendar form.
+    '''
+    value = value.replace('-', '').replace(':', '')
+    if all_day:
+        return ';VALUE=DATE:%s' % value[:8]
+    return ':%s' % value
+
+def soap_address(elem):
+    name = elem.findtext('./gwt:displayName', '', GW_NS)
+    address = elem.findtext('./gwt:email', '', GW_NS)
+    if name:
+        return ';CN="%s":MAILTO:%s' % (name.replace('"', '\''), address)
+    return ':MAILTO:%s' % address
+
+def soap_part_text(part):
+    '''
+    Decodes a base64 message part with the charset of its content type,
+    or UTF-8 if it has none.
+
+    @result: the unicode text, the undecodable bytes being replaced
+    '''
+    content = base64.b64decode(part.text)
+    charset = 'utf-8'
+    match = CHARSET_RE.search(part.get('contentType', ''))
+    if match is not None:
+        charset = match.group(1)
+    try:
+        return content.decode(charset, 'replace')
+    except LookupError:
+        # Unknown charset
+        return content.decode('utf-8', 'replace')
+
+def soap_item_to_ical(item):
+    '''
+    Converts an appointment element of a getItemsResponse to the lines
+    of the matching VEVENT.
+
+    @result: the lines or None if the item isn't an appointment
+    '''
+    item_type = item.get('{http://www.w3.org/2001/XMLSchema-instance}type', '')
+    if item_type and not item_type.endswith('Appointment'):
+        return None
+
+    item_id = item.findtext('./gwt:id', None, GW_NS)
+    uid = item.findtext('./gwt:iCalId', item_id, GW_NS)
+    all_day = item.findtext('./gwt:allDayEvent', '0', GW_NS) in ('1', 'true')
+    lines = ['BEGIN:VEVENT',
+             'UID:%s' % uid,
+             'X-GWRECORDID:%s' % item_id]
+
+    modified = item.findtext('./gwt:modified', None, GW_NS)
+    if modified is not None:
+        lines.append('DTSTAMP%s' % soap_date(modified))
+    for (tag, name) in (('startDate', 'DTSTART'), ('endDate', 'DTEND')):
+        value = item.findtext('./gwt:%s' % tag, None, GW_NS)
+        if value is not None:
+            lines.append('%s%s' % (name, soap_date(value, all_day)))
+    if item.findtext('./gwt:recurrenceKey', '0', GW_NS) not in ('', '0'):
+        # All the instances of a recurring appointment share the iCalId
+        lines.append('RECURRENCE-ID%s' % soap_date(
+            item.findtext('./gwt:startDate', '', GW_NS), all_day))
+
+    for (tag, name) in (('subject', 'SUMMARY'), ('place', 'LOCATION')):
+        value = item.findtext('./gwt:%s' % tag, None, GW_NS)
+        if value:
+            lines.append('%s:%s' % (name, ical_text(value)))
+    for part in item.findall('./gwt:message/gwt:part', GW_NS):
+        content_type = part.get('contentType', 'text/plain').split(';')[0]
+        if content_type.strip().lower() == 'text/plain' and part.text:
+            description = soap_part_text(part)
+            lines.append('DESCRIPTION:%s' %
+                         ical_text(description).encode('utf-8'))
+            break
+
+    sender = item.find('./gwt:distribution/gwt:from', GW_NS)
+    if sender is not None:
+        lines.append('ORGANIZER%s' % soap_address(sender))
+    for recipient in item.findall('./gwt:distribution/gwt:recipients/gwt:recipient',
+                                  GW_NS):
+        role = 'REQ-PARTICIPANT'
+        if recipient.findtext('./gwt:distType', 'TO', GW_NS) != 'TO':
+            role = 'OPT-PARTICIPANT'
+        partstat = 'NEEDS-ACTION'
+        if recipient.find('./gwt:recipientStatus/gwt:accepted', GW_NS) is not None:
+            partstat = 'ACCEPTED'
+        elif recipient.find('./gwt:recipientStatus/gwt:declined', GW_NS) is not None:
+            partstat = 'DECLINED'
+        lines.append('ATTENDEE;PARTSTAT=%s;ROLE=%s%s' %
+                     (partstat, role, soap_address(recipient)))
+    lines.append('END:VEVENT')
+    return [line.encode('utf-8') if isinstance(line, unicode) else line
+            for line in lines]
+
+class GWSoapConnection(object):
+    '''
+    Calendar source using the GroupWise SOAP API. Unlike IMAP, it can ask
+    for the appointments modified since the previous synchronization, so
+    only the changed ones are transferred. Deleted appointments are found
+    by listing the item ids of the calendar folder.
+
+    The SOAP items have no attachment content: the events have no ATTACH.
+    '''
+    # Fields of the appointments needed to build the events
+    VIEW = 'id iCalId modified startDate endDate allDayEvent recurrenceKey ' \
+           'subject place message distribution'
+
+    def __init__(self, server, port, debug = False, connections = 4,
+                 secure = True, folder_cache_path = None):
+        self.server = server
+        self.port = port
+        self.connections = connections
+        self.secure = secure
+        self.folder_cache_path = folder_cache_path
+        self.is_debug = debug
+        self.client = None
+        self.folder = None
+        self.registry = TimezoneRegistry()
+        self.metrics = Metrics()
+
+    def debug(self, message, *args):
+        if self.is_debug:
+            if len(args) > 0:
+                message = message % args
+            print >> sys.stderr, message
+
+    def connect(self, login, passwd):
+        with self.metrics.timer('connect'):
+            self.client = GwSoapClient(self.server, self.port, login, passwd,
+                                       self.connections, self.secure,
+                                       FolderCache(self.folder_cache_path))
+            self.client.connect()
+            self.folder = self.client.get_folder_id_by_type('Calendar')
+        if self.folder is None:
+            raise SoapException('No calendar folder')
+        self.debug('Calendar folder: %s', self.folder)
+
+    def logout(self):
+        if self.client is not None:
+            self.client.logout()
+
+    def get_item_ids(self):
+        '''
+        @result: the set of the ids of the items of the calendar folder
+        '''
+        with self.metrics.timer('soap_ids'):
+            ids = set()
+            for item in self.client.iter_items(self.folder, 'id'):
+                ids.add(item.findtext('./gwt:id', None, GW_NS))
+        return ids
+
+    def iter_changes(self, since):
+        '''
+        Generator yielding the (item id, modification date, event) tuples
+        of the appointments modified since the given date, or of all of
+        them if since is None.
+        '''
+        filter = None
+        if since is not None:
+            # Items modified at the very same second may not have been all
+            # seen: ask for them again
+            filter = '<ns2:filter><ns1:element xsi:type="ns1:FilterEntry">' \
+                     '<ns1:op>gte</ns1:op><ns1:field>modified</ns1:field>' \
+                     '<ns1:value>%s</ns1:value></ns1:element></ns2:filter>' % since
+        calendar = Calendar(registry=self.registry)
+        for item in self.client.iter_items(self.folder, GWSoapConnection.VIEW,
+                                           filter):
+            lines = soap_item_to_ical(item)
+            if lines is None:
+                continue
+            for event in calendar.iter_parse(lines, []):
+                yield (item.findtext('./gwt:id', None, GW_NS),
+                       item.findtext('./gwt:modified', None, GW_NS), event)
+
+    def sync(self, state):
+        '''
+        Updates the synchronization state with the calendar folder content.
+
+        @result: True if a full resynchronization has been done
+        '''
+        full = not state.is_valid(self.folder)
+        if full:
+            state.reset(self.folder)
+        else:
+            current = self.get_item_ids()
+            deleted = [item_id for item_id in state.items
+                       if item_id not in current]
+            self.debug('Deleted items: %s', deleted)
+            state.remove(deleted)
+            self.metrics.incr('soap_deleted', len(deleted))
+
+        with self.metrics.timer('soap_changes'):
+            for (item_id, modified, event) in self.iter_changes(state.modified):
+                state.add(item_id, modified, event)
+                self.metrics.incr('soap_items')
+        return full
+
+    def dump(self, path, state_path=None, metrics_path=None, start=None,
+             end=None):
+        '''
+        Writes the calendar to path, or stdout if None.
+
+        @state_path: file keeping the synchronization state between runs
+        @metrics_path: file where to write the metrics of the run
+        @start, end: only write the events with an occurrence in
+                     [start, end), naive UTC datetimes or None
+        '''
+        if path is not None:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+        state = SoapSyncState(state_path)
+        with self.metrics.timer('state_load'):
+            state.load()
+
+        with self.metrics.timer('sync'):
+            full = self.sync(state)
+        self.metrics.incr('full_sync' if full else 'incremental_sync')
+
+        calendar = Calendar()
+        for item_id in sorted(state.items):
+            calendar.events.append(state.items[item_id][1])
+        if start is not None or end is not None:
+            with self.metrics.timer('occurrences'):
+                calendar.restrict(start, end)
+        self.metrics.incr('events', len(calendar.events))
+
+        if path is not None:
+            fp = open(path, 'w')
+        else:
+            fp = sys.stdout
+
+        with self.metrics.timer('output'):
+            calendar.write_ical(fp)
+
+        if path is not None:
+            fp.close()
+
+        with self.metrics.timer('state_save'):
+            state.save()
+
+        self.debug('%s', self.metrics.summary())
+        if metrics_path is not None:
+            self.metrics.write(metrics_path)
@@ -0,0 +1,220 @@
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import os
+import os.path
+import Queue
+import random
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+from connection import GWConnection
+from metrics import Metrics
+
+class Account(object):
+    '''
+    A GroupWise mailbox to dump, keeping its IMAP connection between runs.
+    '''
+
+    def __init__(self, name, gw, ics, state, mailbox='Calendar',
+                 metrics=None, settings=None, debug=False):
+        '''
+        @gw: the gw dictionary of the account configuration file
+        @ics, state, metrics: paths of the dumped calendar, of the
+                              synchronization state and of the metrics
+        @settings: additional GWConnection parameters like batch_size
+        '''
+        self.name = name
+        self.gw = gw
+        self.ics = ics
+        self.state = state
+        self.mailbox = mailbox
+        self.metrics = metrics
+        self.settings = settings or {}
+        self.is_debug = debug
+        self.connection = None
+        # Number of consecutive failed runs
+        self.failures = 0
+        self.last_duration = None
+
+    def sync(self):
+        '''
+        Dumps the calendar, reusing the connection of the previous run
+        if there is one.
+        '''
+        try:
+            if self.connection is None:
+                self.connection = GWConnection(self.gw['imap'], self.is_debug,
+                                               port=self.gw.get('port'),
+                                               ssl=self.gw.get('ssl', True),
+                                               **self.settings)
+                self.connection.connect(self.gw['login'], self.gw['password'],
+                                        self.mailbox)
+            else:
+                self.connection.metrics = Metrics()
+                self.connection.refresh()
+            self.connection.dump(self.ics, self.state, self.metrics)
+        except:
+            # The next run starts from a new connection
+            self.close()
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.logout()
+            self.connection = None
+
+def load_account(path, output_dir, settings=None, debug=False):
+    '''
+    Reads an account configuration file, in the groupwise-to-ics format.
+    Its optional sync dictionary can set the ics, state and metrics paths
+    and the mailbox. The files are written by default in a directory of
+    output_dir named like the configuration file.
+
+    @result: the Account
+    '''
+    config = {}
+    execfile(path, {}, config)
+    gw = config.get('gw') or {}
+    for key in ('imap', 'login', 'password'):
+        if gw.get(key) is None:
+            raise ValueError('%s needs to define gw.%s' % (path, key))
+
+    name = os.path.basename(path)
+    sync = config.get('sync') or {}
+    account_dir = os.path.join(output_dir, name)
+    return Account(name, gw,
+                   sync.get('ics', os.path.join(account_dir, 'calendar.ics')),
+                   sync.get('state', os.path.join(account_dir, 'state')),
+                   sync.get('mailbox', 'Calendar'), sync.get('metrics'),
+                   settings, debug)
+
+class SyncDaemon(object):
+    '''
+    Dumps the calendars of several accounts every interval seconds, with
+    at most workers of them synchronized at the same time. The runs are
+    spread by a random jitter, a fraction of the interval, so that the
+    accounts don't all hit the server at once.
+
+    A failed run is retried with an exponential backoff from retry
+    seconds, without affecting the other accounts.
+    '''
+
+    def __init__(self, accounts, workers=8, interval=900, jitter=0.1,
+                 retry=60, debug=False):
+        self.accounts = accounts
+        self.workers = workers
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self.is_debug = debug
+        # Indexes of the accounts whose run is finished
+        self.done = Queue.Queue()
+        self.stopped = threading.Event()
+
+    def debug(self, message, *args):
+        if self.is_debug:
+            if args:
+                message = message % args
+            print >> sys.stderr, 'DEBUG %s\n' % (message)
+
+    def get_delay(self, account):
+        '''
+        @result: the number of seconds before the next run of the account
+        '''
+        delay = self.interval
+        if account.failures > 0:
+            delay = min(delay, self.retry * 2 ** (account.failures - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run_account(self, index):
+        '''
+        Synchronizes an account, its errors are only reported.
+
+        @result: the index of the account
+        '''
+        account = self.accounts[index]
+        start = time.time()
+        try:
+            account.sync()
+            account.failures = 0
+        except Exception, e:
+            account.failures += 1
+            print >> sys.stderr, 'Synchronizing %s failed (%d in a row): %s' % \
+                (account.name, account.failures, e)
+            self.debug('%s', traceback.format_exc())
+        account.last_duration = time.time() - start
+        self.debug('%s synchronized in %.2f s', account.name,
+                   account.last_duration)
+        return index
+
+    def run_once(self):
+        '''
+        Synchronizes all the accounts once.
+
+        @result: the number of accounts whose synchronization failed
+        '''
+        pool = ThreadPool(max(min(self.workers, len(self.accounts)), 1))
+        try:
+            pool.map(self.run_account, range(len(self.accounts)))
+        finally:
+            pool.close()
+            pool.join()
+        return len([account for account in self.accounts
+                    if account.failures > 0])
+
+    def run(self):
+        '''
+        Synchronizes the accounts until stop() is called, then waits for
+        the running synchronizations and closes the connections.
+        '''
+        now = time.time()
+        schedule = [(now + random.uniform(0, self.interval * self.jitter), index)
+                    for index in range(len(self.accounts))]
+        heapq.heapify(schedule)
+        pool = ThreadPool(max(self.workers, 1))
+        try:
+            while not self.stopped.is_set():
+                now = time.time()
+                while len(schedule) > 0 and schedule[0][0] <= now:
+                    (due, index) = heapq.heappop(schedule)
+                    pool.apply_async(self.run_account, (index,),
+                                     callback=self.done.put)
+
+                # Wake up regularly: blocking without a timeout would
+                # delay the signals handling
+                timeout = 1.0
+                if len(schedule) > 0:
+                    timeout = max(min(schedule[0][0] - now, timeout), 0)
+                try:
+                    index = self.done.get(timeout=timeout)
+                except Queue.Empty:
+                    continue
+                if index is not None:
+                    delay = self.get_delay(self.accounts[index])
+                    heapq.heappush(schedule, (time.time() + delay, index))
+        finally:
+            pool.close()
+            pool.join()
+            for account in self.accounts:
+                account.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.done.put(None)
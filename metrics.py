@@ -0,0 +1,151 @@
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+class Metrics(object):
+    '''
+    Counters, timers and per-message outliers of a synchronization run.
+    All the methods can be called from several threads.
+    '''
+    # Number of messages kept for each outliers list
+    OUTLIERS = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = {}
+        # Timer name -> [count, total seconds, max seconds]
+        self.timers = {}
+        # Outliers name -> heap of (value, message uid)
+        self.outliers = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def observe(self, name, mail_uid, value):
+        '''
+        Records a per-message value, only the OUTLIERS highest are kept.
+        '''
+        with self.lock:
+            heap = self.outliers.setdefault(name, [])
+            if len(heap) < Metrics.OUTLIERS:
+                heapq.heappush(heap, (value, mail_uid))
+            elif value > heap[0][0]:
+                heapq.heapreplace(heap, (value, mail_uid))
+
+    def to_dict(self):
+        with self.lock:
+            timers = {}
+            for (name, (count, total, maximum)) in self.timers.items():
+                timers[name] = {'count': count, 'seconds': total, 'max': maximum}
+            outliers = {}
+            for (name, heap) in self.outliers.items():
+                outliers[name] = [{'uid': mail_uid, 'value': value}
+                                  for (value, mail_uid) in sorted(heap, reverse=True)]
+            return {'duration': time.time() - self.start,
+                    'counters': dict(self.counters),
+                    'timers': timers,
+                    'outliers': outliers}
+
+    def to_prometheus(self, prefix='groupwise_ics'):
+        '''
+        @result: the metrics in the Prometheus text format
+        '''
+        data = self.to_dict()
+        lines = ['# TYPE %s_duration_seconds gauge' % prefix,
+                 '%s_duration_seconds %f' % (prefix, data['duration'])]
+        for name in sorted(data['counters']):
+            metric = '%s_%s_total' % (prefix, metric_name(name))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, data['counters'][name]))
+        for name in sorted(data['timers']):
+            timer = data['timers'][name]
+            metric = '%s_%s_seconds' % (prefix, metric_name(name))
+            lines.append('# TYPE %s summary' % metric)
+            lines.append('%s_sum %f' % (metric, timer['seconds']))
+            lines.append('%s_count %d' % (metric, timer['count']))
+            lines.append('# TYPE %s_max gauge' % metric)
+            lines.append('%s_max %f' % (metric, timer['max']))
+        for name in sorted(data['outliers']):
+            metric = '%s_outlier_%s' % (prefix, metric_name(name))
+            lines.append('# TYPE %s gauge' % metric)
+            for outlier in data['outliers'][name]:
+                lines.append('%s{uid="%s"} %s' % (metric, outlier['uid'],
+                                                  outlier['value']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''
+        Writes the metrics to a file: in the Prometheus text format if its
+        name ends with .prom, as JSON otherwise. The file is replaced
+        atomically as the Prometheus textfile collector may read it anytime.
+        '''
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        tmp_path = '%s.tmp' % path
+        fdescr = open(tmp_path, 'w')
+        fdescr.write(content)
+        fdescr.close()
+        os.rename(tmp_path, path)
+
+    def summary(self):
+        '''
+        @result: a short human readable summary of the timers and counters
+        '''
+        data = self.to_dict()
+        lines = ['Run duration: %.2f s' % data['duration']]
+        for name in sorted(data['timers']):
+            timer = data['timers'][name]
+            lines.append('  %-20s %8.3f s in %d calls (max %.3f s)' %
+                         (name, timer['seconds'], timer['count'], timer['max']))
+        for name in sorted(data['counters']):
+            lines.append('  %-20s %d' % (name, data['counters'][name]))
+        for name in sorted(data['outliers']):
+            values = ['%s: %s' % (outlier['uid'], outlier['value'])
+                      for outlier in data['outliers'][name][:3]]
+            lines.append('  %-20s %s' % ('top ' + name, ', '.join(values)))
+        return '\n'.join(lines)
+
+def metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
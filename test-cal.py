@@ -18,6 +18,14 @@
 
 import unittest
 import datetime
+import StringIO
+import email.encoders
+import email.mime.base
+import email.message
+import os.path
+import tempfile
+import shutil
+import uu
 import cal
 
 def tzdetails_from_dict(values):
@@ -125,6 +133,44 @@ class CalendarTest(unittest.TestCase):
         actual = tested.utcoffset(datetime.datetime(2014, 6, 21, 9, 0, 0))
         self.assertEqual(actual, datetime.timedelta(hours=-6))
 
+        # Test the first transition and dates after the precomputed horizon
+        summer = datetime.datetime(2000, 6, 21, 9, 0, 0)
+        self.assertEqual(tested.utcoffset(summer), datetime.timedelta(hours=-6))
+        far_summer = datetime.datetime(2080, 6, 21, 9, 0, 0)
+        self.assertEqual(tested.utcoffset(far_summer), datetime.timedelta(hours=-6))
+        far_winter = datetime.datetime(2080, 12, 21, 9, 0, 0)
+        self.assertEqual(tested.utcoffset(far_winter), datetime.timedelta(hours=-7))
+
+        # Test the DST and names
+        self.assertEqual(tested.dst(far_summer), datetime.timedelta(hours=1))
+        self.assertEqual(tested.dst(far_winter), datetime.timedelta(0))
+        self.assertEqual(tested.tzname(far_summer), 'Mountain Daylight Time')
+        self.assertEqual(tested.tzname(far_winter), 'Mountain Standard Time')
+
+    def test_split_contentline(self):
+        self.assertEqual(cal.split_contentline('SUMMARY:some;value:here'),
+                         ('SUMMARY', [], 'some;value:here'))
+        self.assertEqual(cal.split_contentline('DTSTART;VALUE=DATE:20131008'),
+                         ('DTSTART', [('VALUE', 'DATE')], '20131008'))
+        self.assertEqual(cal.split_contentline('ATTENDEE;CN="Hacker; Joe: Mr";RSVP:MAILTO:joe@hacker.com'),
+                         ('ATTENDEE', [('CN', '"Hacker; Joe: Mr"'), ('RSVP', None)], 'MAILTO:joe@hacker.com'))
+        self.assertEqual(cal.split_contentline('END'), ('END', [], None))
+
+    def test_parse_params(self):
+        header = 'cn="Joe Hacker";RSVP'
+        self.assertEqual(cal.parse_params(header), {'CN': '"Joe Hacker"'})
+        # The cached parameters are not changed through the result
+        cal.parse_params(header)['CN'] = 'Bob'
+        self.assertEqual(cal.parse_params(header), {'CN': '"Joe Hacker"'})
+        self.assertEqual(cal.parse_params('CN="Hacker; Joe"'), None)
+
+    def test_parse_quoted_organizer(self):
+        event = cal.Event()
+        event.parseline(['ORGANIZER;CN="Hacker; Joe: Mr":MAILTO:joe@hacker.com'],
+                        'ORGANIZER;CN="Hacker; Joe: Mr":MAILTO:joe@hacker.com', [])
+        self.assertEqual(event.organizer,
+                         create_parametrized_value({'CN': '"Hacker; Joe: Mr"'}, 'MAILTO:joe@hacker.com'))
+
     def test_parametrized_values_equals(self):
         parametrized_values1 = [ create_parametrized_value( {'CUTYPE': 'INDIVIDUAL', 'ROLE': 'REQ-PARTICIPANT', \
                                                'PARTSTAT': 'ACCEPTED', 'RSVP': 'TRUE', \
@@ -140,6 +186,52 @@ class CalendarTest(unittest.TestCase):
                                                'CN': 'Joe HACKER', 'LANGUAGE': 'en'}, 'MAILTO:joe@hacker.com' ) ]
         self.assertTrue( len(set(parametrized_values1) ^ set(parametrized_values2)) == 0 )
 
+    def test_events_by_uid(self):
+        calendar = cal.Calendar()
+        for uid in ('a', 'b', 'c'):
+            event = cal.Event()
+            event.uid = uid
+            calendar.events.append(event)
+
+        def get_uids():
+            return sorted(calendar.get_events_by_uid())
+        self.assertEqual(['a', 'b', 'c'], get_uids())
+
+        # The index follows the changes of the list and of the events
+        other = cal.Event()
+        other.uid = 'd'
+        calendar.events[0] = other
+        self.assertEqual(['b', 'c', 'd'], get_uids())
+        calendar.events[1].uid = 'e'
+        self.assertEqual(['c', 'd', 'e'], get_uids())
+        calendar.events[2].gwrecordid = 'f'
+        self.assertEqual(['d', 'e', 'f'], get_uids())
+        del calendar.events[0]
+        self.assertEqual(['e', 'f'], get_uids())
+        calendar.events = [other]
+        self.assertEqual(['d'], get_uids())
+
+    def test_event_fingerprint(self):
+        first = cal.Event()
+        first.uid = 'some-uid'
+        first.summary = 'test summary'
+        first.attendees = [ create_parametrized_value( {'CN': 'Joe', 'ROLE': 'CHAIR'}, 'MAILTO:joe@hacker.com' ),
+                            create_parametrized_value( {'CN': 'Alice'}, 'MAILTO:alice@hacker.com' ) ]
+
+        second = cal.Event()
+        second.summary = 'test summary'
+        second.uid = 'some-uid'
+        second.attendees = [ create_parametrized_value( {'CN': 'Alice'}, 'MAILTO:alice@hacker.com' ),
+                             create_parametrized_value( {'ROLE': 'CHAIR', 'CN': 'Joe'}, 'MAILTO:joe@hacker.com' ) ]
+
+        self.assertEqual(first.fingerprint, second.fingerprint)
+        self.assertEqual(first, second)
+
+        # Changing a property needs to update the fingerprint
+        second.summary = 'changed summary'
+        self.assertNotEqual(first.fingerprint, second.fingerprint)
+        self.assertNotEqual(first, second)
+
     def test_parse_event(self):
         data = '\r\n'.join(['BEGIN:VCALENDAR',
                             'PRODID:-//Ximian//NONSGML Evolution Calendar//EN',
@@ -186,8 +278,8 @@ class CalendarTest(unittest.TestCase):
     def test_parse_mail_attachement(self):
         mail = load_from_file('tests/attach.eml')
         files = {}
-        def output_files(name, content):
-            files[name] = content
+        def output_files(name, attachment):
+            files[name] = attachment.get_payload()
             return 'file:///mockup/%s' % name
 
         tested = cal.Calendar(mail, output_files)
@@ -198,6 +290,220 @@ class CalendarTest(unittest.TestCase):
         self.assertEqual(tested_event.attachments[0], expected)
         self.assertEqual(files[expected_name], 'some content')
 
+    def test_attachment_decode(self):
+        content = ''.join([chr(i % 256) for i in range(1000)])
+        text = 'caf\xc3\xa9 = cr\xc3\xa8me\n' * 50
+        def encode_uu(part):
+            output = StringIO.StringIO()
+            uu.encode(StringIO.StringIO(part.get_payload()), output, 'f.bin')
+            part.set_payload(output.getvalue())
+            part['Content-Transfer-Encoding'] = 'x-uuencode'
+
+        parts = []
+        for (payload, encoding) in ((content, email.encoders.encode_base64),
+                                    (text, email.encoders.encode_quopri),
+                                    (text, email.encoders.encode_7or8bit),
+                                    (content, encode_uu)):
+            part = email.mime.base.MIMEBase('application', 'octet-stream')
+            part.set_payload(payload)
+            encoding(part)
+            part.add_header('Content-Disposition', 'attachment', filename='f.bin')
+            parts.append((payload, cal.Attachment(part)))
+
+        chunk_size = cal.Attachment.CHUNK_SIZE
+        # Make sure the decoding works across chunks
+        cal.Attachment.CHUNK_SIZE = 7
+        try:
+            for (payload, attachment) in parts:
+                self.assertEqual('f.bin', attachment.filename)
+                self.assertEqual(payload, attachment.get_payload())
+                output = StringIO.StringIO()
+                attachment.write_to(output)
+                self.assertEqual(payload, output.getvalue())
+
+            # Like email, the badly encoded data is kept rather than dropped
+            part = email.message.Message()
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.set_payload('YWJj\nZ')
+            self.assertEqual('abcZ', cal.Attachment(part).get_payload())
+        finally:
+            cal.Attachment.CHUNK_SIZE = chunk_size
+
+    def test_timezone_registry(self):
+        paris = ['BEGIN:VTIMEZONE',
+                 'TZID:Europe/Paris',
+                 'BEGIN:STANDARD',
+                 'TZNAME:CET',
+                 'DTSTART:20131027T030000',
+                 'TZOFFSETFROM:+0200',
+                 'TZOFFSETTO:+0100',
+                 'END:STANDARD',
+                 'END:VTIMEZONE']
+        london = ['BEGIN:VTIMEZONE',
+                  'TZID:Europe/London',
+                  'BEGIN:STANDARD',
+                  'TZNAME:GMT',
+                  'DTSTART:20131027T020000',
+                  'TZOFFSETFROM:+0100',
+                  'TZOFFSETTO:+0000',
+                  'END:STANDARD',
+                  'END:VTIMEZONE']
+        data = '\r\n'.join(['BEGIN:VCALENDAR',
+                            'VERSION:2.0'] + paris + london +
+                           ['BEGIN:VEVENT',
+                            'UID:tz-event-uid',
+                            'DTSTAMP:20131007T194119Z',
+                            'DTSTART;TZID=Europe/Paris:20131108T130000',
+                            'DTEND;TZID=Europe/Paris:20131108T133000',
+                            'SUMMARY:test summary',
+                            'END:VEVENT',
+                            'END:VCALENDAR'])
+
+        registry = cal.TimezoneRegistry()
+        first = cal.Calendar(create_email(data), registry=registry)
+        second = cal.Calendar(create_email(data), registry=registry)
+
+        self.assertEqual(first.timezones['europe/paris'], paris)
+        self.assertEqual(first.timezones['europe/london'], london)
+        self.assertTrue(first.timezones['europe/paris'] is second.timezones['europe/paris'])
+        self.assertEqual(len(registry.definitions), 2)
+
+        # Only the referenced timezone is written
+        content = first.to_ical()
+        self.assertTrue('\r\n'.join(paris) in content)
+        self.assertFalse('TZID:Europe/London' in content)
+
+    def test_read_file(self):
+        mail = load_from_file('tests/attach.eml')
+        expected = cal.Calendar(mail, lambda name, content: 'file:///mockup/%s' % name)
+        content = expected.to_ical()
+
+        path = os.path.join(tempfile.mkdtemp(), 'test.ics')
+        fdescr = open(path, 'w')
+        fdescr.write(content)
+        fdescr.close()
+
+        # From a path
+        tested = cal.Calendar()
+        tested.read_file(path)
+        self.assertEqual(tested.events, expected.events)
+        self.assertEqual(tested.to_ical(), content)
+
+        # Incrementally from a file object
+        fdescr = open(path, 'r')
+        events = list(cal.Calendar().iter_file(fdescr))
+        fdescr.close()
+        self.assertEqual(events, expected.events)
+
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_calendar_write_ical(self):
+        mail = load_from_file('tests/attach.eml')
+        tested = cal.Calendar(mail, lambda name, content: 'file:///mockup/%s' % name)
+
+        out = StringIO.StringIO()
+        tested.write_ical(out)
+        content = out.getvalue()
+
+        self.assertEqual(content, tested.to_ical())
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(content.endswith('END:VEVENT\r\nEND:VCALENDAR\r\n'))
+        self.assertTrue('\r\nATTACH:file:///mockup/recordid/foo.txt\r\n' in content)
+
+    def test_occurrence_index(self):
+        ical = '\r\n'.join(['BEGIN:VCALENDAR',
+                             'BEGIN:VTIMEZONE',
+                             'TZID:Paris',
+                             'BEGIN:STANDARD',
+                             'DTSTART:16011028T030000',
+                             'RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10',
+                             'TZOFFSETFROM:+0200',
+                             'TZOFFSETTO:+0100',
+                             'END:STANDARD',
+                             'BEGIN:DAYLIGHT',
+                             'DTSTART:16010325T020000',
+                             'RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3',
+                             'TZOFFSETFROM:+0100',
+                             'TZOFFSETTO:+0200',
+                             'END:DAYLIGHT',
+                             'END:VTIMEZONE',
+                             'BEGIN:VEVENT',
+                             'UID:single',
+                             'DTSTART:20130107T080000Z',
+                             'DTEND:20130107T090000Z',
+                             'END:VEVENT',
+                             'BEGIN:VEVENT',
+                             'UID:weekly',
+                             'DTSTART;TZID=Paris:20130301T100000',
+                             'DURATION:PT1H',
+                             'RRULE:FREQ=WEEKLY;UNTIL=20130412T090000Z',
+                             'EXDATE;TZID=Paris:20130308T100000',
+                             'RDATE:20130601T120000Z',
+                             'END:VEVENT',
+                             'BEGIN:VEVENT',
+                             'UID:allday',
+                             'DTSTART;VALUE=DATE:20130310',
+                             'END:VEVENT',
+                             'END:VCALENDAR'])
+        calendar = cal.Calendar()
+        calendar.parse(ical, [])
+        index = cal.OccurrenceIndex(calendar)
+
+        def search(start, end):
+            return [event.uid for event in index.search(start, end)]
+        date = datetime.datetime
+        self.assertEqual(['single'], search(date(2013, 1, 7, 8, 30), date(2013, 1, 8)))
+        self.assertEqual([], search(date(2013, 1, 7, 9), date(2013, 3, 1)))
+        # The excluded occurrence and the recurrences after UNTIL
+        self.assertEqual([], search(date(2013, 3, 8), date(2013, 3, 9)))
+        self.assertEqual([], search(date(2013, 4, 19), date(2013, 4, 20)))
+        # The local time is kept over the DST change
+        self.assertEqual(['weekly'], search(date(2013, 3, 1, 9), date(2013, 3, 1, 9, 1)))
+        self.assertEqual(['weekly'], search(date(2013, 4, 12, 8), date(2013, 4, 12, 8, 1)))
+        self.assertEqual(['weekly', 'allday'], search(date(2013, 3, 10, 23), date(2013, 3, 16)))
+        self.assertEqual(['weekly'], search(date(2013, 6, 1), date(2013, 6, 2)))
+
+        calendar.restrict(date(2013, 3, 9))
+        self.assertEqual(['weekly', 'allday'], [event.uid for event in calendar.events])
+
+    def test_occurrence_index_open_ended(self):
+        ical = '\r\n'.join(['BEGIN:VCALENDAR',
+                             'BEGIN:VEVENT',
+                             'UID:weekly',
+                             'DTSTART:20130301T100000Z',
+                             'DTEND:20130301T110000Z',
+                             'RRULE:FREQ=WEEKLY',
+                             'END:VEVENT',
+                             'BEGIN:VEVENT',
+                             'UID:long',
+                             'DTSTART:20130101T000000Z',
+                             'DTEND:20200101T000000Z',
+                             'END:VEVENT',
+                             'BEGIN:VEVENT',
+                             'UID:single',
+                             'DTSTART:20150107T080000Z',
+                             'DTEND:20150107T090000Z',
+                             'END:VEVENT',
+                             'END:VCALENDAR'])
+        calendar = cal.Calendar()
+        calendar.parse(ical, [])
+        index = cal.OccurrenceIndex(calendar)
+
+        def search(start, end):
+            return [event.uid for event in index.search(start, end)]
+        date = datetime.datetime
+        self.assertEqual(['weekly', 'long'], search(date(2015, 1, 8), date(2015, 1, 15)))
+        self.assertEqual(['long', 'single'], search(date(2015, 1, 7), date(2015, 1, 7, 9)))
+        self.assertEqual(['weekly'], search(date(2020, 1, 1), date(2020, 1, 8)))
+
+        # Only a start after the horizon: the endless rule still matches
+        self.assertEqual(['weekly'], search(date(2040, 1, 1), date.max))
+        self.assertEqual(['weekly'], search(date(2040, 1, 1), date(2040, 2, 1)))
+        self.assertEqual(['weekly'], search(date(2090, 1, 1), date.max))
+
+        calendar.restrict(date(2040, 1, 1))
+        self.assertEqual(['weekly'], [event.uid for event in calendar.events])
+
     def test_calendar_diff_added(self):
         data_old = '\r\n'.join(['BEGIN:VCALENDAR',
                             'PRODID:-//Ximian//NONSGML Evolution Calendar//EN',
@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os.path
+import sys
+import tempfile
+import shutil
+import datetime
+import email.message
+import imaplib
+import imp
+import socket
+import subprocess
+import time
+
+TOP_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOP_DIR, 'tests'))
+sys.path.insert(0, os.path.join(TOP_DIR, 'benchmarks'))
+
+import cal
+import connection
+import daemon
+import metrics
+import gwgen
+import imapserver
+import soapserver
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+def make_attachment(content):
+    part = email.message.Message()
+    part.set_payload(content)
+    return cal.Attachment(part)
+
+def get_fingerprints(content):
+    '''
+    The events parameters order may change through the state file, so
+    compare the events rather than the dumped text.
+    '''
+    calendar = cal.Calendar()
+    calendar.parse(content, [])
+    return sorted([event.fingerprint for event in calendar.events])
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mails = [mail for (date, mail) in
+                      gwgen.generate_mails({'events': 30, 'versions': 2,
+                                            'attachments': 0.2,
+                                            'attachment_size': 20000})]
+        self.mailbox = imapserver.Mailbox()
+        self.server = imapserver.IMAPServer(('127.0.0.1', 0), self.mailbox)
+        self.server.start()
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+    def dump(self, name, state=None, **kwargs):
+        cnx = connection.GWConnection('127.0.0.1', port=self.server.server_address[1],
+                                      ssl=False, **kwargs)
+        cnx.connect('user', 'password', 'Calendar')
+        path = os.path.join(self.workdir, name, 'calendar.ics')
+        if state is not None:
+            state = os.path.join(self.workdir, state)
+        cnx.dump(path, state)
+        cnx.logout()
+        fdescr = open(path, 'r')
+        content = fdescr.read()
+        fdescr.close()
+        return content
+
+    def test_dump(self):
+        for mail in self.mails:
+            self.mailbox.append(mail)
+
+        content = self.dump('out', batch_size=1)
+        calendar = cal.Calendar()
+        calendar.parse(content, [])
+        self.assertEqual(30, len(calendar.events))
+
+        # The batches and sessions only change the way the mails are fetched
+        self.server.stats.reset()
+        self.assertEqual(content, self.dump('out', batch_size=7))
+        self.assertEqual(9, self.server.stats.commands['UID FETCH'])
+        self.assertEqual(content, self.dump('out', batch_size=7,
+                                            connections=3))
+
+    def test_parallel_dump_fresh_interpreter(self):
+        # strptime is first called from the fetching threads: it must not
+        # depend on a lazy import made by one of them
+        check = 'import sys; import connection; ' \
+                'sys.exit(0 if "_strptime" in sys.modules else 1)'
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', check],
+                                            cwd=TOP_DIR))
+
+        for mail in self.mails:
+            self.mailbox.append(mail)
+        config = os.path.join(self.workdir, 'config')
+        fdescr = open(config, 'w')
+        fdescr.write("gw = {'imap': '127.0.0.1', 'port': %d, 'ssl': False, "
+                     "'login': 'user', 'password': 'password'}\n" %
+                     self.server.server_address[1])
+        fdescr.close()
+        path = os.path.join(self.workdir, 'parallel', 'calendar.ics')
+        self.assertEqual(0, subprocess.call([sys.executable,
+                                             os.path.join(TOP_DIR, 'groupwise-to-ics'),
+                                             '--config', config, '--ics', path,
+                                             '--connections', '4',
+                                             '--batch-size', '5']))
+        fdescr = open(path, 'r')
+        content = fdescr.read()
+        fdescr.close()
+        self.assertEqual(get_fingerprints(self.dump('out')),
+                         get_fingerprints(content))
+
+    def test_uid_after_literal(self):
+        for mail in self.mails:
+            self.mailbox.append(mail)
+        content = self.dump('out')
+
+        self.server.uid_last = True
+        self.assertEqual(content, self.dump('out', 'state'))
+        self.assertEqual(content, self.dump('out', partial=True))
+
+    def test_partial_fetch(self):
+        for mail in self.mails:
+            self.mailbox.append(mail)
+
+        content = self.dump('out')
+        full_bytes = self.server.stats.bytes_out
+        self.server.stats.reset()
+        self.assertEqual(content, self.dump('out', partial=True))
+
+        # The attachments already in the store are not fetched again
+        self.server.stats.reset()
+        self.assertEqual(content, self.dump('out', partial=True, batch_size=1))
+        self.assertTrue(self.server.stats.bytes_out * 2 < full_bytes)
+
+    def test_incremental_dump(self):
+        for mail in self.mails[:40]:
+            self.mailbox.append(mail)
+        self.dump('out', 'state')
+
+        for mail in self.mails[40:]:
+            self.mailbox.append(mail)
+        self.mailbox.expunge([1, 2, 3])
+        self.server.stats.reset()
+        content = self.dump('out', 'state')
+        self.assertEqual(1, self.server.stats.commands['UID FETCH'])
+
+        self.assertEqual(get_fingerprints(self.dump('full')),
+                         get_fingerprints(content))
+
+    def test_new_uids_search(self):
+        for mail in self.mails[:40]:
+            self.mailbox.append(mail)
+        self.dump('out', 'state')
+        self.assertEqual(['(ALL)'], self.server.searches)
+
+        # Only the UIDs above the last one seen are searched
+        for mail in self.mails[40:50]:
+            self.mailbox.append(mail)
+        self.server.searches = []
+        content = self.dump('out', 'state')
+        self.assertEqual(['UID 41:*'], self.server.searches)
+        self.assertEqual(get_fingerprints(self.dump('full')),
+                         get_fingerprints(content))
+
+        # Nothing new: '*' matches the last UID, which is not fetched again
+        self.server.searches = []
+        self.server.stats.reset()
+        self.dump('out', 'state')
+        self.assertEqual(['UID 51:*'], self.server.searches)
+        self.assertEqual(0, self.server.stats.commands.get('UID FETCH', 0))
+
+        # The message count reveals the expunged mails
+        for mail in self.mails[50:]:
+            self.mailbox.append(mail)
+        self.mailbox.expunge([3, 45])
+        self.server.searches = []
+        content = self.dump('out', 'state')
+        self.assertEqual(['UID 51:*', '(ALL)'], self.server.searches)
+        self.assertEqual(get_fingerprints(self.dump('full')),
+                         get_fingerprints(content))
+
+    def test_uidvalidity_change(self):
+        for mail in self.mails[:10]:
+            self.mailbox.append(mail)
+        self.dump('out', 'state')
+
+        self.mailbox.reset(2)
+        for mail in self.mails[10:]:
+            self.mailbox.append(mail)
+        content = self.dump('out', 'state')
+
+        self.assertEqual(get_fingerprints(self.dump('full')),
+                         get_fingerprints(content))
+
+    def test_two_phase(self):
+        for mail in self.mails[:40]:
+            self.mailbox.append(mail)
+        content = self.dump('out')
+        self.server.stats.reset()
+        self.assertEqual(content, self.dump('out', partial=True))
+        partial_bytes = self.server.stats.bytes_out
+
+        # Only the calendar parts of the older versions are transferred
+        self.server.stats.reset()
+        self.assertEqual(content, self.dump('out', 'state', two_phase=True))
+        self.assertTrue(self.server.stats.bytes_out < partial_bytes)
+
+        # The older versions are fetched if the newest ones are expunged
+        newest = [uid for (uid, data, date) in self.mailbox.snapshot()[1][-5:]]
+        for mail in self.mails[40:]:
+            self.mailbox.append(mail)
+        self.mailbox.expunge(newest)
+        content = self.dump('out', 'state', two_phase=True)
+        self.assertEqual(get_fingerprints(self.dump('full')),
+                         get_fingerprints(content))
+
+    def test_search_dates(self):
+        mails = list(gwgen.generate_mails({'events': 30, 'versions': 2}))
+        for (date, mail) in mails:
+            self.mailbox.append(mail)
+        since = mails[20][0].replace(hour=0, minute=0, second=0)
+        before = mails[40][0].replace(hour=0, minute=0, second=0)
+        expected = len([date for (date, mail) in mails if since <= date < before])
+
+        self.server.stats.reset()
+        self.dump('out', 'state', batch_size=1, since=since, before=before)
+        self.assertEqual(expected, self.server.stats.commands['UID FETCH'])
+
+        # Moving the dates only fetches the mails newly in the period
+        self.server.stats.reset()
+        content = self.dump('out', 'state', batch_size=1, since=since, sent=True)
+        newer = len([date for (date, mail) in mails if date >= before])
+        self.assertEqual(newer, self.server.stats.commands['UID FETCH'])
+        self.assertEqual(get_fingerprints(self.dump('full', since=since)),
+                         get_fingerprints(content))
+
+    def test_search_refused(self):
+        for mail in self.mails:
+            self.mailbox.append(mail)
+        self.dump('out', 'state')
+        state = os.path.join(self.workdir, 'state')
+        fdescr = open(state, 'r')
+        content = fdescr.read()
+        fdescr.close()
+
+        # The refused search must not be taken for an empty mailbox
+        self.server.refuse_search = True
+        try:
+            self.dump('out', 'state', since=datetime.datetime(2013, 1, 1))
+            self.fail('The refused search has not been detected')
+        except imaplib.IMAP4.error, e:
+            self.assertTrue('SINCE 1-Jan-2013' in str(e))
+        fdescr = open(state, 'r')
+        self.assertEqual(content, fdescr.read())
+        fdescr.close()
+
+    def test_batch_fetch_refused(self):
+        for mail in self.mails:
+            self.mailbox.append(mail)
+        expected = get_fingerprints(self.dump('full'))
+
+        # The mails are fetched one by one instead
+        self.server.refuse_batch_fetch = True
+        for options in ({}, {'partial': True}, {'two_phase': True}):
+            state = 'state-%s' % '-'.join(options)
+            content = self.dump('out', state, batch_size=7, **options)
+            self.assertEqual(expected, get_fingerprints(content))
+
+            # All of them have been recorded in the state
+            self.server.stats.reset()
+            self.dump('out', state, batch_size=7, **options)
+            self.assertEqual(0, self.server.stats.commands.get('UID FETCH', 0))
+
+    def test_batch_fetch_incomplete(self):
+        for mail in self.mails:
+            self.mailbox.append(mail)
+        expected = get_fingerprints(self.dump('full'))
+
+        self.server.omitted = set([2, 9, 10, 31])
+        for options in ({}, {'partial': True}, {'two_phase': True}):
+            content = self.dump('out', batch_size=7, **options)
+            self.assertEqual(expected, get_fingerprints(content))
+
+    def test_attachment_store(self):
+        path = os.path.join(self.workdir, 'attachments')
+        store = connection.AttachmentStore(path)
+        first = store.write('1/slides.pdf', make_attachment('content'))
+        second = store.write('2/copy.pdf', make_attachment('content'))
+        old = store.write('1/slides.pdf', make_attachment('old content'))
+        self.assertTrue(first.startswith('file://%s' % os.path.join(path, '1')))
+        self.assertTrue(first.endswith('/slides.pdf'))
+        self.assertNotEqual(first, old)
+        self.assertEqual(2, store.written)
+
+        # Only the referenced attachments are linked, the blobs of the
+        # other ones are kept as they have been seen
+        self.assertEqual(0, store.collect([first, second]))
+        self.assertEqual(2, store.linked)
+        self.assertTrue(os.path.samefile(first[7:], second[7:]))
+        self.assertFalse(os.path.exists(old[7:]))
+        fdescr = open(first[7:], 'r')
+        self.assertEqual('content', fdescr.read())
+        fdescr.close()
+
+        # Nothing is written again for unchanged attachments, the no longer
+        # referenced copy and the old blob are removed
+        store = connection.AttachmentStore(path)
+        self.assertEqual(first, store.write('1/slides.pdf', make_attachment('content')))
+        self.assertEqual(2, store.collect([first]))
+        self.assertEqual(0, store.written)
+        self.assertEqual(0, store.linked)
+
+        # Unreferenced attachments and blobs are removed
+        self.assertEqual(2, connection.AttachmentStore(path).collect([]))
+        self.assertEqual([], os.listdir(path))
+
+    def test_metrics(self):
+        run = metrics.Metrics()
+        run.incr('imap_bytes', 10)
+        run.incr('imap_bytes', 5)
+        run.add_time('parse', 0.5)
+        run.add_time('parse', 1.5)
+        for uid in range(20):
+            run.observe('message_bytes', uid, uid * 100)
+
+        data = run.to_dict()
+        self.assertEqual(15, data['counters']['imap_bytes'])
+        self.assertEqual({'count': 2, 'seconds': 2.0, 'max': 1.5},
+                         data['timers']['parse'])
+        outliers = data['outliers']['message_bytes']
+        self.assertEqual(metrics.Metrics.OUTLIERS, len(outliers))
+        self.assertEqual({'uid': 19, 'value': 1900}, outliers[0])
+
+        prometheus = run.to_prometheus().split('\n')
+        self.assertTrue('groupwise_ics_imap_bytes_total 15' in prometheus)
+        self.assertTrue('groupwise_ics_parse_seconds_count 2' in prometheus)
+        self.assertTrue('groupwise_ics_outlier_message_bytes{uid="19"} 1900' in prometheus)
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mails = [mail for (date, mail) in
+                      gwgen.generate_mails({'events': 10, 'versions': 2})]
+        self.servers = []
+        for i in range(2):
+            server = imapserver.IMAPServer(('127.0.0.1', 0), imapserver.Mailbox())
+            server.start()
+            self.servers.append(server)
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.workdir)
+
+    def write_config(self, name, port):
+        path = os.path.join(self.workdir, name)
+        fdescr = open(path, 'w')
+        fdescr.write("gw = {'imap': '127.0.0.1', 'port': %d, 'ssl': False, "
+                     "'login': '%s', 'password': 'password'}\n" % (port, name))
+        fdescr.close()
+        return daemon.load_account(path, os.path.join(self.workdir, 'out'))
+
+    def count_events(self, account):
+        fdescr = open(account.ics, 'r')
+        calendar = cal.Calendar()
+        calendar.parse(fdescr.read(), [])
+        fdescr.close()
+        return len(calendar.events)
+
+    def test_run_once(self):
+        for server in self.servers:
+            for mail in self.mails[:10]:
+                server.mailbox.append(mail)
+        # Nothing listens on the port of the closed socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        closed_port = sock.getsockname()[1]
+        sock.close()
+        accounts = [self.write_config('first', self.servers[0].server_address[1]),
+                    self.write_config('broken', closed_port),
+                    self.write_config('second', self.servers[1].server_address[1])]
+        sync = daemon.SyncDaemon(accounts, workers=2)
+
+        # A failing account doesn't prevent the other ones to be synchronized
+        self.assertEqual(1, sync.run_once())
+        self.assertEqual(1, accounts[1].failures)
+        self.assertTrue(self.count_events(accounts[0]) > 0)
+        self.assertTrue(self.count_events(accounts[2]) > 0)
+
+        # The connections are reused by the next run
+        for mail in self.mails[10:]:
+            self.servers[0].mailbox.append(mail)
+        self.assertEqual(1, sync.run_once())
+        self.assertEqual(2, accounts[1].failures)
+        self.assertEqual(1, self.servers[0].stats.sessions)
+        self.assertEqual(10, self.count_events(accounts[0]))
+
+        # A connection closed by the server is opened again
+        accounts[2].connection.imap.shutdown()
+        self.assertEqual(1, sync.run_once())
+        self.assertEqual(0, accounts[2].failures)
+        self.assertEqual(2, self.servers[1].stats.sessions)
+        for account in accounts:
+            account.close()
+
+def write_events(path, summaries):
+    lines = ['BEGIN:VCALENDAR']
+    for (index, summary) in enumerate(summaries):
+        lines.extend(['BEGIN:VEVENT',
+                      'UID:event-%d@hacker.com' % index,
+                      'DTSTART:20130107T080000Z',
+                      'SUMMARY:%s' % summary,
+                      'END:VEVENT'])
+    lines.append('END:VCALENDAR')
+    fdescr = open(path, 'w')
+    fdescr.write('\r\n'.join(lines))
+    fdescr.close()
+
+@unittest.skipIf(pyinotify is None, 'pyinotify is needed by ics-to-groupwise')
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        # Not compiled: the script name has no .py extension
+        sys.dont_write_bytecode = True
+        try:
+            self.script = imp.load_source('ics_to_groupwise',
+                                          os.path.join(TOP_DIR, 'ics-to-groupwise'))
+        finally:
+            sys.dont_write_bytecode = False
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_debounce(self):
+        cached = os.path.join(self.workdir, 'cached.ics')
+        path = os.path.join(self.workdir, 'calendar.ics')
+        write_events(cached, ['Meeting', 'Lunch'])
+        write_events(path, ['Meeting', 'Changed lunch'])
+        handler = self.script.EventHandler(old_path=cached, delay=0.2)
+        pushes = []
+        def push_changes(changed, removed, added):
+            pushes.append((len(changed), len(removed), len(added)))
+            return self.pushed
+        handler.push_changes = push_changes
+        self.pushed = False
+
+        # A burst of events is only processed once it is over
+        for i in range(3):
+            handler.changed(path)
+            handler.flush()
+        self.assertEqual([], pushes)
+        time.sleep(0.3)
+        handler.flush()
+        handler.flush()
+        self.assertEqual([(1, 0, 0)], pushes)
+
+        # An unchanged file isn't diffed again
+        handler.changed(path)
+        time.sleep(0.3)
+        handler.flush()
+        self.assertEqual([(1, 0, 0)], pushes)
+
+        # The changes not pushed stay in the next diff
+        write_events(path, ['Meeting', 'Changed lunch', 'Dinner'])
+        handler.changed(path)
+        time.sleep(0.3)
+        handler.flush()
+        self.assertEqual([(1, 0, 0), (1, 0, 1)], pushes)
+        self.assertNotEqual(open(cached).read(), open(path).read())
+
+        # The baseline is only rolled once the changes are pushed
+        self.pushed = True
+        write_events(path, ['Meeting', 'Changed lunch', 'Late dinner'])
+        handler.changed(path)
+        time.sleep(0.3)
+        handler.flush()
+        self.assertEqual((1, 0, 1), pushes[-1])
+        self.assertEqual(open(cached).read(), open(path).read())
+        write_events(path, ['Meeting', 'Changed lunch', 'Late dinner', 'Breakfast'])
+        handler.changed(path)
+        time.sleep(0.3)
+        handler.flush()
+        self.assertEqual((0, 0, 1), pushes[-1])
+
+class SoapConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = soapserver.Folder()
+        self.ids = [self.folder.add(soapserver.make_appointment(index))
+                    for index in range(20)]
+        self.server = soapserver.SoapServer(('127.0.0.1', 0), self.folder)
+        self.server.start()
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+    def dump(self, name, state=None):
+        cnx = connection.GWSoapConnection('127.0.0.1', self.server.server_address[1],
+                                          secure=False)
+        cnx.connect('user', 'password')
+        path = os.path.join(self.workdir, name, 'calendar.ics')
+        if state is not None:
+            state = os.path.join(self.workdir, state)
+        cnx.dump(path, state)
+        cnx.logout()
+        fdescr = open(path, 'r')
+        content = fdescr.read()
+        fdescr.close()
+        return content
+
+    def test_dump(self):
+        calendar = cal.Calendar()
+        calendar.parse(self.dump('out'), [])
+        self.assertEqual(20, len(calendar.events))
+        event = calendar.events[0]
+        self.assertEqual('00000000-soap-0@hacker.com', event.uid)
+        self.assertEqual(':20130107T080000Z', event.dtstart)
+        self.assertEqual('Room 0\\, floor 0', event.location)
+        self.assertEqual(1, len(event.attendees))
+
+    def test_incremental_dump(self):
+        self.dump('out', 'state')
+
+        self.folder.update(self.ids[3], subject='Changed meeting')
+        self.folder.delete(self.ids[5])
+        self.folder.add(soapserver.make_appointment(20))
+        self.server.stats.reset()
+        content = self.dump('out', 'state')
+
+        # Only the changed items are transferred, with the last one of the
+        # previous run, plus the ids to find the deleted ones
+        self.assertEqual(20 + 3, self.server.stats.items)
+        self.assertTrue('SUMMARY:Changed meeting' in content)
+        self.assertEqual(get_fingerprints(self.dump('full')),
+                         get_fingerprints(content))
+
+    def test_message_charsets(self):
+        self.folder.update(self.ids[1], message='Caf\xe9 cr\xe8me',
+                           charset='iso-8859-1')
+        # Not UTF-8 and without charset
+        self.folder.update(self.ids[2], message='Caf\xe9 cr\xe8me')
+        calendar = cal.Calendar()
+        calendar.parse(self.dump('out', 'state'), [])
+        events = calendar.get_events_by_uid()
+        self.assertEqual(20, len(events))
+        self.assertEqual(u'Caf\xe9 cr\xe8me',
+                         events[self.ids[1]].description.decode('utf-8'))
+        self.assertEqual(u'Caf\ufffd cr\ufffdme',
+                         events[self.ids[2]].description.decode('utf-8'))
+
+    def test_folder_cache(self):
+        path = os.path.join(self.workdir, 'folders')
+        def get_client():
+            return connection.GwSoapClient('127.0.0.1', self.server.server_address[1],
+                                           'user', 'password', secure=False,
+                                           folder_cache=connection.FolderCache(path))
+
+        client = get_client()
+        self.assertEqual(self.folder.folder_id, client.get_folder_id_by_type('Calendar'))
+        self.assertEqual('team.folder@1', client.get_folder_id_by_path('Calendar/Team'))
+        self.assertEqual(1, self.server.stats.requests['getFolderListRequest'])
+        client.logout()
+
+        # The cache is kept on disk, a missing folder reloads it
+        self.server.stats.reset()
+        client = get_client()
+        self.assertEqual('mailbox.folder@1', client.get_folder_id(None, 'Mailbox'))
+        self.assertEqual({}, self.server.stats.requests)
+        self.server.folders.append(('new.folder@1', 'folders', 'New', None))
+        self.assertEqual('new.folder@1', client.get_folder_id(None, 'New'))
+        self.assertEqual(1, self.server.stats.requests['getFolderListRequest'])
+
+        # Stale caches are reloaded
+        client.folders.ttl = 0
+        self.assertEqual('new.folder@1', client.get_folder_id(None, 'New'))
+        self.assertEqual(2, self.server.stats.requests['getFolderListRequest'])
+        client.logout()
+
+    def test_idle_connection_closed(self):
+        self.server.idle_timeout = 0.2
+        # Timeout of the client connections
+        socket.setdefaulttimeout(1)
+        try:
+            client = connection.GwSoapClient('127.0.0.1', self.server.server_address[1],
+                                             'user', 'password', connections=1,
+                                             secure=False)
+            client.connect()
+            time.sleep(0.5)
+
+            # The request is sent again, once, on a new connection
+            self.server.stats.reset()
+            self.assertEqual(self.folder.folder_id,
+                             client.get_folder_id_by_type('Calendar'))
+            self.assertEqual({'getFolderListRequest': 1}, self.server.stats.requests)
+            self.assertEqual(1, self.server.stats.connections)
+
+            # A request which may have been read by the server is not sent
+            # again
+            self.server.stats.reset()
+            self.server.idle_timeout = None
+            self.server.latency = 1.5
+            self.assertRaises(socket.timeout, client.get_folder_id, None, 'Missing')
+            time.sleep(1)
+            self.assertEqual({'getFolderListRequest': 1}, self.server.stats.requests)
+        finally:
+            socket.setdefaulttimeout(None)
+
+if __name__ == '__main__':
+    unittest.main()
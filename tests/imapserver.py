@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Minimal IMAP4rev1 server standing in for GroupWise: it serves a single
+# read-only mailbox and only knows the commands groupwise-to-ics needs.
+# Each command can be delayed and the responses throttled to mimic a
+# remote server.
+
+import SocketServer
+import email
+import email.utils
+import optparse
+import os
+import os.path
+import re
+import sys
+import threading
+import time
+
+LITERAL_RE = re.compile(r'\{(\d+)\}$')
+SECTION_RE = re.compile(r'^BODY(\.PEEK)?\[([0-9.]*)\]$', re.I)
+
+class Mailbox(object):
+    '''
+    Messages served by the IMAP server, as (uid, data, date) tuples
+    sorted by UID.
+    '''
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.lock = threading.Lock()
+        # UID -> parsed email message, for BODYSTRUCTURE and sections
+        self.parsed = {}
+
+    def get_message(self, uid, data):
+        with self.lock:
+            message = self.parsed.get(uid)
+            if message is None:
+                message = email.message_from_string(data)
+                self.parsed[uid] = message
+            return message
+
+    def append(self, data, date=None):
+        '''
+        Adds a message to the mailbox.
+
+        @date: the internal date of the message as a timestamp, the one
+               of its Date header by default
+        @result: the UID of the new message
+        '''
+        if date is None:
+            date = header_date(data)
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages.append((uid, data, date))
+        return uid
+
+    def expunge(self, uids):
+        with self.lock:
+            self.messages = [msg for msg in self.messages if msg[0] not in uids]
+
+    def reset(self, uidvalidity):
+        '''
+        Empties the mailbox and changes its UIDVALIDITY.
+        '''
+        with self.lock:
+            self.uidvalidity = uidvalidity
+            self.messages = []
+            self.next_uid = 1
+
+    def snapshot(self):
+        with self.lock:
+            return (self.uidvalidity, list(self.messages))
+
+    def load_dir(self, path):
+        '''
+        Appends all the files of a folder, in the order of their names.
+        '''
+        for name in sorted(os.listdir(path)):
+            fdescr = open(os.path.join(path, name), 'r')
+            self.append(fdescr.read())
+            fdescr.close()
+
+def header_date(data):
+    '''
+    @result: the timestamp of the Date header of a message or None
+    '''
+    match = re.search(r'^Date: (.*)$', data, re.M)
+    if match is not None:
+        parsed = email.utils.parsedate_tz(match.group(1).strip())
+        if parsed is not None:
+            return email.utils.mktime_tz(parsed)
+    return None
+
+def parse_search_date(value):
+    '''
+    @result: the (year, month, day) of an IMAP date like 7-Jan-2013
+    '''
+    parsed = time.strptime(value, '%d-%b-%Y')
+    return (parsed.tm_year, parsed.tm_mon, parsed.tm_mday)
+
+def get_day(timestamp):
+    return time.gmtime(timestamp or 0)[:3]
+
+class Stats(object):
+    '''
+    Counters of the server activity, shared by all the sessions.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.sessions = 0
+        self.commands = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def count(self, name, bytes_in):
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+            self.bytes_in += bytes_in
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_out += size
+
+    def round_trips(self):
+        return sum(self.commands.values())
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'sessions': self.sessions,
+                'commands': dict(self.commands),
+                'round_trips': sum(self.commands.values()),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+def parse_sequence_set(value, maximum):
+    '''
+    Parses an IMAP sequence set like '1:3,5,7:*' where * is maximum.
+
+    @result: a list of (first, last) ranges
+    '''
+    ranges = []
+    for item in value.split(','):
+        bounds = [maximum if bound == '*' else int(bound) for bound in item.split(':')]
+        ranges.append((min(bounds), max(bounds)))
+    return ranges
+
+def in_ranges(number, ranges):
+    for (first, last) in ranges:
+        if first <= number <= last:
+            return True
+    return False
+
+def split_items(value):
+    '''
+    Splits a FETCH items list like '(UID BODY.PEEK[HEADER.FIELDS (DATE)])'
+    on the spaces outside brackets.
+    '''
+    value = value.strip()
+    if value.startswith('(') and value.endswith(')'):
+        value = value[1:-1]
+    items = []
+    current = []
+    depth = 0
+    for char in value:
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        if char == ' ' and depth == 0:
+            if current:
+                items.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    if current:
+        items.append(''.join(current))
+    return items
+
+def split_arguments(value):
+    '''
+    Splits command arguments, honouring quoted strings and parenthesized
+    lists which are kept as a single argument.
+    '''
+    args = []
+    i = 0
+    length = len(value)
+    while i < length:
+        char = value[i]
+        if char == ' ':
+            i += 1
+        elif char == '"':
+            end = i + 1
+            chars = []
+            while end < length and value[end] != '"':
+                if value[end] == '\\':
+                    end += 1
+                chars.append(value[end])
+                end += 1
+            args.append(''.join(chars))
+            i = end + 1
+        elif char == '(':
+            depth = 0
+            end = i
+            while end < length:
+                if value[end] == '(':
+                    depth += 1
+                elif value[end] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            args.append(value[i:end + 1])
+            i = end + 1
+        else:
+            end = value.find(' ', i)
+            if end < 0:
+                end = length
+            args.append(value[i:end])
+            i = end
+    return args
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def quote_params(params):
+    if not params:
+        return 'NIL'
+    return '(%s)' % ' '.join(['%s %s' % (quote(key.upper()), quote(value))
+                              for (key, value) in params])
+
+def body_structure(part):
+    '''
+    @result: the BODYSTRUCTURE of an email message part, with the
+             extension data
+    '''
+    disposition = 'NIL'
+    header = part.get('Content-Disposition')
+    if header is not None:
+        params = part.get_params(header='content-disposition') or []
+        disposition = '(%s %s)' % (quote(params[0][0].upper()),
+                                   quote_params(params[1:]))
+
+    if part.is_multipart():
+        children = ''.join([body_structure(child) for child in part.get_payload()])
+        return '(%s %s %s %s NIL NIL)' % (children, quote(part.get_content_subtype().upper()),
+                                          quote_params((part.get_params() or [])[1:]),
+                                          disposition)
+
+    payload = part.get_payload()
+    encoding = part.get('Content-Transfer-Encoding', '7BIT').strip().upper()
+    fields = [quote(part.get_content_maintype().upper()),
+              quote(part.get_content_subtype().upper()),
+              quote_params((part.get_params() or [])[1:]),
+              quote(part.get('Content-ID')),
+              quote(part.get('Content-Description')),
+              quote(encoding),
+              str(len(payload))]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(payload.count('\n')))
+    fields.extend(['NIL', disposition, 'NIL', 'NIL'])
+    return '(%s)' % ' '.join(fields)
+
+def get_section(message, section):
+    '''
+    @result: the raw content of a numbered section like '1.2'
+    '''
+    if section == '':
+        return message.as_string()
+    part = message
+    for number in section.split('.'):
+        index = int(number) - 1
+        if part.is_multipart():
+            children = part.get_payload()
+            if index < 0 or index >= len(children):
+                return ''
+            part = children[index]
+        elif index != 0:
+            return ''
+    payload = part.get_payload()
+    if not isinstance(payload, basestring):
+        text = part.as_string()
+        return text[text.find('\n\n') + 2:]
+    return payload
+
+class CommandError(Exception):
+    pass
+
+class IMAPHandler(SocketServer.StreamRequestHandler):
+    '''
+    One IMAP session. The server attributes configure it: mailbox, stats,
+    latency in seconds added before each tagged response and bandwidth in
+    bytes per second, 0 for unlimited.
+    '''
+    # The responses are written in several small chunks
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.selected = None
+        with self.server.stats.lock:
+            self.server.stats.sessions += 1
+
+    def send(self, data):
+        bandwidth = self.server.bandwidth
+        if bandwidth > 0:
+            chunk = max(bandwidth / 20, 1024)
+            for start in xrange(0, len(data), chunk):
+                part = data[start:start + chunk]
+                self.wfile.write(part)
+                self.wfile.flush()
+                time.sleep(float(len(part)) / bandwidth)
+        else:
+            self.wfile.write(data)
+        self.server.stats.sent(len(data))
+
+    def untagged(self, line):
+        self.send('* %s\r\n' % line)
+
+    def read_command(self):
+        '''
+        Reads a command line, including the literals it may contain.
+        '''
+        line = self.rfile.readline()
+        if not line:
+            return None
+        size = len(line)
+        line = line.rstrip('\r\n')
+        match = LITERAL_RE.search(line)
+        while match is not None:
+            self.send('+ Ready for literal\r\n')
+            literal = self.rfile.read(int(match.group(1)))
+            rest = self.rfile.readline()
+            size += len(literal) + len(rest)
+            line = line[:match.start()] + '"%s"' % literal.replace('"', '\\"') + \
+                   rest.rstrip('\r\n')
+            match = LITERAL_RE.search(line)
+        return (line, size)
+
+    def handle(self):
+        self.send('* OK [CAPABILITY IMAP4rev1 IDLE] IMAP stand-in ready\r\n')
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            (line, size) = command
+            parts = line.split(' ', 2)
+            if len(parts) < 2:
+                self.send('* BAD Invalid command\r\n')
+                continue
+            tag = parts[0]
+            name = parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ''
+            if name == 'UID':
+                self.server.stats.count('UID %s' % args.split(' ', 1)[0].upper(),
+                                        size)
+            else:
+                self.server.stats.count(name, size)
+
+            if self.server.latency > 0:
+                time.sleep(self.server.latency)
+
+            method = getattr(self, 'do_%s' % name, None)
+            if method is None:
+                self.send('%s BAD Unknown command %s\r\n' % (tag, name))
+                continue
+            try:
+                result = method(tag, args)
+            except CommandError, e:
+                self.send('%s BAD %s\r\n' % (tag, e))
+                continue
+            except Exception, e:
+                self.send('%s NO %s\r\n' % (tag, e))
+                continue
+            if result is None:
+                return
+            self.send('%s %s\r\n' % (tag, result))
+
+    def require_selected(self):
+        if self.selected is None:
+            raise CommandError('No mailbox selected')
+
+    def do_CAPABILITY(self, tag, args):
+        self.untagged('CAPABILITY IMAP4rev1 IDLE')
+        return 'OK CAPABILITY completed'
+
+    def do_NOOP(self, tag, args):
+        return 'OK NOOP completed'
+
+    def do_LOGIN(self, tag, args):
+        credentials = split_arguments(args)
+        if len(credentials) != 2:
+            raise CommandError('LOGIN expects a user and a password')
+        if self.server.credentials is not None and \
+           tuple(credentials) != self.server.credentials:
+            return 'NO [AUTHENTICATIONFAILED] Invalid credentials'
+        return 'OK LOGIN completed'
+
+    def select(self, args, readonly):
+        names = split_arguments(args)
+        if len(names) != 1 or names[0] != self.server.mailbox_name:
+            return 'NO Mailbox does not exist'
+        self.selected = names[0]
+        (uidvalidity, messages) = self.server.mailbox.snapshot()
+        self.untagged('FLAGS (\\Seen \\Deleted)')
+        self.untagged('%d EXISTS' % len(messages))
+        self.untagged('0 RECENT')
+        self.untagged('OK [UIDVALIDITY %d] UIDs valid' % uidvalidity)
+        next_uid = 1
+        if len(messages) > 0:
+            next_uid = messages[-1][0] + 1
+        self.untagged('OK [UIDNEXT %d] Predicted next UID' % next_uid)
+        # The mailbox is never modified, but imaplib checks SELECT gives
+        # a writable one
+        if readonly:
+            return 'OK [READ-ONLY] EXAMINE completed'
+        return 'OK [READ-WRITE] SELECT completed'
+
+    def do_SELECT(self, tag, args):
+        return self.select(args, False)
+
+    def do_EXAMINE(self, tag, args):
+        return self.select(args, True)
+
+    def do_LOGOUT(self, tag, args):
+        self.untagged('BYE IMAP stand-in closing')
+        self.send('%s OK LOGOUT completed\r\n' % tag)
+        return None
+
+    def do_IDLE(self, tag, args):
+        self.require_selected()
+        self.send('+ idling\r\n')
+        (uidvalidity, messages) = self.server.mailbox.snapshot()
+        known = len(messages)
+        self.connection.settimeout(0.2)
+        try:
+            while True:
+                try:
+                    line = self.rfile.readline()
+                except Exception:
+                    (uidvalidity, messages) = self.server.mailbox.snapshot()
+                    if len(messages) != known:
+                        known = len(messages)
+                        self.untagged('%d EXISTS' % known)
+                    continue
+                if not line or line.strip().upper() == 'DONE':
+                    break
+        finally:
+            self.connection.settimeout(None)
+        return 'OK IDLE terminated'
+
+    def search(self, criteria, messages):
+        '''
+        @result: the indexes of the messages in the list matching
+                 the search criteria
+        '''
+        tokens = []
+        for token in split_arguments(criteria):
+            # All the keys of a parenthesized list must match too
+            if token.startswith('(') and token.endswith(')'):
+                tokens.extend(split_arguments(token[1:-1]))
+            else:
+                tokens.append(token)
+        if tokens and tokens[0].upper() == 'CHARSET':
+            tokens = tokens[2:]
+
+        # (key, day) tests, the day being compared to the internal date or
+        # to the Date header for the SENT keys, and (UID, ranges) tests
+        tests = []
+        i = 0
+        while i < len(tokens):
+            key = tokens[i].upper()
+            if key == 'ALL':
+                i += 1
+            elif key in ('SINCE', 'BEFORE', 'ON', 'SENTSINCE', 'SENTBEFORE',
+                         'SENTON') and i + 1 < len(tokens):
+                try:
+                    tests.append((key, parse_search_date(tokens[i + 1])))
+                except ValueError:
+                    raise CommandError('Invalid date %s' % tokens[i + 1])
+                i += 2
+            elif key == 'UID' and i + 1 < len(tokens):
+                maximum = messages[-1][0] if messages else 0
+                try:
+                    tests.append((key, parse_sequence_set(tokens[i + 1], maximum)))
+                except ValueError:
+                    raise CommandError('Invalid UID set %s' % tokens[i + 1])
+                i += 2
+            else:
+                raise CommandError('Unsupported search criteria %s' % key)
+
+        indexes = []
+        for (index, (uid, data, date)) in enumerate(messages):
+            matches = True
+            for (key, day) in tests:
+                if key == 'UID':
+                    if not in_ranges(uid, day):
+                        matches = False
+                        break
+                    continue
+                if key.startswith('SENT'):
+                    message_day = get_day(header_date(data))
+                    key = key[4:]
+                else:
+                    message_day = get_day(date)
+                if (key == 'SINCE' and message_day < day) or \
+                   (key == 'BEFORE' and message_day >= day) or \
+                   (key == 'ON' and message_day != day):
+                    matches = False
+                    break
+            if matches:
+                indexes.append(index)
+        return indexes
+
+    def do_SEARCH(self, tag, args, uid=False):
+        self.require_selected()
+        self.server.searches.append(args)
+        if self.server.refuse_search:
+            return 'NO SEARCH criteria not supported'
+        (uidvalidity, messages) = self.server.mailbox.snapshot()
+        numbers = []
+        for index in self.search(args, messages):
+            if uid:
+                numbers.append(str(messages[index][0]))
+            else:
+                numbers.append(str(index + 1))
+        self.untagged(' '.join(['SEARCH'] + numbers))
+        return 'OK SEARCH completed'
+
+    def fetch_item(self, item, uid, data, date):
+        '''
+        @result: the response string for a FETCH item of a message
+        '''
+        name = item.upper()
+        if name == 'UID':
+            return 'UID %d' % uid
+        if name == 'FLAGS':
+            return 'FLAGS (\\Seen)'
+        if name == 'RFC822.SIZE':
+            return 'RFC822.SIZE %d' % len(data)
+        if name == 'INTERNALDATE':
+            return 'INTERNALDATE "%s"' % time.strftime('%d-%b-%Y %H:%M:%S +0000',
+                                                       time.gmtime(date or 0))
+        if name in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+            label = name.replace('.PEEK', '')
+            return '%s {%d}\r\n%s' % (label, len(data), data)
+        if name == 'BODYSTRUCTURE':
+            message = self.server.mailbox.get_message(uid, data)
+            return 'BODYSTRUCTURE %s' % body_structure(message)
+        match = SECTION_RE.match(name)
+        if match is not None:
+            message = self.server.mailbox.get_message(uid, data)
+            content = get_section(message, match.group(2))
+            return 'BODY[%s] {%d}\r\n%s' % (match.group(2), len(content), content)
+        raise CommandError('Unsupported FETCH item %s' % item)
+
+    def do_FETCH(self, tag, args, uid=False):
+        self.require_selected()
+        args = args.split(' ', 1)
+        if len(args) != 2:
+            raise CommandError('FETCH expects a sequence set and items')
+        (uidvalidity, messages) = self.server.mailbox.snapshot()
+        items = split_items(args[1])
+        if uid and 'UID' not in [item.upper() for item in items]:
+            items.insert(0, 'UID')
+        if self.server.uid_last:
+            items = [item for item in items if item.upper() != 'UID'] + \
+                    [item for item in items if item.upper() == 'UID']
+
+        if uid:
+            maximum = messages[-1][0] if messages else 0
+        else:
+            maximum = len(messages)
+        ranges = parse_sequence_set(args[0], maximum)
+        several = ',' in args[0] or ':' in args[0]
+        if several and self.server.refuse_batch_fetch:
+            return 'NO FETCH of several messages failed'
+
+        for (index, (msg_uid, data, date)) in enumerate(messages):
+            number = msg_uid if uid else index + 1
+            if not in_ranges(number, ranges):
+                continue
+            if several and msg_uid in self.server.omitted:
+                continue
+            content = ' '.join([self.fetch_item(item, msg_uid, data, date)
+                                for item in items])
+            self.untagged('%d FETCH (%s)' % (index + 1, content))
+        return 'OK FETCH completed'
+
+    def do_UID(self, tag, args):
+        args = args.split(' ', 1)
+        name = args[0].upper()
+        rest = args[1] if len(args) > 1 else ''
+        if name == 'FETCH':
+            result = self.do_FETCH(tag, rest, uid=True)
+            if not result.startswith('OK'):
+                return result
+            return 'OK UID FETCH completed'
+        if name == 'SEARCH':
+            result = self.do_SEARCH(tag, rest, uid=True)
+            if not result.startswith('OK'):
+                return result
+            return 'OK UID SEARCH completed'
+        raise CommandError('Unsupported UID command %s' % name)
+
+class IMAPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''
+    IMAP stand-in server. Use port 0 to get a free port, then read it
+    from server_address.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, mailbox, mailbox_name='Calendar',
+                 credentials=None, latency=0, bandwidth=0):
+        SocketServer.TCPServer.__init__(self, address, IMAPHandler)
+        self.mailbox = mailbox
+        self.mailbox_name = mailbox_name
+        self.credentials = credentials
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # Send the UID after the other FETCH items, as allowed by RFC 3501
+        self.uid_last = False
+        # Answer NO to the searches, like a server rejecting the criteria
+        self.refuse_search = False
+        # Answer NO to the fetches of several messages, or leave out the
+        # given UIDs from their responses
+        self.refuse_batch_fetch = False
+        self.omitted = set()
+        # Criteria of the searches received, in order
+        self.searches = []
+        self.stats = Stats()
+        self.thread = None
+
+    def start(self):
+        '''
+        Serves the requests in a background thread.
+        '''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+def main(args):
+    usage_str = 'usage: %prog [options] MAILDIR'
+    parser = optparse.OptionParser(usage = usage_str)
+
+    parser.add_option('--port', dest='port',
+                      type='int', default=1143,
+                      help='Port to listen on (default: %default)')
+    parser.add_option('--mailbox', dest='mailbox',
+                      default='Calendar',
+                      help='Name of the served mailbox (default: %default)')
+    parser.add_option('--latency', dest='latency',
+                      type='float', default=0,
+                      metavar='MS',
+                      help='Delay added to each command in milliseconds')
+    parser.add_option('--bandwidth', dest='bandwidth',
+                      type='int', default=0,
+                      metavar='KB/S',
+                      help='Maximum bandwidth of the responses in kilobytes per '
+                           'second, 0 for unlimited (default: %default)')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('the folder of the mails to serve is required')
+
+    mailbox = Mailbox()
+    mailbox.load_dir(args[0])
+    server = IMAPServer(('127.0.0.1', options.port), mailbox, options.mailbox,
+                        latency=options.latency / 1000.0,
+                        bandwidth=options.bandwidth * 1024)
+    print 'Serving %d mails on port %d' % (len(mailbox.messages),
+                                           server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    sys.exit(ret)
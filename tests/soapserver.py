@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+# groupwise-ics: synchronize GroupWise calendar to ICS file and back
+# Copyright (C) 2013  Cedric Bosdonnat <cedric@bosdonnat.fr>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Minimal GroupWise SOAP server: it serves the appointments of a single
+# calendar folder and only knows the requests groupwise-ics needs. The
+# responses are sent with chunked encoding on kept-alive connections.
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import datetime
+import optparse
+import socket
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+METHODS_NS = 'http://schemas.novell.com/2005/01/GroupWise/methods'
+TYPES_NS = 'http://schemas.novell.com/2005/01/GroupWise/types'
+
+RESPONSE_HEAD = '''<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:gwm="%s" xmlns:gwt="%s" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"><SOAP-ENV:Body>''' % (METHODS_NS, TYPES_NS)
+RESPONSE_FOOTER = '</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+START = datetime.datetime(2013, 1, 7, 8, 0, 0)
+
+def format_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def make_appointment(index):
+    '''
+    @result: the fields of a generated appointment
+    '''
+    start = START + datetime.timedelta(days=index % 700, hours=index % 9)
+    return {
+        'iCalId': '%08d-soap-%d@hacker.com' % (index, index),
+        'subject': 'Generated meeting %d' % index,
+        'place': 'Room %d, floor %d' % (index % 30, index % 3),
+        'message': 'Agenda of the generated meeting %d.\nBe on time.' % index,
+        'startDate': start,
+        'endDate': start + datetime.timedelta(hours=1),
+        'allDayEvent': False,
+        'organizer': ('Organizer %d' % (index % 50),
+                      'organizer%d@hacker.com' % (index % 50)),
+        'recipients': [('Attendee %d' % (index % 7),
+                        'attendee%d@hacker.com' % (index % 7), 'accepted')],
+    }
+
+class Folder(object):
+    '''
+    Appointments of the calendar folder. Every change sets the modified
+    date of the appointment from a clock advancing by step seconds, so
+    that the dates are predictable.
+    '''
+
+    def __init__(self, folder_id='calendar.folder@1', step=1):
+        self.folder_id = folder_id
+        self.lock = threading.Lock()
+        self.items = {}
+        self.next_id = 1
+        self.clock = START
+        self.step = datetime.timedelta(seconds=step)
+
+    def touch(self):
+        self.clock += self.step
+        return self.clock
+
+    def add(self, fields):
+        '''
+        @result: the id of the new appointment
+        '''
+        with self.lock:
+            item_id = '%08X.calendar.%d' % (self.next_id, self.next_id)
+            self.next_id += 1
+            item = dict(fields)
+            item['id'] = item_id
+            item['modified'] = self.touch()
+            self.items[item_id] = item
+        return item_id
+
+    def update(self, item_id, **fields):
+        with self.lock:
+            self.items[item_id].update(fields)
+            self.items[item_id]['modified'] = self.touch()
+
+    def delete(self, item_id):
+        with self.lock:
+            del self.items[item_id]
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(self.items[item_id]) for item_id in sorted(self.items)]
+
+class Stats(object):
+    '''
+    Counters of the server activity, shared by all the connections.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.connections = 0
+        self.requests = {}
+        self.items = 0
+        self.bytes_out = 0
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def sent(self, items, size):
+        with self.lock:
+            self.items += items
+            self.bytes_out += size
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'requests': dict(self.requests),
+                'items': self.items,
+                'bytes_out': self.bytes_out,
+            }
+
+def address_xml(tag, name, address, extra=''):
+    return '<gwt:%s><gwt:displayName>%s</gwt:displayName>' \
+           '<gwt:email>%s</gwt:email>%s</gwt:%s>' % (
+               tag, escape(name), escape(address), extra, tag)
+
+def item_xml(item, fields):
+    '''
+    @fields: the names of the fields to include, None for all of them
+    '''
+    def wanted(name):
+        return fields is None or name in fields
+
+    out = ['<gwt:item xsi:type="gwt:Appointment"><gwt:id>%s</gwt:id>' %
+           escape(item['id'])]
+    if wanted('iCalId'):
+        out.append('<gwt:iCalId>%s</gwt:iCalId>' % escape(item['iCalId']))
+    if wanted('modified'):
+        out.append('<gwt:modified>%s</gwt:modified>' % format_date(item['modified']))
+    for name in ('startDate', 'endDate'):
+        if wanted(name):
+            out.append('<gwt:%s>%s</gwt:%s>' % (name, format_date(item[name]), name))
+    if wanted('allDayEvent'):
+        out.append('<gwt:allDayEvent>%d</gwt:allDayEvent>' % item['allDayEvent'])
+    if wanted('recurrenceKey'):
+        out.append('<gwt:recurrenceKey>%d</gwt:recurrenceKey>' %
+                   item.get('recurrenceKey', 0))
+    for name in ('subject', 'place'):
+        if wanted(name):
+            out.append('<gwt:%s>%s</gwt:%s>' % (name, escape(item[name]), name))
+    if wanted('message'):
+        content_type = 'text/plain'
+        if item.get('charset') is not None:
+            content_type += '; charset=%s' % item['charset']
+        out.append('<gwt:message><gwt:part contentType="%s">%s'
+                   '</gwt:part></gwt:message>' %
+                   (content_type, base64.b64encode(item['message'])))
+    if wanted('distribution'):
+        recipients = []
+        for (name, address, status) in item['recipients']:
+            recipients.append(address_xml('recipient', name, address,
+                '<gwt:distType>TO</gwt:distType><gwt:recipientStatus>'
+                '<gwt:%s>%s</gwt:%s></gwt:recipientStatus>' % (
+                    status, format_date(item['modified']), status)))
+        out.append('<gwt:distribution>%s<gwt:recipients>%s</gwt:recipients>'
+                   '</gwt:distribution>' % (address_xml('from', *item['organizer']),
+                                            ''.join(recipients)))
+    out.append('</gwt:item>')
+    return ''.join(out)
+
+class Fault(Exception):
+    pass
+
+class SoapHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # handle_one_request() closes the connection on timeouts
+        if self.server.idle_timeout is not None:
+            self.connection.settimeout(self.server.idle_timeout)
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_chunks(self, chunks):
+        '''
+        Sends the response body with chunked encoding.
+        '''
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.server.stats.sent(0, len(chunk))
+        self.wfile.write('0\r\n\r\n')
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        envelope = ET.fromstring(self.rfile.read(length))
+        body = envelope.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
+        request = body[0]
+        name = request.tag.split('}')[-1]
+        self.server.stats.count(name)
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        try:
+            self.session = envelope.findtext('.//session')
+            if name != 'loginRequest':
+                if self.session not in self.server.sessions:
+                    raise Fault('Invalid session')
+            handler = getattr(self, 'do_%s' % name, None)
+            if handler is None:
+                raise Fault('Unsupported request %s' % name)
+            chunks = handler(request)
+        except Fault, e:
+            content = '%s<SOAP-ENV:Fault><faultstring>%s</faultstring>' \
+                      '</SOAP-ENV:Fault>%s' % (RESPONSE_HEAD, escape(str(e)),
+                                               RESPONSE_FOOTER)
+            self.send_response(500)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        self.send_chunks([RESPONSE_HEAD] + list(chunks) + [RESPONSE_FOOTER])
+
+    def do_loginRequest(self, request):
+        username = request.findtext('.//{%s}username' % TYPES_NS)
+        password = request.findtext('.//{%s}password' % TYPES_NS)
+        credentials = self.server.credentials
+        if credentials is not None and credentials != (username, password):
+            return ['<gwm:loginResponse><gwm:status><gwt:code>53505</gwt:code>'
+                    '</gwm:status></gwm:loginResponse>']
+        with self.server.lock:
+            self.server.next_session += 1
+            session = 'session-%d' % self.server.next_session
+            self.server.sessions.add(session)
+        return ['<gwm:loginResponse><gwm:session>%s</gwm:session>'
+                '</gwm:loginResponse>' % session]
+
+    def do_logoutRequest(self, request):
+        with self.server.lock:
+            self.server.sessions.discard(self.session)
+        return ['<gwm:logoutResponse/>']
+
+    def do_getFolderRequest(self, request):
+        folder_type = request.findtext('{%s}folderType' % METHODS_NS)
+        for (folder_id, parent_id, name, kind) in self.server.folders:
+            if kind == folder_type:
+                return ['<gwm:getFolderResponse><gwm:folder><gwt:id>%s</gwt:id>'
+                        '<gwt:name>%s</gwt:name></gwm:folder></gwm:getFolderResponse>' %
+                        (escape(folder_id), escape(name))]
+        return ['<gwm:getFolderResponse/>']
+
+    def do_getFolderListRequest(self, request):
+        parents = set([request.findtext('{%s}parent' % METHODS_NS)])
+        recurse = request.findtext('{%s}recurse' % METHODS_NS) == 'true'
+        out = ['<gwm:getFolderListResponse><gwm:folders>']
+        # The folders are listed after their parent
+        for (folder_id, parent_id, name, kind) in self.server.folders:
+            if parent_id not in parents:
+                continue
+            if recurse:
+                parents.add(folder_id)
+            folder_type = ''
+            if kind is not None:
+                folder_type = '<gwt:folderType>%s</gwt:folderType>' % kind
+            out.append('<gwt:folder><gwt:id>%s</gwt:id><gwt:name>%s</gwt:name>'
+                       '<gwt:parent>%s</gwt:parent>%s</gwt:folder>' %
+                       (escape(folder_id), escape(name), escape(parent_id),
+                        folder_type))
+        out.append('</gwm:folders></gwm:getFolderListResponse>')
+        return out
+
+    def do_getItemsRequest(self, request):
+        container = request.findtext('{%s}container' % METHODS_NS)
+        if container != self.server.folder.folder_id:
+            raise Fault('Unknown container %s' % container)
+        fields = None
+        view = request.findtext('{%s}view' % METHODS_NS)
+        if view is not None:
+            fields = set(view.split())
+
+        items = self.server.folder.snapshot()
+        for element in request.findall('{%s}filter/{%s}element' %
+                                       (METHODS_NS, TYPES_NS)):
+            op = element.findtext('{%s}op' % TYPES_NS)
+            field = element.findtext('{%s}field' % TYPES_NS)
+            value = element.findtext('{%s}value' % TYPES_NS)
+            if field != 'modified' or op not in ('gt', 'gte'):
+                raise Fault('Unsupported filter %s %s' % (field, op))
+            if op == 'gt':
+                items = [item for item in items if format_date(item['modified']) > value]
+            else:
+                items = [item for item in items if format_date(item['modified']) >= value]
+
+        def generate():
+            yield '<gwm:getItemsResponse><gwm:items>'
+            for item in items:
+                self.server.stats.sent(1, 0)
+                yield item_xml(item, fields)
+            yield '</gwm:items></gwm:getItemsResponse>'
+        return generate()
+
+    def do_getItemRequest(self, request):
+        item_id = request.findtext('{%s}id' % METHODS_NS)
+        for item in self.server.folder.snapshot():
+            if item['id'] == item_id:
+                self.server.stats.sent(1, 0)
+                return ['<gwm:getItemResponse>%s</gwm:getItemResponse>' %
+                        item_xml(item, None).replace('gwt:item', 'gwm:item')]
+        raise Fault('Unknown item %s' % item_id)
+
+class SoapServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    SOAP stand-in server. Use port 0 to get a free port, then read it
+    from server_address.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, folder, credentials=None, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SoapHandler)
+        self.folder = folder
+        # (folder id, parent id, name, system folder type), the parents
+        # first. Only the calendar folder has items.
+        self.folders = [('mailbox.folder@1', 'folders', 'Mailbox', 'Mailbox'),
+                        (folder.folder_id, 'folders', 'Calendar', 'Calendar'),
+                        ('team.folder@1', folder.folder_id, 'Team', None)]
+        self.credentials = credentials
+        self.latency = latency
+        # Seconds after which the idle kept-alive connections are closed
+        self.idle_timeout = None
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.next_session = 0
+        self.thread = None
+
+    def start(self):
+        '''
+        Serves the requests in a background thread.
+        '''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # The clients may close their connection before the response is
+        # sent, like when they time out
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+def main(args):
+    usage_str = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage = usage_str)
+
+    parser.add_option('--port', dest='port',
+                      type='int', default=7191,
+                      help='Port to listen on (default: %default)')
+    parser.add_option('--events', dest='events',
+                      type='int', default=100,
+                      help='Number of generated appointments (default: %default)')
+    parser.add_option('--latency', dest='latency',
+                      type='float', default=0,
+                      metavar='MS',
+                      help='Delay added to each request in milliseconds')
+
+    (options, args) = parser.parse_args()
+
+    folder = Folder()
+    for index in range(options.events):
+        folder.add(make_appointment(index))
+    server = SoapServer(('127.0.0.1', options.port), folder,
+                        latency=options.latency / 1000.0)
+    print 'Serving %d appointments on port %d' % (len(folder.items),
+                                                  server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    sys.exit(ret)